@@ -1,8 +1,35 @@
-"""Site announcement models."""
+"""
+Site announcement models.
+
+Read state is tracked with a per-profile watermark rather than per-profile
+sets of unread IDs: for each profile Redis holds the ID through which all
+announcements are read, plus a small set of announcements after that
+watermark which the profile has dismissed. An announcement is unread by a web
+user if it is newer than both their watermark and their account, and not
+dismissed.
+
+Since announcements are rare, each process caches all announcement rows, and
+each profile's unread announcements, locally. The cache is invalidated
+whenever the Redis version key (bumped by ``to_all`` and ``mark_read``)
+changes; the version is checked at most once every
+``ANNOUNCEMENT_CACHE_SECONDS``.
+
+"""
+import threading
+import time
+
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 
-from portfoliyo import redis, model
+from portfoliyo import redis
+
+
+
+VERSION_KEY = 'announcements:version'
+
+# maximum number of profiles' unread announcements cached per process
+MAX_CACHED_PROFILES = 10000
 
 
 
@@ -20,28 +47,128 @@ def to_all(text):
     """Create an announcement, mark it unread by all web users."""
     a = Announcement.objects.create(text=text)
 
-    for profile_id in model.Profile.objects.filter(
-            user__email__isnull=False).values_list('id', flat=True):
-        redis.client.sadd(make_key(profile_id), a.pk)
+    _client().incr(VERSION_KEY)
+    clear_cache()
 
     return a
 
 
 
 def get_unread(profile):
-    """Get unread announcements for given profile."""
-    announcement_ids = redis.client.smembers(make_key(profile.id))
+    """Get list of unread announcements for given profile."""
+    if not profile.user.email:
+        return []
 
-    return Announcement.objects.filter(pk__in=announcement_ids).order_by(
-        'timestamp')
+    with _cache_lock:
+        announcements = _get_cached_announcements()
+        unread = _cache['unread_by_profile'].get(profile.id)
+    if unread is None:
+        unread = _compute_unread(profile, announcements)
+        with _cache_lock:
+            by_profile = _cache['unread_by_profile']
+            if len(by_profile) >= MAX_CACHED_PROFILES:
+                by_profile.clear()
+            by_profile[profile.id] = unread
+    return list(unread)
 
 
 
 def mark_read(profile, announcement_id):
-    return redis.client.srem(make_key(profile.id), announcement_id)
+    p = _client().pipeline()
+    p.sadd(make_dismissed_key(profile.id), announcement_id)
+    p.incr(VERSION_KEY)
+    ret = p.execute()[0]
+    clear_cache()
+    return ret
+
+
+
+def clear_cache():
+    """Clear this process' announcement cache."""
+    with _cache_lock:
+        _cache['version'] = None
+        _cache['checked'] = None
+        _cache['announcements'] = []
+        _cache['unread_by_profile'] = {}
+
+
+_cache_lock = threading.RLock()
+_cache = {}
+clear_cache()
+
+
+
+def _get_cached_announcements():
+    """Return list of all announcements, refreshing the cache if outdated."""
+    now = time.time()
+    checked = _cache['checked']
+    if checked is None or now - checked >= settings.ANNOUNCEMENT_CACHE_SECONDS:
+        version = _client().get(VERSION_KEY)
+        if checked is None or version != _cache['version']:
+            _cache['version'] = version
+            _cache['announcements'] = list(
+                Announcement.objects.order_by('timestamp'))
+            _cache['unread_by_profile'] = {}
+        _cache['checked'] = now
+    return _cache['announcements']
+
+
+
+def _compute_unread(profile, announcements):
+    """Return list of profile's unread announcements from those given."""
+    joined = profile.user.date_joined
+    candidates = [a for a in announcements if a.timestamp >= joined]
+    if not candidates:
+        return []
+
+    p = _client().pipeline()
+    p.get(make_watermark_key(profile.id))
+    p.smembers(make_dismissed_key(profile.id))
+    watermark, dismissed = p.execute()
+    watermark = int(watermark or 0)
+    dismissed = set(int(a) for a in dismissed)
+
+    unread = [
+        a for a in candidates if a.pk > watermark and a.pk not in dismissed]
+
+    latest_id = max(a.pk for a in announcements)
+    if not unread and latest_id > watermark:
+        # everything through latest_id is read; future checks can skip it
+        _advance_watermark(
+            profile.id, latest_id, [a for a in dismissed if a <= latest_id])
+
+    return unread
+
+
+
+def _advance_watermark(profile_id, announcement_id, dismissed_ids):
+    """
+    Mark all announcements through ``announcement_id`` read by profile.
+
+    ``dismissed_ids`` are the profile's dismissed announcement IDs no greater
+    than ``announcement_id``, which the watermark now covers.
+
+    """
+    p = _client().pipeline()
+    p.set(make_watermark_key(profile_id), announcement_id)
+    for dismissed_id in dismissed_ids:
+        p.srem(make_dismissed_key(profile_id), dismissed_id)
+    p.execute()
+
+
+
+def _client():
+    """Return Redis client for announcement state."""
+    return redis.get_client('announcements')
+
+
+
+def make_watermark_key(profile_id):
+    """Return Redis key for ID through which profile has read everything."""
+    return 'announcements:read-through:%s' % profile_id
 
 
 
-def make_key(profile_id):
-    """Return Redis key for given profile's set of unread announcement IDs."""
-    return 'announcements:unread:%s' % profile_id
+def make_dismissed_key(profile_id):
+    """Return Redis key for profile's set of dismissed announcement IDs."""
+    return 'announcements:dismissed:%s' % profile_id
@@ -1,17 +1,20 @@
 """Celery configuration."""
 from __future__ import absolute_import
 
-from collections import Sequence
+from collections import Sequence, namedtuple
+from contextlib import contextmanager
 import logging
 import threading
 
 from celery import Celery, Task
+from celery.signals import task_prerun, task_postrun
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db import transaction, models
 from django.db.models import loading
+from kombu import Exchange, Queue
 
-from portfoliyo import xact
+from portfoliyo import redis, xact
 
 
 if 'raven.contrib.django' in settings.INSTALLED_APPS: # pragma: no cover
@@ -54,16 +57,28 @@ class TransactionTask(Task):
     up by a worker, before the database transaction that saves those objects is
     commmitted, it would fail.
 
+    When the transaction commits, identical pending calls of a task that sets
+    ``dedupe`` are sent only once. If a task sets ``batch_task`` (the name of a
+    task taking a single list of ``(args, kwargs)`` tuples), its pending calls
+    with no extra options are merged into a single call of that batch task.
+    See ``publish``.
+
     This implementation is inspired by
     https://github.com/chrisdoble/django-celery-transactions
 
     """
+    # True if identical calls pending in one transaction need only run once
+    dedupe = False
+    # name of task that can run a list of (args, kwargs) calls of this task
+    batch_task = None
+
+
     def original_apply_async(self, *a, **kw):
         """Shortcut to reach original ``apply_async`` method."""
         return super(TransactionTask, self).apply_async(*a, **kw)
 
 
-    def apply_async(self, *args, **kw):
+    def apply_async(self, args=None, kwargs=None, **options):
         """
         If in transaction, push onto pending-tasks instead of sending to queue.
 
@@ -71,10 +86,18 @@ class TransactionTask(Task):
 
         """
         if _in_transaction():
-            _get_pending_tasks().append((self, args, kw))
+            _get_pending_tasks().append(
+                Call(self, tuple(args or ()), kwargs or {}, options))
         else:
             # no transaction in progress, send to queue immediately
-            return self.original_apply_async(*args, **kw)
+            return self.original_apply_async(args, kwargs, **options)
+
+
+
+# a pending call of a task
+Call = namedtuple('Call', ['task', 'args', 'kwargs', 'options'])
+# pending calls to be merged into one call of the named batch task
+Batch = namedtuple('Batch', ['task_name', 'calls'])
 
 
 
@@ -95,13 +118,113 @@ xact.post_rollback.connect(_discard_tasks)
 def _send_tasks(**kw):
     """Transaction is committed; send all pending tasks."""
     pending = _get_pending_tasks()
-    while pending:
-        task, a, kw = pending.pop(0)
-        task.original_apply_async(*a, **kw)
+    calls = pending[:]
+    pending[:] = []
+    if not calls:
+        return
+    stats = publish(calls)
+    if stats['duplicates'] or stats['merged']:
+        logger.info(
+            "Published %(published)s of %(queued)s pending tasks "
+            "(%(duplicates)s duplicates dropped, %(merged)s merged).", stats)
 
 xact.post_commit.connect(_send_tasks)
 
 
+
+def publish(calls):
+    """
+    Coalesce and send given ``Call``s.
+
+    Identical calls of a task with ``dedupe`` set are only sent once. Calls of
+    a task with a ``batch_task``, and no extra options, are merged into one
+    call of the batch task, sent where the first of them would have been; so
+    merged calls may be sent before calls of other tasks that preceded them.
+    Everything is sent over a single broker connection.
+
+    Return dict of stats: number of calls ``queued``, ``duplicates`` dropped,
+    calls ``merged`` into batch tasks, and tasks ``published``.
+
+    """
+    stats = {'queued': len(calls), 'duplicates': 0, 'merged': 0}
+    seen = set()
+    # maps batch task name to its Batch
+    batches = {}
+    # Calls and Batches, in order of sending
+    to_send = []
+    for call in calls:
+        if call.task.dedupe:
+            key = (
+                call.task.name,
+                repr(call.args),
+                repr(sorted(call.kwargs.items())),
+                repr(sorted(call.options.items())),
+                )
+            if key in seen:
+                stats['duplicates'] += 1
+                continue
+            seen.add(key)
+        batch_task_name = call.task.batch_task
+        if batch_task_name and not call.options:
+            if batch_task_name not in batches:
+                batches[batch_task_name] = Batch(batch_task_name, [])
+                to_send.append(batches[batch_task_name])
+            batches[batch_task_name].calls.append(call)
+        else:
+            to_send.append(call)
+
+    with _producer() as producer:
+        for item in to_send:
+            if isinstance(item, Batch):
+                if len(item.calls) > 1:
+                    stats['merged'] += len(item.calls)
+                    celery.tasks[item.task_name].original_apply_async(
+                        ([(c.args, c.kwargs) for c in item.calls],),
+                        producer=producer,
+                        )
+                    continue
+                # a batch of one is sent as the original call
+                item = item.calls[0]
+            item.task.original_apply_async(
+                item.args, item.kwargs, producer=producer, **item.options)
+
+    stats['published'] = len(to_send)
+    return stats
+
+
+
+@contextmanager
+def _producer():
+    """Context manager yielding a broker producer (``None`` if eager)."""
+    if celery.conf.CELERY_ALWAYS_EAGER:
+        yield None
+    else: # pragma: no cover
+        with celery.producer_or_acquire() as producer:
+            yield producer
+
+
+
+def _start_task_redis_stats(task_id=None, task=None, **kw):
+    """Task is starting; track its Redis usage."""
+    _thread_data.__dict__.setdefault('redis_stats', {})[task_id] = (
+        redis.start_stats(task.name))
+
+task_prerun.connect(_start_task_redis_stats)
+
+
+
+def _stop_task_redis_stats(task_id=None, **kw):
+    """Task is finished; log its Redis usage (if it used Redis at all)."""
+    stats = _thread_data.__dict__.get('redis_stats', {}).pop(task_id, None)
+    if stats is not None:
+        redis.stop_stats(stats)
+        if stats.calls:
+            stats.log()
+
+task_postrun.connect(_stop_task_redis_stats)
+
+
+
 class TransactionCelery(Celery):
     """Celery app class that uses TransactionTask task base by default."""
     def task(self, *a, **kw):
@@ -174,6 +297,50 @@ class ModelReference(object):
         return val
 
 
+    @classmethod
+    def find(cls, val):
+        """Return list of all ``ModelReference``s in ``val`` (or sequence)."""
+        if is_sequence(val):
+            return [ref for v in val for ref in cls.find(v)]
+        if isinstance(val, cls):
+            return [val]
+        return []
+
+
+    @classmethod
+    def load(cls, refs, cache, select_related=None):
+        """
+        Load instances for all given references into ``cache`` dict.
+
+        Takes one query per distinct model class. ``select_related`` maps
+        lower-case ``"app_label.model_name"`` to a list of relations to load
+        along with instances of that model.
+
+        References that can't be loaded (unknown model class, or missing
+        instance) are skipped; dereferencing them will fail as usual.
+
+        """
+        select_related = select_related or {}
+        pks_by_model = {}
+        for ref in refs:
+            if ref.as_tuple() not in cache:
+                pks_by_model.setdefault(
+                    (ref.app_label, ref.model_name), set()).add(ref.pk)
+        for (app_label, model_name), pks in pks_by_model.items():
+            model_class = loading.cache.get_model(app_label, model_name)
+            if model_class is None:
+                continue
+            logger.debug(
+                "ModelTask loading %s.%s pks %r" % (
+                    app_label, model_name, sorted(pks)))
+            qs = model_class._default_manager.all()
+            related = select_related.get('%s.%s' % (app_label, model_name))
+            if related:
+                qs = qs.select_related(*related)
+            for pk, instance in qs.in_bulk(list(pks)).items():
+                cache[(app_label, model_name, pk)] = instance
+
+
     def _dereference(self, cache):
         """Return referenced model instance, or raise ``DereferenceFailed``."""
         t = self.as_tuple()
@@ -222,9 +389,17 @@ class ModelTask(TransactionTask):
     At execution time, the ``ModelReference`` is re-hydrated into an actual
     model object, which is passed to the task function. If any model arguments
     cannot be re-hydrated (i.e. the row has disappeared from the database), the
-    task is not executed.
+    task is not executed. All references to the same model class are loaded
+    in a single query.
+
+    A task can set ``select_related`` (e.g. as an option to the ``task``
+    decorator) to a dict mapping lower-case ``"app_label.model_name"`` to a
+    list of relations to load along with its model arguments of that class.
 
     """
+    select_related = None
+
+
     def apply_async(self, args=None, kwargs=None, **kw):
         """Dehydrate any model arguments to ``ModelReference`` instances."""
         args = [ModelReference.from_instance(a) for a in args]
@@ -242,6 +417,11 @@ class ModelTask(TransactionTask):
 
         """
         cache = {}
+        ModelReference.load(
+            ModelReference.find(list(args) + kw.values()),
+            cache,
+            self.select_related,
+            )
         try:
             args = [ModelReference.dereference(a, cache) for a in args]
             kw = dict(
@@ -260,8 +440,8 @@ if not settings.CELERY_ALWAYS_EAGER: # pragma: no cover
         raise ImproperlyConfigured(
             "Must set REDIS_URL in order to turn CELERY_ALWAYS_EAGER off.")
     celery = TransactionCelery(
-        broker=settings.REDIS_URL,
-        backend=settings.REDIS_URL,
+        broker=redis.get_url('broker'),
+        backend=redis.get_url('broker'),
         )
 else:
     celery = TransactionCelery()
@@ -271,4 +451,50 @@ celery.conf.update(
     CELERY_DISABLE_RATE_LIMITS=True,
     CELERY_TIMEZONE=settings.TIME_ZONE,
     CELERY_STORE_ERRORS_EVEN_IF_IGNORED=True,
+    CELERY_QUEUES=[
+        Queue(name, Exchange(name), routing_key=name)
+        for name in settings.CELERY_TASK_QUEUES
+        ],
+    CELERY_DEFAULT_QUEUE=settings.CELERY_DEFAULT_QUEUE,
+    CELERY_DEFAULT_EXCHANGE=settings.CELERY_DEFAULT_QUEUE,
+    CELERY_DEFAULT_ROUTING_KEY=settings.CELERY_DEFAULT_QUEUE,
+    CELERY_ROUTES=settings.CELERY_ROUTES,
+    CELERYBEAT_SCHEDULE=settings.CELERYBEAT_SCHEDULE,
     )
+
+
+
+# separator and priority suffixes kombu's Redis transport uses for the
+# per-priority lists backing each queue
+_PRIORITY_SEP = '\x06\x16'
+_PRIORITY_STEPS = [0, 3, 6, 9]
+
+
+
+def queue_depths(queues=None):
+    """
+    Return dict mapping queue name to number of tasks waiting in it.
+
+    ``queues`` defaults to ``CELERY_TASK_QUEUES``. Counts all priorities of
+    each queue, in a single round-trip to the broker's Redis.
+
+    """
+    queues = queues or settings.CELERY_TASK_QUEUES
+    p = redis.get_client('broker').pipeline()
+    for queue in queues:
+        for key in _priority_keys(queue):
+            p.llen(key)
+    lengths = iter(p.execute())
+    return dict(
+        (queue, sum(next(lengths) for step in _PRIORITY_STEPS))
+        for queue in queues
+        )
+
+
+
+def _priority_keys(queue):
+    """Return broker Redis list keys for all priorities of ``queue``."""
+    return [
+        '%s%s%s' % (queue, _PRIORITY_SEP, step) if step else queue
+        for step in _PRIORITY_STEPS
+        ]
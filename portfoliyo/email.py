@@ -52,6 +52,19 @@ def send_multipart(subject, text_part, html_part, recipients,
     ``sender`` can be an email, 'Name <email>' or None. If unspecified, the
     ``DEFAULT_FROM_EMAIL`` setting will be used.
 
+    """
+    msg = make_multipart(subject, text_part, html_part, recipients, sender)
+    return msg.send(fail_silently)
+
+
+
+def make_multipart(subject, text_part, html_part, recipients, sender=None):
+    """
+    Return a multi-part email message with both HTML and text parts.
+
+    Arguments are the same as for ``send_multipart``. Use this rather than
+    ``send_multipart`` to send many messages over a single connection.
+
     """
     sender = sender or settings.DEFAULT_FROM_EMAIL
 
@@ -59,4 +72,4 @@ def send_multipart(subject, text_part, html_part, recipients,
     subject = u" ".join(subject.splitlines()).strip()
     msg = EmailMultiAlternatives(subject, text_part, sender, recipients)
     msg.attach_alternative(html_part, "text/html")
-    return msg.send(fail_silently)
+    return msg
@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from portfoliyo import redis
+from portfoliyo.model.village import unread
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Drop unread state for deleted relationships, cap unread posts per "
+        "village, and print Redis memory usage by key prefix."
+        )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--max-unread',
+            dest='max_unread',
+            default=None,
+            help=(
+                "Unread posts to keep per village "
+                "(default UNREAD_MAX_PER_VILLAGE)."
+                ),
+            ),
+        make_option(
+            '--report-only',
+            action='store_true',
+            dest='report_only',
+            default=False,
+            help="Only print the memory report; don't compact.",
+            ),
+        )
+
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        max_unread = options.get('max_unread')
+        if max_unread is None:
+            max_unread = settings.UNREAD_MAX_PER_VILLAGE
+        else:
+            try:
+                max_unread = int(max_unread)
+            except ValueError:
+                raise CommandError("--max-unread must be an integer.")
+
+        if not options.get('report_only'):
+            stats = unread.compact(max_unread)
+            if verbosity:
+                self.stdout.write(
+                    "Scanned %(scanned)s unread keys; deleted %(deleted)s, "
+                    "trimmed %(trimmed)s posts.\n" % stats
+                    )
+        if verbosity:
+            report = redis.memory_report()
+            self.stdout.write("\n%-20s %10s %12s\n" % ("prefix", "keys", "bytes"))
+            for prefix, usage in sorted(report.items()):
+                self.stdout.write(
+                    "%-20s %10s %12s\n" % (
+                        prefix, usage['keys'], usage['bytes']))
@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+
+from portfoliyo import celery
+
+
+
+class Command(BaseCommand):
+    args = "[queue ...]"
+    help = (
+        "Print the number of tasks waiting in each task queue "
+        "(default all of CELERY_TASK_QUEUES)."
+        )
+
+
+    def handle(self, *args, **options):
+        depths = celery.queue_depths(list(args) or None)
+        self.stdout.write("%-20s %10s\n" % ("queue", "tasks"))
+        for queue, depth in sorted(depths.items()):
+            self.stdout.write("%-20s %10s\n" % (queue, depth))
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+from portfoliyo.model.village import unread
+
+
+CHUNK_SIZE = 1000
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Convert unread-post sets to sorted sets scored by post timestamp."
+        for client, keys in self._unread_keys_by_client(orm).items():
+            self._forwards(orm, client, keys)
+
+
+    def _forwards(self, orm, client, keys):
+        "Convert given unread-post sets, all stored in given client."
+        p = client.pipeline()
+        for key in keys:
+            p.smembers(key)
+        ids_by_key = dict(zip(keys, p.execute()))
+
+        all_ids = sorted(
+            set(int(pid) for post_ids in ids_by_key.values() for pid in post_ids))
+        scores = {}
+        for i in range(0, len(all_ids), CHUNK_SIZE):
+            for post_id, timestamp in orm['village.Post'].objects.filter(
+                    pk__in=all_ids[i:i+CHUNK_SIZE]).values_list(
+                    'id', 'timestamp'):
+                scores[str(post_id)] = (
+                    calendar.timegm(timestamp.utctimetuple()) +
+                    timestamp.microsecond / 1000000.0
+                    )
+
+        p = client.pipeline()
+        for key, post_ids in ids_by_key.items():
+            if not post_ids:
+                continue
+            p.delete(key)
+            args = []
+            for post_id in post_ids:
+                # posts deleted since being marked unread are dropped
+                if str(post_id) in scores:
+                    args.extend([scores[str(post_id)], post_id])
+            # keep the unread count (populated by 0012) in step with the set
+            elder_id, student_id = key.split(':')[1:]
+            counts_key = 'unread-counts:%s' % elder_id
+            if args:
+                p.zadd(key, *args)
+                p.hmset(counts_key, {student_id: len(args) // 2})
+            else:
+                p.hdel(counts_key, student_id)
+        p.execute()
+
+
+    def backwards(self, orm):
+        "Convert unread-post sorted sets back to plain sets."
+        for client, keys in self._unread_keys_by_client(orm).items():
+            p = client.pipeline()
+            for key in keys:
+                p.zrangebyscore(key, '-inf', '+inf')
+            ids_by_key = dict(zip(keys, p.execute()))
+
+            p = client.pipeline()
+            for key, post_ids in ids_by_key.items():
+                if post_ids:
+                    p.delete(key)
+                    p.sadd(key, *post_ids)
+            p.execute()
+
+
+    def _unread_keys_by_client(self, orm):
+        "Return dict mapping Redis client to its possible unread-post keys."
+        keys_by_client = {}
+        for elder_id, student_id in orm['users.Relationship'].objects.values_list(
+                'from_profile_id', 'to_profile_id'):
+            keys_by_client.setdefault(unread._client(elder_id), []).append(
+                'unread:%s:%s' % (elder_id, student_id))
+        return keys_by_client
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '255', 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'users.group': {
+            'Meta': {'object_name': 'Group'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '20'}),
+            'elders': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'elder_in_groups'", 'blank': 'True', 'to': "orm['users.Profile']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'owned_groups'", 'to': "orm['users.Profile']"}),
+            'students': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'student_in_groups'", 'blank': 'True', 'to': "orm['users.Profile']"})
+        },
+        'users.profile': {
+            'Meta': {'object_name': 'Profile'},
+            'code': ('django.db.models.fields.CharField', [], {'max_length': '20', 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'country_code': ('django.db.models.fields.CharField', [], {'default': "'us'", 'max_length': '10'}),
+            'declined': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'email_confirmed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'has_posted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invited_by': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['users.Profile']", 'null': 'True', 'blank': 'True'}),
+            'lang_code': ('django.db.models.fields.CharField', [], {'default': "'en'", 'max_length': '10'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'notify_added_to_village': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'notify_joined_my_village': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'notify_new_parent': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'notify_parent_text': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'notify_teacher_post': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'phone': ('django.db.models.fields.CharField', [], {'max_length': '20', 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'role': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'school': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['users.School']"}),
+            'school_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'source_phone': ('django.db.models.fields.CharField', [], {'default': "'+15555555555'", 'max_length': '20'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'users.relationship': {
+            'Meta': {'unique_together': "[('from_profile', 'to_profile', 'kind')]", 'object_name': 'Relationship'},
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '200', 'blank': 'True'}),
+            'direct': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'from_profile': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'relationships_from'", 'to': "orm['users.Profile']"}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'relationships'", 'blank': 'True', 'to': "orm['users.Group']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kind': ('django.db.models.fields.CharField', [], {'default': "'elder'", 'max_length': '20'}),
+            'level': ('django.db.models.fields.CharField', [], {'default': "'normal'", 'max_length': '20'}),
+            'to_profile': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'relationships_to'", 'to': "orm['users.Profile']"})
+        },
+        'users.school': {
+            'Meta': {'unique_together': "[('name', 'postcode')]", 'object_name': 'School'},
+            'auto': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'country_code': ('django.db.models.fields.CharField', [], {'default': "'us'", 'max_length': '10'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'postcode': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        },
+        'village.bulkpost': {
+            'Meta': {'object_name': 'BulkPost'},
+            'author': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'authored_bulkposts'", 'null': 'True', 'to': "orm['users.Profile']"}),
+            'from_sms': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'group': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'bulk_posts'", 'null': 'True', 'to': "orm['users.Group']"}),
+            'html_text': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'meta': ('jsonfield.fields.JSONField', [], {'default': '{}'}),
+            'original_text': ('django.db.models.fields.TextField', [], {}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2013, 4, 9, 0, 0)'}),
+            'to_sms': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'village.post': {
+            'Meta': {'object_name': 'Post'},
+            'author': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'authored_posts'", 'null': 'True', 'to': "orm['users.Profile']"}),
+            'from_bulk': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'triggered'", 'null': 'True', 'to': "orm['village.BulkPost']"}),
+            'from_sms': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'html_text': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'meta': ('jsonfield.fields.JSONField', [], {'default': '{}'}),
+            'original_text': ('django.db.models.fields.TextField', [], {}),
+            'post_type': ('django.db.models.fields.CharField', [], {'default': "'message'", 'max_length': '20'}),
+            'relationship': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'posts'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': "orm['users.Relationship']"}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'posts_in_village'", 'to': "orm['users.Profile']"}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2013, 4, 9, 0, 0)'}),
+            'to_sms': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'village.postattachment': {
+            'Meta': {'object_name': 'PostAttachment'},
+            'attachment': ('django.db.models.fields.files.FileField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'post': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'attachments'", 'to': "orm['village.Post']"})
+        }
+    }
+
+    complete_apps = ['village']
\ No newline at end of file
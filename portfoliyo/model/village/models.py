@@ -234,6 +234,8 @@ class BulkPost(BasePost):
         for rel in relationships:
             rels_by_student[rel.student] = rel
 
+        to_mark_unread = []
+
         for student in group.students.all():
             sub = Post.objects.create(
                 author=author,
@@ -256,7 +258,9 @@ class BulkPost(BasePost):
             # mark the subpost unread by all web users in village (not author)
             for elder in student.elders:
                 if elder.user.email and elder != author:
-                    unread.mark_unread(sub, elder)
+                    to_mark_unread.append((sub, elder))
+
+        unread.mark_unread_many(to_mark_unread)
 
         tasks.push_event.delay(
             'bulk_posted', post.id, author_sequence_id=sequence_id)
@@ -374,9 +378,10 @@ class Post(BasePost):
             post.attachments.create(attachment=uploaded_file)
 
         # mark the post unread by all web users in village (except the author)
-        for elder in student.elders:
-            if elder.user.email and elder != author:
-                unread.mark_unread(post, elder)
+        unread.mark_unread_many(
+            (post, elder) for elder in student.elders
+            if elder.user.email and elder != author
+            )
 
         tasks.push_event.delay(
             'posted',
@@ -1,34 +1,191 @@
-"""Unread-counts data-model layer implementation."""
+"""
+Unread-counts data-model layer implementation.
+
+Unread state is stored in Redis as one sorted set of unread post IDs per
+(profile, student) pair, scored by post timestamp (as a Unix timestamp), so
+unread posts can be queried by time without loading the whole set. Alongside
+these sets, each profile has a single hash mapping student ID to the number of
+unread posts in that student's village, so that counts for all of a profile's
+villages (or groups) can be fetched with a single HGETALL.
+
+The counts hash is only adjusted when a set membership actually changes (per
+the return value of ZADD/ZREM), and each membership change and its count
+update run together in one atomic Lua script (or transaction), so neither
+repeated nor concurrent marking ever skews the counts.
+
+All of a profile's unread state lives on one Redis instance, so the
+``unread`` Redis role may be sharded by profile ID.
+
+Unread keys never expire, so ``compact`` (run periodically by the
+``compact_redis`` task) drops keys for deleted relationships and caps the size
+of each set.
+
+"""
+import calendar
+import datetime
+
+from django.utils import timezone
+
 from portfoliyo import redis
 
 
 
 def mark_unread(post, profile):
     """Mark given post unread by given profile."""
-    redis.client.sadd(make_key(post.student, profile), post.id)
+    _mark_unread_many(_client(profile.id), [(post, profile)])
+
+
+def mark_unread_many(pairs):
+    """
+    Mark many posts unread, given an iterable of (post, profile) pairs.
+
+    Takes one atomic Redis round-trip per Redis instance, regardless of the
+    number of pairs.
+
+    """
+    pairs_by_client = {}
+    for post, profile in pairs:
+        pairs_by_client.setdefault(_client(profile.id), []).append(
+            (post, profile))
+    for client, client_pairs in pairs_by_client.items():
+        _mark_unread_many(client, client_pairs)
+
+
+def _mark_unread_many(client, pairs):
+    """Mark (post, profile) pairs unread, all stored in given client."""
+    keys = []
+    args = []
+    for post, profile in pairs:
+        keys.extend([make_key(post.student, profile), make_counts_key(profile)])
+        args.extend(
+            [repr(timestamp_score(post.timestamp)), post.id, post.student_id])
+    _mark_unread_script(keys=keys, args=args, redis_client=client)
+
+
+
+@redis.script("""
+for k = 1, #KEYS, 2 do
+    local a = (k - 1) / 2 * 3
+    if redis.call('ZADD', KEYS[k], ARGV[a + 1], ARGV[a + 2]) == 1 then
+        redis.call('HINCRBY', KEYS[k + 1], ARGV[a + 3], 1)
+    end
+end
+""")
+def _mark_unread_script(client, keys, args):
+    """
+    Atomically mark posts unread and increment counts of those newly unread.
+
+    ``keys`` are pairs of (unread set key, counts hash key); ``args`` are, for
+    each pair, the post's score, post ID and student ID.
+
+    """
+    for k in range(0, len(keys), 2):
+        score, post_id, student_id = args[k // 2 * 3:k // 2 * 3 + 3]
+        if client.zadd(keys[k], score, post_id):
+            client.hincrby(keys[k + 1], student_id, 1)
 
 
 def mark_read(post, profile):
     """Mark given post read by given profile."""
-    redis.client.srem(make_key(post.student, profile), post.id)
+    _mark_read_script(
+        keys=[make_key(post.student, profile), make_counts_key(profile)],
+        args=[post.id, post.student_id],
+        redis_client=_client(profile.id),
+        )
+
+
+
+@redis.script("""
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[2], ARGV[2], -1)
+end
+""")
+def _mark_read_script(client, keys, args):
+    """
+    Atomically remove post ``args[0]`` from unread set ``keys[0]``.
+
+    If it was unread, decrement count for student ``args[1]`` in counts hash
+    ``keys[1]``.
+
+    """
+    if client.zrem(keys[0], args[0]):
+        client.hincrby(keys[1], args[1], -1)
 
 
 
 def is_unread(post, profile):
     """Given post is unread by given profile (returns boolean)."""
-    return redis.client.sismember(make_key(post.student, profile), post.id)
+    return _client(profile.id).zscore(
+        make_key(post.student, profile), post.id) is not None
 
 
 
 def all_unread(student, profile):
     """Return set of post IDs in ``student`` village unread by ``profile``."""
-    return redis.client.smembers(make_key(student, profile))
+    return set(
+        _client(profile.id).zrangebyscore(
+            make_key(student, profile), '-inf', '+inf'))
+
+
+
+def oldest_unread(student, profile):
+    """
+    Return (post ID, timestamp) of profile's oldest unread post in village.
+
+    Return ``None`` if profile has no unread posts in ``student`` village.
+
+    """
+    found = _client(profile.id).zrangebyscore(
+        make_key(student, profile), '-inf', '+inf',
+        start=0, num=1, withscores=True)
+    if not found:
+        return None
+    post_id, score = found[0]
+    return post_id, score_timestamp(score)
+
+
+
+def unread_before(student, profile, before, count=None):
+    """
+    Return IDs of unread posts in village older than ``before``, newest first.
+
+    ``before`` is a datetime (exclusive). If ``count`` is given, return at most
+    that many IDs; this allows paging back through unread posts.
+
+    """
+    return unread_in_range(student, profile, before=before, count=count)
+
+
+
+def unread_in_range(student, profile, since=None, before=None, count=None):
+    """
+    Return IDs of unread posts in village by timestamp range, newest first.
+
+    ``since`` (inclusive) and ``before`` (exclusive) are datetimes; either may
+    be ``None`` for an open-ended range. If ``count`` is given, return at most
+    that many IDs.
+
+    """
+    low = '-inf' if since is None else timestamp_score(since)
+    high = '+inf' if before is None else '(%r' % timestamp_score(before)
+    kw = {}
+    if count is not None:
+        kw = {'start': 0, 'num': count}
+    return _client(profile.id).zrevrangebyscore(
+        make_key(student, profile), high, low, **kw)
 
 
 
 def unread_count(student, profile):
     """Return count of profile's unread posts in given student's village."""
-    return redis.client.scard(make_key(student, profile))
+    return _client(profile.id).zcard(make_key(student, profile))
+
+
+
+def unread_count_since(student, profile, since):
+    """Return count of profile's unread posts in village since ``since``."""
+    return _client(profile.id).zcount(
+        make_key(student, profile), timestamp_score(since), '+inf')
 
 
 def unread_counts(students, profile):
@@ -38,19 +195,13 @@ def unread_counts(students, profile):
     Return dict mapping student to unread count.
 
     """
-    student = list(students)
-    p = redis.client.pipeline()
-    for student in students:
-        p.scard(make_key(student, profile))
-    return dict(zip(students, p.execute()))
+    counts = _counts_by_student_id(profile)
+    return {student: counts.get(student.id, 0) for student in students}
 
 
 def group_unread_count(group, profile):
     """Return count of profile's unread posts in all villages in group."""
-    p = redis.client.pipeline()
-    for student in group.students.all():
-        p.scard(make_key(student, profile))
-    return sum(p.execute())
+    return group_unread_counts([group], profile)[group]
 
 
 def group_unread_counts(groups, profile):
@@ -60,39 +211,207 @@ def group_unread_counts(groups, profile):
     Return a dictionary mapping groups to counts.
 
     """
-    p = redis.client.pipeline()
-
-    # track list of student IDs for each group
-    student_ids_by_group = {}
-    # we need an ordered list of student IDs to match them up with the pipeline
-    # results, but we also need the set for fast membership tests
-    student_ids_seen = set()
-    ordered_student_ids = []
-
-    for group in groups:
-        student_ids = student_ids_by_group.setdefault(group, set())
-        for student in group.students.all():
-            student_ids.add(student.id)
-            if student.id not in student_ids_seen:
-                ordered_student_ids.append(student.id)
-                student_ids_seen.add(student.id)
-                p.scard(make_key(student, profile))
-    unread_counts_by_student_id = dict(zip(ordered_student_ids, p.execute()))
+    groups = list(groups)
+    student_ids_by_group = _student_ids_by_group(groups)
+    counts = _counts_by_student_id(profile)
     return {
-        group: sum(
-            unread_counts_by_student_id[sid]
-            for sid in student_ids_by_group[group]
-            )
+        group: sum(counts.get(sid, 0) for sid in student_ids_by_group[group])
         for group in groups
         }
 
 
 def mark_village_read(student, profile):
     """Mark all posts in given student's village as read by profile."""
-    redis.client.delete(make_key(student, profile))
+    # pipelines are MULTI/EXEC transactions, atomic w.r.t. the mark scripts
+    p = _client(profile.id).pipeline()
+    p.delete(make_key(student, profile))
+    p.hdel(make_counts_key(profile), student.id)
+    p.execute()
+
+
+
+def compact(max_unread=None, batch_size=500):
+    """
+    Compact stored unread state; return dict of counts of work done.
+
+    Scans all unread keys incrementally, deleting those whose relationship no
+    longer exists and, if ``max_unread`` is given, trimming each remaining set
+    to the newest ``max_unread`` posts. The counts hash is adjusted to match.
+
+    Returned dict has keys ``scanned`` (unread keys seen), ``deleted`` (keys
+    deleted) and ``trimmed`` (posts trimmed from remaining keys).
+
+    """
+    stats = {'scanned': 0, 'deleted': 0, 'trimmed': 0}
+    for client in redis.get_clients('unread'):
+        pairs = []
+        for key in client.scan_iter(match='unread:*', count=batch_size):
+            try:
+                prefix, elder_id, student_id = key.split(':')
+                pairs.append((int(elder_id), int(student_id)))
+            except ValueError:
+                continue
+            if len(pairs) >= batch_size:
+                _compact_batch(client, pairs, max_unread, stats)
+                pairs = []
+        if pairs:
+            _compact_batch(client, pairs, max_unread, stats)
+    return stats
+
+
+
+def _compact_batch(client, pairs, max_unread, stats):
+    """Compact unread keys for given (elder ID, student ID) pairs."""
+    from ..users.models import Relationship
+
+    existing = set(
+        Relationship.objects.filter(
+            from_profile__in=set(e for e, s in pairs),
+            to_profile__in=set(s for e, s in pairs),
+            ).values_list('from_profile_id', 'to_profile_id')
+        )
+    stale = [pair for pair in pairs if pair not in existing]
+    live = [pair for pair in pairs if pair in existing]
+    if max_unread is None:
+        live = []
+
+    trimmed = 0
+    keys = []
+    for elder_id, student_id in stale + live:
+        keys.extend([_make_key(elder_id, student_id), _make_counts_key(elder_id)])
+    args = [len(stale), max_unread or 0]
+    args.extend(student_id for elder_id, student_id in stale + live)
+    if keys:
+        trimmed = _compact_script(keys=keys, args=args, redis_client=client)
+
+    stats['scanned'] += len(pairs)
+    stats['deleted'] += len(stale)
+    stats['trimmed'] += int(trimmed)
+
+
+
+@redis.script("""
+local num_stale, max_unread = tonumber(ARGV[1]), tonumber(ARGV[2])
+local trimmed = 0
+for k = 1, #KEYS, 2 do
+    local i = (k + 1) / 2
+    local student_id = ARGV[i + 2]
+    if i <= num_stale then
+        redis.call('DEL', KEYS[k])
+        redis.call('HDEL', KEYS[k + 1], student_id)
+    else
+        -- ranks are oldest-first; keep only the newest max_unread
+        local removed = redis.call(
+            'ZREMRANGEBYRANK', KEYS[k], 0, -(max_unread + 1))
+        if removed > 0 then
+            redis.call('HINCRBY', KEYS[k + 1], student_id, -removed)
+            trimmed = trimmed + removed
+        end
+    end
+end
+return trimmed
+""")
+def _compact_script(client, keys, args):
+    """
+    Atomically delete stale unread sets and trim live ones.
+
+    ``keys`` are pairs of (unread set key, counts hash key), stale pairs
+    first. ``args`` are the number of stale pairs, the number of posts to
+    keep in each live set, then the student ID of each pair. Counts are
+    adjusted to match. Return number of posts trimmed from live sets.
+
+    """
+    num_stale, max_unread = int(args[0]), int(args[1])
+    trimmed = 0
+    for i, k in enumerate(range(0, len(keys), 2)):
+        student_id = args[i + 2]
+        if i < num_stale:
+            client.delete(keys[k])
+            client.hdel(keys[k + 1], student_id)
+        else:
+            removed = client.zremrangebyrank(keys[k], 0, -(max_unread + 1))
+            if removed:
+                client.hincrby(keys[k + 1], student_id, -removed)
+                trimmed += removed
+    return trimmed
+
+
+
+def _counts_by_student_id(profile):
+    """Return dict mapping student ID to profile's unread count (one query)."""
+    counts = _client(profile.id).hgetall(make_counts_key(profile))
+    return {int(sid): int(count) for sid, count in counts.items()}
+
+
+
+def _student_ids_by_group(groups):
+    """
+    Return dict mapping each group to a set of its student IDs.
+
+    Uses already-prefetched group students where available; otherwise fetches
+    membership for all real groups in a single query, rather than querying
+    once per group.
+
+    """
+    from ..users.models import Group
+
+    ids_by_group = {}
+    to_fetch = {}
+    for group in groups:
+        prefetched = getattr(group, '_prefetched_objects_cache', {})
+        if 'students' in prefetched:
+            ids_by_group[group] = {s.id for s in prefetched['students']}
+        elif group.is_all:
+            ids_by_group[group] = set(
+                group.students.values_list('id', flat=True))
+        else:
+            ids_by_group[group] = set()
+            to_fetch[group.id] = group
+
+    if to_fetch:
+        memberships = Group.students.through.objects.filter(
+            group__in=to_fetch.keys()).values_list('group_id', 'profile_id')
+        for group_id, student_id in memberships:
+            ids_by_group[to_fetch[group_id]].add(student_id)
+
+    return ids_by_group
+
+
+
+def _client(profile_id):
+    """Return Redis client holding given profile's unread state."""
+    return redis.get_client('unread', shard_key=profile_id)
+
+
+
+def timestamp_score(timestamp):
+    """Convert an aware datetime to a sorted-set score (Unix timestamp)."""
+    return (
+        calendar.timegm(timestamp.utctimetuple()) +
+        timestamp.microsecond / 1000000.0
+        )
+
+
+
+def score_timestamp(score):
+    """Convert a sorted-set score (Unix timestamp) back to an aware datetime."""
+    return datetime.datetime.fromtimestamp(float(score), timezone.utc)
 
 
 
 def make_key(student, profile):
     """Construct Redis key for given profile and student."""
-    return 'unread:%s:%s' % (profile.id, student.id)
+    return _make_key(profile.id, student.id)
+
+
+def make_counts_key(profile):
+    """Construct Redis key for given profile's per-student unread counts."""
+    return _make_counts_key(profile.id)
+
+
+def _make_key(profile_id, student_id):
+    return 'unread:%s:%s' % (profile_id, student_id)
+
+
+def _make_counts_key(profile_id):
+    return 'unread-counts:%s' % profile_id
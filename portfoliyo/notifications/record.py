@@ -1,36 +1,61 @@
 """Record notifications."""
 from django.conf import settings
 
-from portfoliyo import tasks
-from . import store, types
+from . import schedule, store, types
 
 
 
 def post_all(p):
-    """Send all appropriate notifications for creation of given post."""
+    """
+    Send all appropriate notifications for creation of given post.
+
+    Records notifications for the whole audience in one batch: one query for
+    the audience (with users), one Redis round-trip to store notifications,
+    and one to schedule any triggered notification emails.
+
+    """
     if not p.author:
         return
-    record_func = bulk_post if p.is_bulk else post
-    for profile in p.elders_in_context.exclude(pk=p.author.pk):
-        record_func(profile, p)
+    notification_func = (
+        _bulk_post_notification if p.is_bulk else _post_notification)
+    _record_many(
+        [
+            (profile,) + notification_func(profile, p)
+            for profile in p.elders_in_context.exclude(pk=p.author.pk)
+            ]
+        )
 
 
 
 def post(profile, post):
     """Notify ``profile`` that a parent or teacher posted ``post``."""
+    name, triggering, data = _post_notification(profile, post)
+    _record(profile, name, triggering=triggering, data=data)
+
+
+
+def _post_notification(profile, post):
+    """Return (name, triggering, data) for ``post`` notification."""
     pref = 'notify_%s' % (
         'teacher_post' if post.author.school_staff else 'parent_text')
-    triggering = getattr(profile, pref)
-    data = {'post-id': post.id}
-    _record(profile, types.POST, triggering=triggering, data=data)
+    return types.POST, getattr(profile, pref), {'post-id': post.id}
 
 
 
 def bulk_post(profile, bulk_post):
     """Notify ``profile`` that a teacher posted ``bulk_post``."""
-    triggering = profile.notify_teacher_post
-    data = {'bulk-post-id': bulk_post.id}
-    _record(profile, types.BULK_POST, triggering=triggering, data=data)
+    name, triggering, data = _bulk_post_notification(profile, bulk_post)
+    _record(profile, name, triggering=triggering, data=data)
+
+
+
+def _bulk_post_notification(profile, bulk_post):
+    """Return (name, triggering, data) for ``bulk_post`` notification."""
+    return (
+        types.BULK_POST,
+        profile.notify_teacher_post,
+        {'bulk-post-id': bulk_post.id},
+        )
 
 
 
@@ -79,9 +104,37 @@ def new_teacher(profile, teacher, student):
 
 def _record(profile, name, triggering=False, data=None):
     """Record a notification for the given profile."""
-    if profile.user.email is None or not profile.user.is_active:
+    if not _can_notify(profile):
         return
     store.store(profile.id, name, triggering=triggering, data=data)
-    # @@@ later this will be only if user prefers instant notifications
     if triggering and settings.NOTIFICATION_EMAILS:
-        tasks.send_notification_email.delay(profile.id)
+        schedule.schedule([profile.id])
+
+
+
+def _record_many(notifications):
+    """
+    Record notifications given as (profile, name, triggering, data) tuples.
+
+    Stores all notifications in one Redis round-trip, and schedules any
+    triggered notification emails in another.
+
+    """
+    notifications = [n for n in notifications if _can_notify(n[0])]
+    if not notifications:
+        return
+    store.store_batch(
+        [
+            (profile.id, name, triggering, data)
+            for profile, name, triggering, data in notifications
+            ]
+        )
+    triggered = [n[0].id for n in notifications if n[2]]
+    if triggered and settings.NOTIFICATION_EMAILS:
+        schedule.schedule(triggered)
+
+
+
+def _can_notify(profile):
+    """Return True if notifications can be recorded for ``profile``."""
+    return profile.user.email is not None and profile.user.is_active
@@ -1 +1 @@
-from .base import render, send, NothingToDo
+from .base import render, send, send_many, NothingToDo
@@ -1,21 +1,30 @@
 """Rendering and sending of notifications."""
+import logging
 import re
+import time
 
 from django.conf import settings
+from django.core import mail
 from django.template.loader import render_to_string
-import premailer
+from django.utils import translation
 
 from portfoliyo import email
 from portfoliyo import model
 from . import collect
+from . import inline
 
 
 HTML_TEMPLATE = 'notifications/activity.html'
 TEXT_TEMPLATE = 'notifications/activity.txt'
+# part of every rendered-fragment cache key; bump when the post or bulk-post
+# templates change, so no stale fragments are used.
+FRAGMENT_VERSION = 2
 
 
 consecutive_newlines = re.compile('\n\n+')
 
+logger = logging.getLogger(__name__)
+
 
 
 class NothingToDo(Exception):
@@ -27,26 +36,147 @@ def send(profile_id, clear=True):
     """
     Send activity notification(s) to user with given profile ID.
 
-    If ``clear`` is ``True`` (the default), clear all notifications for this
-    profile ID.
+    If ``clear`` is ``True`` (the default), clear the sent notifications for
+    this profile ID once the email has been sent.
 
     Return ``True`` if email was sent, ``False`` otherwise.
 
     """
     profile = model.Profile.objects.select_related('user').get(pk=profile_id)
+    msg, collection = _make_message(profile, clear=clear)
+    if msg is None:
+        return False
+
+    msg.send()
+    if clear:
+        collection.clear()
+
+    return True
+
+
+
+def send_many(profile_ids, clear=True):
+    """
+    Send activity notifications to users with given profile IDs.
+
+    Fetches all profiles in one query and sends all emails over a single mail
+    backend connection. A failure to render or send one email is logged and
+    doesn't prevent sending the rest; after a failed send the connection is
+    re-opened. If the connection can't be (re-)opened, all remaining emails
+    are counted as failed.
+
+    ``clear`` is as for ``send``; notifications whose email failed are left
+    pending. Return dict with counts of emails ``sent``, ``skipped`` (nothing
+    to send) and ``failed``, the elapsed ``seconds``, and the list of
+    ``failed_profile_ids``.
+
+    """
+    start = time.time()
+    stats = {'sent': 0, 'skipped': 0, 'failed': 0}
+    profile_ids = list(profile_ids)
+    failed_profile_ids = stats['failed_profile_ids'] = []
+    profiles = model.Profile.objects.select_related('user').in_bulk(
+        profile_ids)
+    connection = mail.get_connection()
+    if not _open(connection):
+        stats['failed'] += len(profile_ids)
+        failed_profile_ids.extend(profile_ids)
+        stats['seconds'] = time.time() - start
+        return stats
+    try:
+        for i, profile_id in enumerate(profile_ids):
+            profile = profiles.get(int(profile_id))
+            if profile is None:
+                stats['skipped'] += 1
+                continue
+            try:
+                msg, collection = _make_message(profile, clear=clear)
+            except Exception:
+                logger.exception(
+                    "Failed to render notification email to profile %s",
+                    profile_id,
+                    )
+                stats['failed'] += 1
+                failed_profile_ids.append(profile_id)
+                continue
+            if msg is None:
+                stats['skipped'] += 1
+                continue
+            try:
+                connection.send_messages([msg])
+            except Exception:
+                logger.exception(
+                    "Failed to send notification email to profile %s",
+                    profile_id,
+                    )
+                stats['failed'] += 1
+                failed_profile_ids.append(profile_id)
+                if not _reopen(connection):
+                    stats['failed'] += len(profile_ids) - i - 1
+                    failed_profile_ids.extend(profile_ids[i + 1:])
+                    break
+                continue
+            if clear:
+                collection.clear()
+            stats['sent'] += 1
+    finally:
+        connection.close()
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+
+def _open(connection):
+    """Open mail ``connection``; return ``False`` (logged) if it failed."""
+    try:
+        connection.open()
+    except Exception:
+        logger.exception("Failed to open mail connection")
+        return False
+    return True
+
+
+
+def _reopen(connection):
+    """
+    Re-open mail backend ``connection`` (after a failed send).
+
+    Return ``False`` (logged) if it couldn't be re-opened.
+
+    """
+    try:
+        connection.close()
+    except Exception:
+        # it's likely already broken; we're replacing it anyway
+        pass
+    return _open(connection)
+
+
+
+def _make_message(profile, clear=True):
+    """
+    Return (notification email message, collection) for ``profile``.
+
+    The message is ``None`` if user can't receive notification emails, or
+    there is nothing to send; in the latter case, if ``clear`` is ``True``,
+    the (unsendable) notifications are cleared. Otherwise nothing is cleared;
+    clear the returned ``NotificationCollection`` once the message is sent.
+
+    """
     user = profile.user
     # bail out if user can't receive notification emails anyway
     if not (user.email and user.is_active):
-        return False
+        return None, None
 
+    collection = collect.NotificationCollection(profile)
     try:
-        subject, text, html = render(profile, clear=clear)
+        subject, text, html = _render(collection)
     except NothingToDo:
-        return False
+        if clear:
+            collection.clear()
+        return None, None
 
-    email.send_multipart(subject, text, html, [profile.user.email])
-
-    return True
+    return email.make_multipart(subject, text, html, [user.email]), collection
 
 
 
@@ -59,23 +189,35 @@ def render(profile, clear=True):
     Raise ``NothingToDo`` if there are no notifications to render.
 
     """
-    collection = collect.NotificationCollection(profile, clear=clear)
+    collection = collect.NotificationCollection(profile)
+    try:
+        return _render(collection)
+    finally:
+        if clear:
+            collection.clear()
+
+
 
+def _render(collection):
+    """Render a ``NotificationCollection``; return (subject, text, html)."""
     # bail out if there's nothing to do
     if not collection:
         raise NothingToDo()
 
     context = collection.context
     context['BASE_URL'] = settings.PORTFOLIYO_BASE_URL
+    context['LANGUAGE_CODE'] = translation.get_language()
+    context['fragment_version'] = FRAGMENT_VERSION
+    context['fragment_cache_seconds'] = (
+        settings.NOTIFICATION_FRAGMENT_CACHE_SECONDS)
 
     subject = render_to_string(collection.get_subject_template(), context)
 
     text = consecutive_newlines.sub(
         '\n\n', render_to_string(TEXT_TEMPLATE, context))
-    html = premailer.Premailer(
+    html = inline.inline(
         render_to_string(HTML_TEMPLATE, context),
         base_url=settings.PORTFOLIYO_BASE_URL,
-        output_xhtml=True,
-        ).transform()
+        )
 
     return subject, text, html
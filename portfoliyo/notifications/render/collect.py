@@ -22,20 +22,24 @@ class SwitchType(Exception):
     ``NotificationCollection`` to instead add this notification to a different
     type collection.
 
+    ``prefetched`` optionally provides database objects already loaded for the
+    new data, as for ``NotificationTypeCollector.add_prefetched``.
+
     """
-    def __init__(self, new_type, new_data):
+    def __init__(self, new_type, new_data, prefetched=None):
         self.new_type = new_type
         self.new_data = new_data
+        self.prefetched = prefetched or {}
         super(SwitchType, self).__init__("Switch to %s" % new_type)
 
 
 
 class NotificationCollection(object):
     """Collects and aggregates all pending notifications for a given profile."""
-    def __init__(self, profile, clear=True):
+    def __init__(self, profile):
         self.profile = profile
-        self.clear = clear
 
+        self._notification_ids = None
         self._notification_data = None
         self._hydrated = False
         self._collectors = None
@@ -46,11 +50,18 @@ class NotificationCollection(object):
     def notification_data(self):
         """Raw notification data from storage."""
         if self._notification_data is None:
+            self._notification_ids = store.pending_ids(self.profile.id)
             self._notification_data = list(
-                store.get_all(self.profile.id, clear=self.clear))
+                store.get_data(self.profile.id, self._notification_ids))
         return self._notification_data
 
 
+    def clear(self):
+        """Clear collected notifications from storage (e.g. once sent)."""
+        if self._notification_ids is not None:
+            store.clear(self.profile.id, self._notification_ids)
+
+
     @property
     def collectors(self):
         """Maps notification type names to ``NotificationTypeCollector``s."""
@@ -80,21 +91,47 @@ class NotificationCollection(object):
 
     def _hydrate(self):
         collectors = {}
-        for data in self.notification_data:
-            name = data.pop('name', None)
-            try:
-                collector_class = COLLECTOR_CLASSES[name]
-            except KeyError:
-                logger.warning("Unknown notification type '%s'", name)
-                continue
-            collector = collectors.setdefault(
-                name, collector_class(self.profile))
-            try:
-                collector.add(data)
-            except SwitchType as switch:
-                data = switch.new_data
-                data['name'] = switch.new_type
-                self.notification_data.append(data)
+        pending = list(self.notification_data)
+        while pending:
+            # group raw data by collector, so each collector can load all the
+            # database objects it needs in a few queries
+            data_by_collector = {}
+            for data in pending:
+                name = data.pop('name', None)
+                try:
+                    collector_class = COLLECTOR_CLASSES[name]
+                except KeyError:
+                    logger.warning("Unknown notification type '%s'", name)
+                    continue
+                collector = collectors.setdefault(
+                    name, collector_class(self.profile))
+                data_by_collector.setdefault(collector, []).append(data)
+
+            # notifications switched to another type get another round
+            pending = []
+            for collector, data_list in data_by_collector.items():
+                collector.prefetch(data_list)
+                for data in data_list:
+                    try:
+                        added = collector.add(data)
+                    except SwitchType as switch:
+                        if switch.prefetched:
+                            collectors.setdefault(
+                                switch.new_type,
+                                COLLECTOR_CLASSES[switch.new_type](
+                                    self.profile),
+                                ).add_prefetched(switch.prefetched)
+                        data = switch.new_data
+                        data['name'] = switch.new_type
+                        self.notification_data.append(data)
+                        pending.append(data)
+                        continue
+                    if not added:
+                        logger.info(
+                            "Rehydration of '%s' notification failed: %r",
+                            collector.type_name,
+                            data,
+                            )
 
         # - clear out any empty collectors (e.g. from invalid data)
         # - populate template-rendering context and set of affected students
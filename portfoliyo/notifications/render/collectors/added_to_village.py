@@ -23,6 +23,10 @@ class AddedToVillageCollector(base.NotificationTypeCollector):
     notification_pref = 'notify_added_to_village'
 
 
+    def get_queryset(self, model_class, dest_key):
+        return model_class.objects.select_related('user')
+
+
     def get_context(self):
         return {
             'added_to_villages': base.VillageList(
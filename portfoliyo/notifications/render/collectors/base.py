@@ -66,6 +66,10 @@ class NotificationTypeCollector(object):
     def __init__(self, profile):
         self.profile = profile
         self.notifications = []
+        # maps db_lookup source key to dict of prefetched objects by ID
+        self._prefetched = {}
+        # maps db_lookup source key to set of all IDs prefetch looked up
+        self._looked_up = {}
 
 
     def __nonzero__(self):
@@ -87,12 +91,56 @@ class NotificationTypeCollector(object):
         return True
 
 
+    def prefetch(self, notifications):
+        """
+        Load database objects needed by all given raw notification data.
+
+        Queries once per ``db_lookup`` key, rather than once per notification;
+        subsequent ``hydrate`` calls find their objects in the prefetched data
+        (or know they don't exist, without querying again).
+
+        """
+        for src_key, (model_class, dest_key) in self.db_lookup.items():
+            ids = set()
+            for data in notifications:
+                try:
+                    ids.add(int(data[src_key]))
+                except (KeyError, ValueError, TypeError):
+                    pass
+            prefetched = self._prefetched.setdefault(src_key, {})
+            looked_up = self._looked_up.setdefault(src_key, set())
+            ids.difference_update(prefetched)
+            ids.difference_update(looked_up)
+            if ids:
+                prefetched.update(
+                    self.get_queryset(model_class, dest_key).in_bulk(ids))
+                looked_up.update(ids)
+
+
+    def add_prefetched(self, prefetched):
+        """
+        Add already-loaded database objects for use by ``hydrate``.
+
+        ``prefetched`` maps ``db_lookup`` source keys to dicts of objects by
+        ID; ``prefetch`` won't query for these objects again.
+
+        """
+        for src_key, objects in prefetched.items():
+            self._prefetched.setdefault(src_key, {}).update(objects)
+
+
+    def get_queryset(self, model_class, dest_key):
+        """Return queryset for loading ``dest_key`` objects of model class."""
+        return model_class.objects.all()
+
+
     def hydrate(self, data):
         """
         Rehydrate given notification data.
 
         Rehydrating means to take any database object IDs in the given
-        notification data, and query for the actual database objects needed.
+        notification data, and query for the actual database objects needed
+        (unless already looked up by ``prefetch``).
 
         If any needed objects aren't found (as defined in the ``db_lookup``
         class attribute, which maps a key in the source ``data`` to a tuple of
@@ -103,9 +151,15 @@ class NotificationTypeCollector(object):
         hydrated = {}
         for src_key, (model_class, dest_key) in self.db_lookup.items():
             try:
-                hydrated[dest_key] = model_class.objects.get(pk=data[src_key])
-            except (KeyError, model_class.DoesNotExist):
+                pk = int(data[src_key])
+                obj = self._prefetched.get(src_key, {}).get(pk)
+                if obj is None:
+                    if pk in self._looked_up.get(src_key, ()):
+                        raise RehydrationFailed()
+                    obj = self.get_queryset(model_class, dest_key).get(pk=pk)
+            except (KeyError, ValueError, TypeError, model_class.DoesNotExist):
                 raise RehydrationFailed()
+            hydrated[dest_key] = obj
 
         return hydrated
 
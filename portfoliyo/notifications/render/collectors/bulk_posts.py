@@ -1,16 +1,28 @@
 """Bulk-post notification collector."""
+import hashlib
+import json
+
+from django.db.models.query import prefetch_related_objects
+
 from portfoliyo import model
 from portfoliyo.notifications import types
 from . import base
-from .posts import serialize_post
+from .posts import SerializedPost
 
 
 
 class VillageSet(object):
-    """A set of villages that all received the same bulk posts."""
-    def __init__(self, students):
+    """
+    A set of villages that all received the same bulk posts.
+
+    ``recipient`` is the profile the village set is rendered for (if any); it
+    determines which posts are rendered as the recipient's own.
+
+    """
+    def __init__(self, students, recipient=None):
         self.students = sorted(students, key=lambda s: s.name)
-        # serialized bulk-posts, in unspecified order
+        self.recipient = recipient
+        # ``SerializedPost``s of bulk posts, in unspecified order
         self._posts = []
         # teachers who authored the bulk posts
         self.teachers = []
@@ -18,7 +30,7 @@ class VillageSet(object):
 
     def add(self, bulk_post):
         """Add ``bulk_post``."""
-        self._posts.append(serialize_post(bulk_post, new=True))
+        self._posts.append(SerializedPost(bulk_post, new=True))
         if bulk_post.author not in self.teachers:
             self.teachers.append(bulk_post.author)
 
@@ -32,10 +44,38 @@ class VillageSet(object):
             )
 
 
+    @property
+    def fragment_key(self):
+        """
+        String identifying the rendered village set, for fragment caching.
+
+        Covers everything that can differ in the rendering of the same bulk
+        posts: which villages (and their names), which posts, and for each
+        post whether it is new or the recipient's own, and its rendered
+        content (see ``posts.fragment_key``).
+
+        """
+        recipient_id = self.recipient.id if self.recipient else None
+        names = json.dumps([s.name for s in self.students])
+        return '%s-%s|%s' % (
+            ','.join(str(s.id) for s in self.students),
+            hashlib.md5(names).hexdigest(),
+            ','.join(
+                '%s-%d-%d' % (
+                    p['fragment_key'],
+                    p.get('new', False),
+                    p['author_id'] == recipient_id,
+                    )
+                for p in self.posts
+                ),
+            )
+
+
 
 class BulkPostCollection(object):
     """Organizes all bulk posts by teacher and village-set."""
-    def __init__(self):
+    def __init__(self, recipient=None):
+        self.recipient = recipient
         # VillageSets by set of students
         self.village_sets = {}
 
@@ -48,7 +88,7 @@ class BulkPostCollection(object):
     def add(self, bulk_post, students):
         student_set = frozenset(students)
         village_set = self.village_sets.setdefault(
-            student_set, VillageSet(students))
+            student_set, VillageSet(students, self.recipient))
 
         self.students.update(student_set)
         self.num_posts += 1
@@ -85,8 +125,14 @@ class BulkPostCollector(base.NotificationTypeCollector):
     notification_pref = 'notify_teacher_post'
 
 
+    def __init__(self, *args, **kw):
+        super(BulkPostCollector, self).__init__(*args, **kw)
+        # maps bulk-post ID to list of its triggered posts visible to me
+        self._visible = {}
+
+
     def get_context(self):
-        collection = BulkPostCollection()
+        collection = BulkPostCollection(self.profile)
         for n in self.notifications:
             collection.add(n['bulk-post'], n['students'])
         return {
@@ -96,22 +142,65 @@ class BulkPostCollector(base.NotificationTypeCollector):
             }
 
 
+    def get_queryset(self, model_class, dest_key):
+        """Load bulk-post authors along with bulk posts."""
+        return model_class.objects.select_related('author__user')
+
+
+    def prefetch(self, notifications):
+        """
+        Also load visible triggered posts for all bulk posts at once.
+
+        Bulk posts visible in only one of my villages will be switched to
+        post notifications by ``hydrate``; everything needed to serialize
+        those posts is loaded here too, so the switch needs no more queries.
+
+        """
+        super(BulkPostCollector, self).prefetch(notifications)
+        bulk_posts = self._prefetched.get('bulk-post-id', {})
+        ids = [bp_id for bp_id in bulk_posts if bp_id not in self._visible]
+        if not ids:
+            return
+        for bp_id in ids:
+            self._visible[bp_id] = []
+        for post in self._get_visible(from_bulk__in=ids):
+            self._visible[post.from_bulk_id].append(post)
+
+        singles = []
+        for bp_id in ids:
+            if len(self._visible[bp_id]) == 1:
+                post = self._visible[bp_id][0]
+                if post.author_id == bulk_posts[bp_id].author_id:
+                    # author (with user) is already loaded on the bulk post
+                    post.author = bulk_posts[bp_id].author
+                singles.append(post)
+        if singles:
+            prefetch_related_objects(singles, ['attachments'])
+
+
+    def _get_visible(self, **filters):
+        """Return triggered individual posts that are in villages I am in."""
+        return model.Post.objects.filter(
+            student__relationships_to__from_profile=self.profile,
+            **filters
+            ).distinct().select_related('student', 'relationship')
+
+
     def hydrate(self, data):
         """Determine how many villages I see this post in."""
         hydrated = super(BulkPostCollector, self).hydrate(data)
         bulk_post = hydrated['bulk-post']
-        # triggered individual posts that are in villages I am in
-        visible = list(
-            bulk_post.triggered.filter(
-                student__relationships_to__from_profile=self.profile).distinct(
-                ).select_related('student')
-            )
+        visible = self._visible.get(bulk_post.id)
+        if visible is None:
+            visible = list(self._get_visible(from_bulk=bulk_post))
         # if only one triggered post is visible, treat it as a non-bulk post
         if len(visible) == 1:
             from .. import collect
+            post = visible[0]
             raise collect.SwitchType(
                 types.POST,
-                {'post-id': visible[0].id, 'triggering': data['triggering']}
+                {'post-id': post.id, 'triggering': data['triggering']},
+                prefetched={'post-id': {post.id: post}},
                 )
         elif not visible:
             raise base.RehydrationFailed()
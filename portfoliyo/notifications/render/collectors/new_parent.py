@@ -17,16 +17,34 @@ class Signup(object):
     @classmethod
     def from_textsignup(cls, text_signup):
         """Instantiate from a ``TextSignup`` model instance."""
-        try:
-            rel = model.Relationship.objects.get(
-                from_profile=text_signup.family,
-                to_profile=text_signup.student)
-        except model.Relationship.DoesNotExist:
-            role = text_signup.family.role
-        else:
-            role = rel.description_or_role
-        return cls(
-            text_signup.student, text_signup.family, role, text_signup.group)
+        return cls.from_textsignups([text_signup])[0]
+
+
+    @classmethod
+    def from_textsignups(cls, text_signups):
+        """
+        Instantiate list from list of ``TextSignup`` model instances.
+
+        Looks up family-student relationships for all signups in one query.
+
+        """
+        rels = {}
+        if text_signups:
+            qs = model.Relationship.objects.filter(
+                from_profile__in=set(ts.family_id for ts in text_signups),
+                to_profile__in=set(ts.student_id for ts in text_signups),
+                ).select_related('from_profile')
+            for rel in qs:
+                rels[(rel.from_profile_id, rel.to_profile_id)] = rel
+        signups = []
+        for ts in text_signups:
+            rel = rels.get((ts.family_id, ts.student_id))
+            if rel is None:
+                role = ts.family.role
+            else:
+                role = rel.description_or_role
+            signups.append(cls(ts.student, ts.family, role, ts.group))
+        return signups
 
 
 
@@ -45,12 +63,14 @@ class NewParentCollector(base.NotificationTypeCollector):
     notification_pref = 'notify_new_parent'
 
 
+    def get_queryset(self, model_class, dest_key):
+        return model_class.objects.select_related('student', 'family', 'group')
+
+
     def get_context(self):
         return {
-            'signups': [
-                Signup.from_textsignup(n['signup'])
-                for n in self.notifications
-                ],
+            'signups': Signup.from_textsignups(
+                [n['signup'] for n in self.notifications]),
             'any_requested_new_parent': self.any_requested(),
             'any_nonrequested_new_parent': self.any_nonrequested(),
             }
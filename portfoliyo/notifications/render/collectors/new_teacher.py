@@ -23,6 +23,10 @@ class NewTeacherCollector(base.NotificationTypeCollector):
     notification_pref = 'notify_joined_my_village'
 
 
+    def get_queryset(self, model_class, dest_key):
+        return model_class.objects.select_related('user')
+
+
     def get_context(self):
         return {
             'new_teacher_villages': base.VillageList(
@@ -1,6 +1,9 @@
 """Post notification collector."""
 from datetime import timedelta
+import hashlib
+import json
 
+from django.db import connection
 from django.utils import timezone
 
 from portfoliyo import model, serializers
@@ -9,6 +12,13 @@ from . import base
 
 
 
+# number of latest posts in a village considered for context
+CONTEXT_POSTS = 5
+# context posts must be newer than this (unless all are older; then keep one)
+CONTEXT_MAX_AGE = timedelta(hours=48)
+
+
+
 def serialize_post(post, **extra):
     """Transform ``Post`` instance into its serialized representation."""
     extra['plain_text'] = post.original_text
@@ -17,23 +27,84 @@ def serialize_post(post, **extra):
 
 
 
+def fragment_key(post):
+    """
+    Return string identifying the rendering of ``post``, for fragment caching.
+
+    Needs no serialization (nor queries, if the post's author and relationship
+    are loaded). Posts are never edited, so besides the post ID this covers
+    only what else can change its rendering: its author's name and role, and
+    the local date its displayed timestamp is relative to.
+
+    """
+    today = timezone.localtime(serializers.now()).date()
+    varies = list(serializers.post_author(post)) + [
+        timezone.get_current_timezone_name(), today.isoformat()]
+    return '%s-%s' % (post.id, hashlib.md5(json.dumps(varies)).hexdigest())
+
+
+
+class SerializedPost(object):
+    """
+    A post's serialized representation, serialized only when first needed.
+
+    Supports item lookup like the dictionary ``serialize_post`` returns. The
+    ``post_id``, ``author_id``, ``original_timestamp`` and ``fragment_key``
+    keys (and any ``extra`` keys) are available without serializing the post;
+    looking up any other key serializes it, e.g. when a template renders the
+    post on a fragment-cache miss.
+
+    """
+    def __init__(self, post, **extra):
+        self.post = post
+        self._extra = extra
+        self._data = None
+        self._cheap = dict(
+            extra,
+            post_id=post.id,
+            author_id=post.author_id or 0,
+            original_timestamp=post.timestamp,
+            fragment_key=fragment_key(post),
+            )
+
+
+    def __getitem__(self, key):
+        if key in self._cheap:
+            return self._cheap[key]
+        if self._data is None:
+            self._data = serialize_post(self.post, **self._extra)
+        return self._data[key]
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+
 class Village(object):
     """
     Encapsulates a village with posts (some new, some context).
 
-    ``new_posts`` and ``context_posts`` attributes are lists of serialized post
-    dictionaries with unspecified ordering.
+    ``new_posts`` and ``context_posts`` attributes are lists of
+    ``SerializedPost`` with unspecified ordering.
 
     ``posts`` attribute is an iterable combining both ``context_posts`` and
     ``new_posts`` in chronological ordering.
 
+    ``batch`` is a list of villages (including this one) whose context posts
+    should all be loaded together when any of them are first needed.
+
     """
-    def __init__(self, student):
+    def __init__(self, student, batch=None):
         self.student = student
         self.new_posts = []
         self._context_posts = None
         self.new_authors = []
         self.requested = False
+        self.batch = batch
 
 
     def posts(self):
@@ -49,8 +120,7 @@ class Village(object):
         assert notification['student'] == self.student
         if notification['triggering']:
             self.requested = True
-        self.new_posts.append(
-            serialize_post(notification['post'], new=True))
+        self.new_posts.append(SerializedPost(notification['post'], new=True))
         author = notification['post'].author
         if author not in self.new_authors:
             self.new_authors.append(author)
@@ -61,22 +131,120 @@ class Village(object):
     def context_posts(self):
         """List of context posts."""
         if self._context_posts is None:
-            cutoff = timezone.now() - timedelta(hours=48)
-            # get latest five posts in village, excluding the new ones
-            latest = list(
-                self.student.posts_in_village.exclude(
-                    pk__in=[p['post_id'] for p in self.new_posts]).order_by(
-                    '-timestamp')[:5]
-                )
-            # only keep those within last 48 hours
-            ctx = [p for p in latest if p.timestamp > cutoff]
-            # if there are posts but they are all old, keep one
-            if latest and not ctx:
-                ctx = list(latest)[-1:]
-            self._context_posts = [serialize_post(p, new=False) for p in ctx]
+            load_context_posts(self.batch or [self])
         return self._context_posts
 
 
+    def set_latest_posts(self, latest):
+        """
+        Set context posts from latest (non-new) posts in village, newest first.
+
+        Only posts within ``CONTEXT_MAX_AGE`` are kept, unless all are older;
+        then only the last of them is kept.
+
+        """
+        cutoff = timezone.now() - CONTEXT_MAX_AGE
+        ctx = [p for p in latest if p.timestamp > cutoff]
+        # if there are posts but they are all old, keep one
+        if latest and not ctx:
+            ctx = latest[-1:]
+        self._context_posts = [SerializedPost(p, new=False) for p in ctx]
+
+
+
+def load_context_posts(villages):
+    """
+    Load context posts for all given villages at once.
+
+    Takes two queries regardless of the number of villages: one for the latest
+    posts in every village (with authors and relationships), and one for their
+    attachments.
+
+    """
+    villages = [v for v in villages if v._context_posts is None]
+    if not villages:
+        return
+    latest = latest_posts(
+        [v.student for v in villages],
+        exclude_ids=[p['post_id'] for v in villages for p in v.new_posts],
+        )
+    for village in villages:
+        village.set_latest_posts(latest.get(village.student.id, []))
+
+
+
+def latest_posts(students, exclude_ids=(), count=CONTEXT_POSTS):
+    """
+    Return dict mapping student ID to latest posts in village, newest first.
+
+    At most ``count`` posts are returned for each student's village, excluding
+    posts with IDs in ``exclude_ids``.
+
+    If the database supports window functions, all villages' posts are fetched
+    in a single query, ranking posts within each village. Otherwise it takes
+    one query per village.
+
+    """
+    candidates = model.Post.objects.filter(
+        student__in=[s.id for s in students]).exclude(id__in=exclude_ids)
+    related = lambda qs: qs.select_related(
+        'author__user', 'relationship').prefetch_related('attachments')
+
+    if _has_window_functions():
+        qn = connection.ops.quote_name
+        ranked_sql, params = candidates.extra(
+            select={
+                'post_rank': (
+                    "ROW_NUMBER() OVER (PARTITION BY {student_id} "
+                    "ORDER BY {timestamp} DESC, {id} DESC)".format(
+                        student_id=qn('student_id'),
+                        timestamp=qn('timestamp'),
+                        id=qn('id'),
+                        )
+                    ),
+                },
+            ).values('id', 'post_rank').query.sql_with_params()
+        posts = related(
+            model.Post.objects.extra(
+                where=[
+                    "{table}.{id} IN (SELECT {id} FROM ({ranked}) AS {alias} "
+                    "WHERE {rank} <= %s)".format(
+                        table=qn(model.Post._meta.db_table),
+                        id=qn('id'),
+                        ranked=ranked_sql,
+                        alias=qn('ranked_posts'),
+                        rank=qn('post_rank'),
+                        )
+                    ],
+                params=list(params) + [count],
+                ).order_by('-timestamp', '-id')
+            )
+    else:
+        posts = [
+            post
+            for student in students
+            for post in related(
+                candidates.filter(student=student).order_by(
+                    '-timestamp', '-id'))[:count]
+            ]
+
+    by_student = {}
+    for post in posts:
+        by_student.setdefault(post.student_id, []).append(post)
+    return by_student
+
+
+
+def _has_window_functions():
+    """Return ``True`` if the database supports ``ROW_NUMBER() OVER``."""
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 25)
+    return False
+
+
 
 class PostCollector(base.NotificationTypeCollector):
     """
@@ -112,10 +280,13 @@ class PostCollector(base.NotificationTypeCollector):
             return
 
         villages = {}
+        batch = []
         for notification in self.notifications:
             student = notification['student']
-            village = villages.setdefault(student, Village(student))
-            village.add(notification)
+            if student not in villages:
+                villages[student] = Village(student, batch=batch)
+                batch.append(villages[student])
+            villages[student].add(notification)
 
         villages = villages.values()
         requested = []
@@ -156,6 +327,13 @@ class PostCollector(base.NotificationTypeCollector):
         return bool(self._nonrequested_villages)
 
 
+    def get_queryset(self, model_class, dest_key):
+        """Load everything needed to serialize posts."""
+        return model_class.objects.select_related(
+            'author__user', 'student', 'relationship').prefetch_related(
+            'attachments')
+
+
     def hydrate(self, data):
         """Add 'triggering' and 'student' keys to hydrated data."""
         hydrated = super(PostCollector, self).hydrate(data)
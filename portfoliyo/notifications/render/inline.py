@@ -0,0 +1,117 @@
+"""
+CSS inlining for notification emails.
+
+Running ``premailer`` over a whole email gets slower the more posts the email
+contains, yet most of its markup is post bodies that are identical from one
+email to the next. So templates mark such fragments with
+``<!--inline-fragment-->`` ... ``<!--/inline-fragment-->``; ``inline`` inlines
+each distinct fragment only once per process (see ``inline_fragments``), runs
+``premailer`` for every email only over the rest of it, and splices the
+inlined fragments back in.
+
+The output is identical to that of
+``premailer.Premailer(unmarked(html), base_url=base_url,
+output_xhtml=True).transform()``, as long as:
+
+- a fragment is (part of) the content of a ``<table>`` that also contains
+  some text outside the fragment, e.g. a newline (as in ``_post.html``);
+
+- no stylesheet rule relates elements inside a fragment to elements outside
+  it (e.g. ``.mine p`` or ``h2 + p``).
+
+The styles can't be inlined into the template source ahead of time: some
+class attributes (e.g. in ``notifications/activity/includes/_post.html``) and
+sibling selectors (``h2 + .post``) only resolve once the template is rendered.
+
+"""
+import re
+
+import premailer
+
+
+
+# maximum number of inlined fragments cached
+MAX_CACHED_FRAGMENTS = 1000
+
+FRAGMENT_START = '<!--inline-fragment-->'
+FRAGMENT_END = '<!--/inline-fragment-->'
+
+_fragment = re.compile(
+    '%s(.*?)%s' % (re.escape(FRAGMENT_START), re.escape(FRAGMENT_END)),
+    re.DOTALL,
+    )
+_placeholder = re.compile(r'<!--inline-fragment:(\d+)-->')
+_start = re.compile(r'\s*(<!DOCTYPE[^>]*>\s*)?<html\b[^>]*>', re.IGNORECASE)
+_style = re.compile(r'<style\b.*?</style>', re.DOTALL | re.IGNORECASE)
+_markers = re.compile(
+    '%s|%s' % (re.escape(FRAGMENT_START), re.escape(FRAGMENT_END)))
+
+# maps (prologue, base URL, fragment) to inlined fragment
+_inlined = {}
+
+
+
+def inline(html, base_url=None):
+    """Return ``html`` with its ``<style>`` rules inlined as style attributes."""
+    fragments = []
+    def _extract(match):
+        fragments.append(match.group(1))
+        return '<!--inline-fragment:%s-->' % (len(fragments) - 1)
+    inlined = _transform(_fragment.sub(_extract, html), base_url)
+    if not fragments:
+        return inlined
+
+    start = _start.match(html)
+    prologue = '%s<head>%s</head>' % (
+        start.group(0) if start else '<html>', ''.join(_style.findall(html)))
+    fragments = inline_fragments(fragments, prologue, base_url)
+    return _placeholder.sub(
+        lambda match: fragments[int(match.group(1))], inlined)
+
+
+
+def inline_fragments(fragments, prologue, base_url=None):
+    """
+    Return list of ``fragments`` of table content, inlined as in a document.
+
+    ``prologue`` is the start of that document: its doctype and ``<html>``
+    tag (which determine how it's serialized), then a ``<head>`` with its
+    ``<style>`` element(s).
+
+    Fragments not cached yet are inlined together, in one ``premailer`` run.
+    Each is inlined in a table of its own that also contains text, so
+    ``premailer`` doesn't reformat it, just as in the document.
+
+    """
+    found = dict(
+        (fragment, _inlined.get((prologue, base_url, fragment)))
+        for fragment in fragments
+        )
+    missing = [fragment for fragment, html in found.items() if html is None]
+    if missing:
+        document = '%s<body>%s</body></html>' % (
+            prologue,
+            ''.join(
+                '<table>\n%s%s%s\n</table>\n' % (
+                    FRAGMENT_START, fragment, FRAGMENT_END)
+                for fragment in missing
+                ),
+            )
+        inlined = _fragment.findall(_transform(document, base_url))
+        for fragment, html in zip(missing, inlined):
+            if len(_inlined) >= MAX_CACHED_FRAGMENTS:
+                _inlined.clear()
+            found[fragment] = _inlined[(prologue, base_url, fragment)] = html
+    return [found[fragment] for fragment in fragments]
+
+
+
+def unmarked(html):
+    """Return ``html`` without inline-fragment markers."""
+    return _markers.sub('', html)
+
+
+
+def _transform(html, base_url):
+    return premailer.Premailer(
+        html, base_url=base_url, output_xhtml=True).transform()
@@ -0,0 +1,223 @@
+"""
+Debounced scheduling of notification emails.
+
+Rather than sending a notification email as soon as each triggering
+notification is recorded, profiles are scheduled in a Redis sorted set scored
+by the time after which their email should be sent. The first trigger
+schedules the send ``NOTIFICATION_DEBOUNCE_SECONDS`` in the future; later
+triggers before then are merged into that already-scheduled send.
+
+The ``send_scheduled_notifications`` task periodically claims all due
+profiles; since claiming is atomic, concurrent callers never claim the same
+profile. A claimed profile is only leased, for
+``NOTIFICATION_SEND_LEASE_SECONDS``: once its email is sent it is ``release``d,
+but if the sending worker dies first, the lease expires and the profile is due
+again, so no batch of emails is lost.
+
+``dispatch_pending`` schedules every profile with pending triggering
+notifications (the ``check_for_pending_notifications`` task), a chunk at a
+time, staggering the chunks so their emails are spread out over time.
+
+"""
+import time
+
+from django.conf import settings
+
+from portfoliyo import redis
+from portfoliyo.notifications import store
+
+
+SCHEDULED_PROFILES_KEY = 'notify:scheduled:profile-ids'
+SENDING_PROFILES_KEY = 'notify:sending:profile-ids'
+DISPATCH_CURSOR_KEY = 'notify:dispatch:cursor'
+
+
+
+def schedule(profile_ids, delay=None):
+    """
+    Schedule notification emails for given profile IDs.
+
+    Emails are sent ``delay`` seconds from now (default
+    ``NOTIFICATION_DEBOUNCE_SECONDS``), unless a profile's email is already
+    scheduled, in which case that earlier schedule stands. Takes a single
+    atomic Redis round-trip.
+
+    Return list of profile IDs newly scheduled.
+
+    """
+    profile_ids = list(profile_ids)
+    if not profile_ids:
+        return []
+    if delay is None:
+        delay = settings.NOTIFICATION_DEBOUNCE_SECONDS
+    send_after = time.time() + delay
+    scheduled = _schedule_script(
+        keys=[SCHEDULED_PROFILES_KEY],
+        args=[repr(send_after)] + profile_ids,
+        redis_client=_client(),
+        )
+    return [int(profile_id) for profile_id in scheduled]
+
+
+
+@redis.script("""
+local scheduled = {}
+for a = 2, #ARGV do
+    if not redis.call('ZSCORE', KEYS[1], ARGV[a]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[a])
+        scheduled[#scheduled + 1] = ARGV[a]
+    end
+end
+return scheduled
+""")
+def _schedule_script(client, keys, args):
+    """
+    Add profile IDs ``args[1:]`` to ``keys[0]`` scored ``args[0]``.
+
+    Profile IDs already present keep their score. Return list of the added
+    profile IDs.
+
+    """
+    scheduled = []
+    for profile_id in args[1:]:
+        if client.zscore(keys[0], profile_id) is None:
+            client.zadd(keys[0], args[0], profile_id)
+            scheduled.append(str(profile_id))
+    return scheduled
+
+
+
+def pop_due(limit=None, lease=None):
+    """
+    Claim and return IDs of profiles whose scheduled send time has passed.
+
+    If ``limit`` is given, claim at most that many (earliest first). Takes a
+    single atomic Redis round-trip, so concurrent callers never both get the
+    same profile.
+
+    Claimed profiles are leased for ``lease`` seconds (default
+    ``NOTIFICATION_SEND_LEASE_SECONDS``); ``release`` them once sent. Profiles
+    whose lease has expired unreleased are due again.
+
+    """
+    if lease is None:
+        lease = settings.NOTIFICATION_SEND_LEASE_SECONDS
+    now = time.time()
+    args = [repr(now), repr(now + lease)]
+    if limit is not None:
+        args.append(limit)
+    due = _pop_due_script(
+        keys=[SCHEDULED_PROFILES_KEY, SENDING_PROFILES_KEY],
+        args=args,
+        redis_client=_client(),
+        )
+    return [int(profile_id) for profile_id in due]
+
+
+
+@redis.script("""
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for i = 1, #expired do
+    redis.call('ZREM', KEYS[2], expired[i])
+    redis.call('ZADD', KEYS[1], ARGV[1], expired[i])
+end
+local due
+if ARGV[3] then
+    due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+else
+    due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+end
+for i = 1, #due do
+    redis.call('ZREM', KEYS[1], due[i])
+    redis.call('ZADD', KEYS[2], ARGV[2], due[i])
+end
+return due
+""")
+def _pop_due_script(client, keys, args):
+    """
+    Move members of ``keys[0]`` scored at most ``args[0]`` to ``keys[1]``.
+
+    Moved members are scored ``args[1]`` in ``keys[1]``. First, members of
+    ``keys[1]`` scored at most ``args[0]`` are moved back to ``keys[0]``,
+    scored ``args[0]``. If given, ``args[2]`` limits the number of members
+    moved to ``keys[1]``. Return list of them.
+
+    """
+    for profile_id in client.zrangebyscore(keys[1], '-inf', args[0]):
+        client.zrem(keys[1], profile_id)
+        client.zadd(keys[0], args[0], profile_id)
+    kw = {}
+    if len(args) > 2:
+        kw = {'start': 0, 'num': int(args[2])}
+    due = client.zrangebyscore(keys[0], '-inf', args[0], **kw)
+    for profile_id in due:
+        client.zrem(keys[0], profile_id)
+        client.zadd(keys[1], args[1], profile_id)
+    return due
+
+
+
+def release(profile_ids):
+    """Release claims (see ``pop_due``) on given profile IDs, once sent."""
+    profile_ids = list(profile_ids)
+    if profile_ids:
+        _client().zrem(SENDING_PROFILES_KEY, *profile_ids)
+
+
+
+def dispatch_pending(chunk_size=None, interval=None):
+    """
+    Schedule notification emails for all profiles with pending notifications.
+
+    Walks the pending-profiles set with SSCAN, ``chunk_size`` (default
+    ``NOTIFICATION_DISPATCH_CHUNK_SIZE``) profiles at a time, scheduling each
+    chunk ``interval`` (default ``NOTIFICATION_DISPATCH_INTERVAL_SECONDS``)
+    seconds after the previous one, so a large backlog is sent gradually.
+
+    The scan cursor is saved in Redis after each chunk; if a dispatch dies
+    part-way, the next one resumes from there. Re-dispatching a chunk never
+    double-sends: already-scheduled profiles keep their schedule, and sent
+    profiles are no longer pending.
+
+    Return dictionary of stats: number of ``chunks`` dispatched, total
+    ``profiles`` in them, how many of those were newly ``scheduled``, and
+    whether this dispatch ``resumed`` an earlier one.
+
+    """
+    chunk_size = chunk_size or settings.NOTIFICATION_DISPATCH_CHUNK_SIZE
+    if interval is None:
+        interval = settings.NOTIFICATION_DISPATCH_INTERVAL_SECONDS
+    client = _client()
+    cursor = int(client.get(DISPATCH_CURSOR_KEY) or 0)
+    stats = {
+        'chunks': 0, 'profiles': 0, 'scheduled': 0, 'resumed': bool(cursor)}
+    while True:
+        cursor, profile_ids = store.scan_pending_profile_ids(
+            cursor, count=chunk_size)
+        if profile_ids:
+            scheduled = schedule(
+                profile_ids, delay=stats['chunks'] * interval)
+            stats['chunks'] += 1
+            stats['profiles'] += len(profile_ids)
+            stats['scheduled'] += len(scheduled)
+        if not cursor:
+            break
+        client.set(DISPATCH_CURSOR_KEY, cursor)
+    client.delete(DISPATCH_CURSOR_KEY)
+    return stats
+
+
+
+def scheduled_profile_ids():
+    """Return dict mapping scheduled profile IDs to send-after timestamps."""
+    return {
+        int(profile_id): send_after
+        for profile_id, send_after in _client().zrangebyscore(
+            SCHEDULED_PROFILES_KEY, '-inf', '+inf', withscores=True)
+        }
+
+
+
+def _client():
+    """Return Redis client for notification scheduling."""
+    return redis.get_client('notifications')
@@ -1,4 +1,12 @@
-"""Notification storage and retrieval."""
+"""
+Notification storage and retrieval.
+
+All notification state must live on a single, non-clustered Redis instance
+(the 'notifications' role, which can't be sharded): ``_store_script`` writes
+notification data keys whose IDs it only generates as it runs, so it can't
+declare them in KEYS as Redis Cluster requires.
+
+"""
 import time
 
 from django.conf import settings
@@ -15,7 +23,24 @@ NOTIFICATION_KEY_PATTERN = 'notify:profiles:%s:notifications:%s'
 
 def pending_profile_ids():
     """Get list of profile IDs with pending triggering notifications."""
-    return redis.client.smembers(PENDING_PROFILES_KEY)
+    return _client().smembers(PENDING_PROFILES_KEY)
+
+
+
+def scan_pending_profile_ids(cursor=0, count=None):
+    """
+    Get one chunk of profile IDs with pending triggering notifications.
+
+    Uses SSCAN, so never blocks Redis for long however many profiles are
+    pending; ``count`` is a hint for how many IDs to return. Start with
+    ``cursor`` 0, then pass each returned cursor back in until it is 0 again.
+
+    Return (next cursor, list of profile IDs).
+
+    """
+    cursor, profile_ids = _client().sscan(
+        PENDING_PROFILES_KEY, cursor, count=count)
+    return cursor, list(profile_ids)
 
 
 
@@ -31,45 +56,198 @@ def store(profile_id, name, triggering=False, data=None):
     ``data`` is a dictionary of arbitrary additional data about the
     notification; all values should be strings.
 
+    Return the new notification's ID.
+
+    """
+    return store_many([profile_id], name, triggering=triggering, data=data)[0]
+
+
+
+def store_many(profile_ids, name, triggering=False, data=None):
+    """
+    Store the same notification for each of given profile IDs.
+
+    Arguments are as for ``store``. Takes a single atomic round-trip to Redis
+    regardless of the number of profiles. Return list of the new notification
+    IDs, in the order of ``profile_ids``.
+
+    """
+    data = _notification_data(name, triggering, data)
+    return _store_all([(profile_id, data) for profile_id in profile_ids])
+
+
+
+def store_batch(notifications):
     """
-    data = data or {}
+    Store many (possibly differing) notifications.
+
+    ``notifications`` is a list of (profile_id, name, triggering, data)
+    tuples, with each item as for the arguments to ``store``. Takes a single
+    atomic round-trip to Redis. Return list of the new notification IDs, in
+    order.
+
+    """
+    return _store_all(
+        [
+            (profile_id, _notification_data(name, triggering, data))
+            for profile_id, name, triggering, data in notifications
+            ]
+        )
+
+
+
+def _notification_data(name, triggering, data):
+    """Return full data dict to store for a notification."""
+    data = dict(data or {})
     data['triggering'] = '1' if triggering else '0'
     data['name'] = name
+    return data
 
-    pending_key = make_pending_notifications_key(profile_id)
-    notification_id = get_next_notification_id(profile_id)
-    key = make_notification_key(profile_id, notification_id)
 
-    expiry_timestamp = time.time() + settings.NOTIFICATION_EXPIRY_SECONDS
 
-    p = redis.client.pipeline()
-    # add the notification ID to the list of pending notifications for this user
-    p.zadd(pending_key, expiry_timestamp, notification_id)
-    # Store data hash for the notification. Allow the data to exist for an
-    # extra minute so we don't ever try to query expired data
-    p.hmset(key, data).expireat(key, int(expiry_timestamp) + 60)
-    if triggering:
-        # Add user to the set of users with pending triggering notifications
-        p.sadd(PENDING_PROFILES_KEY, profile_id)
-    p.execute()
+def _store_all(notifications):
+    """
+    Store notifications given as a list of (profile_id, data) tuples.
+
+    Each ``data`` dict must include ``triggering`` ('1' or '0') and ``name``.
+    Return list of new notification IDs.
+
+    """
+    if not notifications:
+        return []
+    now = time.time()
+    expiry_timestamp = now + settings.NOTIFICATION_EXPIRY_SECONDS
+    # Allow the data to exist for an extra minute so we don't ever try to
+    # query expired data
+    keys = [PENDING_PROFILES_KEY]
+    args = [
+        repr(expiry_timestamp), int(expiry_timestamp) + 60, '(%s' % int(now)]
+    for profile_id, data in notifications:
+        keys.append(NEXT_NOTIFICATION_ID_KEY_PATTERN % profile_id)
+        keys.append(make_pending_notifications_key(profile_id))
+        args.extend([
+                profile_id,
+                make_notification_key(profile_id, ''),
+                len(data),
+                ])
+        for item in data.items():
+            args.extend(item)
+    return _store_script(keys=keys, args=args, redis_client=_client())
+
+
+
+@redis.script("""
+local expiry, data_expiry, expired = ARGV[1], ARGV[2], ARGV[3]
+local ids = {}
+local a = 4
+for k = 2, #KEYS, 2 do
+    local profile_id, data_key_prefix = ARGV[a], ARGV[a + 1]
+    local num_fields = tonumber(ARGV[a + 2])
+    local data = {}
+    local triggering = false
+    for f = a + 3, a + 2 + 2 * num_fields, 2 do
+        data[#data + 1] = ARGV[f]
+        data[#data + 1] = ARGV[f + 1]
+        if ARGV[f] == 'triggering' and ARGV[f + 1] == '1' then
+            triggering = true
+        end
+    end
+    a = a + 3 + 2 * num_fields
+
+    local id = redis.call('INCR', KEYS[k])
+    redis.call('ZREMRANGEBYSCORE', KEYS[k + 1], '-inf', expired)
+    redis.call('ZADD', KEYS[k + 1], expiry, id)
+    redis.call('EXPIREAT', KEYS[k + 1], data_expiry)
+    local data_key = data_key_prefix .. id
+    redis.call('HMSET', data_key, unpack(data))
+    redis.call('EXPIREAT', data_key, data_expiry)
+    if triggering then
+        redis.call('SADD', KEYS[1], profile_id)
+    end
+    ids[#ids + 1] = id
+end
+return ids
+""")
+def _store_script(client, keys, args):
+    """
+    Atomically store notifications.
+
+    ``keys`` are the pending-profiles set key, then for each notification its
+    profile's next-ID key and pending-notifications key. ``args`` are the
+    pending-notification expiry score, the data expiry timestamp and the
+    (exclusive) max score of already-expired notifications, then for each
+    notification: profile ID, data key prefix, number of data fields, and the
+    data fields and values.
 
+    Each notification gets the next ID for its profile, is added (scored by
+    expiry) to the profile's pending notifications, has its data stored in an
+    expiring hash, and (if triggering) adds its profile to the set of profiles
+    with pending triggering notifications. Expired notifications are trimmed
+    from the profile's pending notifications, which expire along with the
+    newest notification's data. Return list of new IDs.
 
+    Data keys (``data key prefix`` + new ID) are not passed in ``keys``, so
+    this requires a single non-clustered Redis instance; see module docstring.
 
-def get_all(profile_id, clear=False):
+    """
+    expiry, data_expiry, expired = args[0], int(args[1]), args[2]
+    ids = []
+    a = 3
+    for k in range(1, len(keys), 2):
+        profile_id, data_key_prefix = args[a], args[a + 1]
+        num_fields = int(args[a + 2])
+        fields = args[a + 3:a + 3 + 2 * num_fields]
+        data = dict(zip(fields[::2], fields[1::2]))
+        a += 3 + 2 * num_fields
+
+        notification_id = client.incr(keys[k])
+        client.zremrangebyscore(keys[k + 1], '-inf', expired)
+        client.zadd(keys[k + 1], expiry, notification_id)
+        client.expireat(keys[k + 1], data_expiry)
+        data_key = data_key_prefix + str(notification_id)
+        client.hmset(data_key, data)
+        client.expireat(data_key, data_expiry)
+        if data.get('triggering') == '1':
+            client.sadd(keys[0], profile_id)
+        ids.append(notification_id)
+    return ids
+
+
+
+def get_all(profile_id, clear=False, chunk_size=None):
     """
     Get all pending notifications for given profile ID.
 
     Do not return expired notifications (those older than
-    NOTIFICATION_EXPIRY_SECONDS).
+    NOTIFICATION_EXPIRY_SECONDS); trim them from Redis instead.
 
     If ``clear`` is ``True``, also clear all pending notifications.
 
+    Takes two Redis round-trips: one for the pending IDs, one for all of their
+    data. For very large backlogs, pass ``chunk_size`` to instead fetch (and
+    yield) notification data that many at a time.
+
+    """
+    ids = pending_ids(profile_id, clear=clear)
+    for data in get_data(profile_id, ids, chunk_size=chunk_size):
+        yield data
+
+
+
+def pending_ids(profile_id, clear=False):
+    """
+    Return list of IDs of given profile's pending notifications, oldest first.
+
+    Expired notifications are trimmed rather than returned. ``clear`` is as
+    for ``get_all``. Takes one Redis round-trip.
+
     """
     pending_key = make_pending_notifications_key(profile_id)
     now_ts = int(time.time())
 
-    p = redis.client.pipeline()
-    # get non-expired pending notifications for this user
+    p = _client().pipeline()
+    # trim expired notifications, get the rest pending for this user
+    p.zremrangebyscore(pending_key, '-inf', '(%s' % now_ts)
     p.zrangebyscore(pending_key, now_ts, '+inf')
     if clear:
         # clear the pending notifications list
@@ -77,23 +255,184 @@ def get_all(profile_id, clear=False):
         # remove user from the set of users w/ pending triggering notifications
         p.srem(PENDING_PROFILES_KEY, profile_id)
         # don't clear out individual notification data; redis expiration will
-    ids = p.execute()[0]
+    return p.execute()[1]
+
+
+
+def get_data(profile_id, notification_ids, chunk_size=None):
+    """
+    Get data of given notifications of given profile ID.
+
+    Yields data dicts in the order of ``notification_ids``, fetching
+    ``chunk_size`` (default all) per Redis round-trip.
+
+    """
+    client = _client()
+    chunk_size = chunk_size or len(notification_ids) or 1
+    for start in range(0, len(notification_ids), chunk_size):
+        p = client.pipeline()
+        for notification_id in notification_ids[start:start + chunk_size]:
+            p.hgetall(make_notification_key(profile_id, notification_id))
+        for data in p.execute():
+            yield data
+
+
+
+def clear(profile_id, notification_ids):
+    """
+    Clear given pending notifications of given profile ID (e.g. once sent).
+
+    Notifications that arrived since ``notification_ids`` were fetched are
+    left pending. The profile is removed from the set of profiles with
+    pending triggering notifications only if none are left pending at all;
+    otherwise it remains, since one of those left may be triggering. Takes a
+    single atomic round-trip to Redis.
+
+    """
+    _clear_script(
+        keys=[
+            PENDING_PROFILES_KEY, make_pending_notifications_key(profile_id)],
+        args=[profile_id] + list(notification_ids),
+        redis_client=_client(),
+        )
+
+
+
+@redis.script("""
+for a = 2, #ARGV do
+    redis.call('ZREM', KEYS[2], ARGV[a])
+end
+if redis.call('ZCARD', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[1], ARGV[1])
+end
+""")
+def _clear_script(client, keys, args):
+    """
+    Remove notification IDs ``args[1:]`` from pending notifications
+    ``keys[1]``.
+
+    If none are left pending, remove profile ID ``args[0]`` from
+    pending-profiles set ``keys[0]``.
+
+    """
+    for notification_id in args[1:]:
+        client.zrem(keys[1], notification_id)
+    if not client.zcard(keys[1]):
+        client.srem(keys[0], args[0])
+
+
+
+def prune(profile_ids):
+    """
+    Trim expired notifications from given profiles' pending notifications.
+
+    Profiles left with no pending notifications are also removed from the set
+    of profiles with pending triggering notifications (they may never have
+    been sent an email, e.g. if they have no email address). Takes a single
+    atomic round-trip to Redis.
+
+    Return tuple of (number of notifications pruned, number of profiles no
+    longer pending).
+
+    """
+    profile_ids = list(profile_ids)
+    if not profile_ids:
+        return 0, 0
+    keys = [PENDING_PROFILES_KEY]
+    keys.extend(make_pending_notifications_key(pid) for pid in profile_ids)
+    pruned, unpended = _prune_script(
+        keys=keys,
+        args=['(%s' % int(time.time())] + profile_ids,
+        redis_client=_client(),
+        )
+    return int(pruned), int(unpended)
+
+
+
+@redis.script("""
+local pruned, unpended = 0, 0
+for k = 2, #KEYS do
+    pruned = pruned + redis.call('ZREMRANGEBYSCORE', KEYS[k], '-inf', ARGV[1])
+    if redis.call('ZCARD', KEYS[k]) == 0 then
+        unpended = unpended + redis.call('SREM', KEYS[1], ARGV[k])
+    end
+end
+return {pruned, unpended}
+""")
+def _prune_script(client, keys, args):
+    """
+    Trim pending notifications ``keys[1:]`` of scores below ``args[0]``.
+
+    Profile IDs ``args[1:]`` (matching ``keys[1:]``) left with no pending
+    notifications are removed from pending-profiles set ``keys[0]``. Return
+    [number pruned, number removed from pending-profiles set].
+
+    """
+    pruned = unpended = 0
+    for key, profile_id in zip(keys[1:], args[1:]):
+        pruned += client.zremrangebyscore(key, '-inf', args[0])
+        if not client.zcard(key):
+            unpended += client.srem(keys[0], profile_id)
+    return [pruned, unpended]
+
+
 
-    for notification_id in ids:
-        yield get(profile_id, notification_id)
+def sweep(chunk_size=500):
+    """
+    Prune expired notifications for all profiles; return dict of stats.
+
+    Scans (incrementally, ``chunk_size`` at a time) all pending-notification
+    sets and the set of profiles with pending triggering notifications,
+    pruning each as by ``prune``. Stats are the number of profiles
+    ``checked`` (those in both are checked twice), notifications ``pruned``
+    and profiles ``unpended``.
+
+    """
+    stats = {'checked': 0, 'pruned': 0, 'unpended': 0}
+
+    def _prune(profile_ids):
+        pruned, unpended = prune(profile_ids)
+        stats['checked'] += len(profile_ids)
+        stats['pruned'] += pruned
+        stats['unpended'] += unpended
+
+    profile_ids = []
+    pattern = make_pending_notifications_key('*')
+    for key in _client().scan_iter(match=pattern, count=chunk_size):
+        profile_ids.append(key.split(':')[2])
+        if len(profile_ids) >= chunk_size:
+            _prune(profile_ids)
+            profile_ids = []
+    if profile_ids:
+        _prune(profile_ids)
+
+    cursor = None
+    while cursor != 0:
+        cursor, profile_ids = scan_pending_profile_ids(
+            cursor or 0, count=chunk_size)
+        if profile_ids:
+            _prune(profile_ids)
+
+    return stats
 
 
 
 def get(profile_id, notification_id):
     """Get a notification's data by id."""
     key = make_notification_key(profile_id, notification_id)
-    return redis.client.hgetall(key)
+    return _client().hgetall(key)
 
 
 
 def get_next_notification_id(profile_id):
     """Get the next notification ID for the given profile ID."""
-    return redis.client.incr(NEXT_NOTIFICATION_ID_KEY_PATTERN % profile_id)
+    return _client().incr(NEXT_NOTIFICATION_ID_KEY_PATTERN % profile_id)
+
+
+
+def _client():
+    """Return Redis client for notification storage."""
+    return redis.get_client('notifications')
 
 
 
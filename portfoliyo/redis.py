@@ -1,133 +1,640 @@
 from __future__ import absolute_import
 
-import time
+import bisect
+import fnmatch
+import functools
+import hashlib
+import heapq
+import logging
+import threading
+from time import time
+import urlparse
+import zlib
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 import redis
-from redis.exceptions import ResponseError
+from redis.client import StrictPipeline
+from redis.exceptions import NoScriptError, ResponseError
 
 
 
-class InMemoryRedis(object):
+logger = logging.getLogger(__name__)
+
+
+
+_thread_data = threading.local()
+
+
+
+class RedisStats(object):
+    """Redis usage (round-trips, commands, time) within one request or task."""
+    def __init__(self, name):
+        self.name = name
+        # round-trips to the server (a pipeline is one round-trip)
+        self.calls = 0
+        # total commands sent, including all commands in pipelines
+        self.commands = 0
+        # largest number of commands sent in a single pipeline
+        self.max_pipeline = 0
+        # wall time spent waiting on Redis, in seconds
+        self.seconds = 0.0
+
+
+    def record(self, commands, seconds, pipeline=False):
+        """Record a round-trip of ``commands`` taking ``seconds``."""
+        self.calls += 1
+        self.commands += commands
+        self.seconds += seconds
+        if pipeline:
+            self.max_pipeline = max(self.max_pipeline, commands)
+
+
+    def as_header(self):
+        """Return stats as a compact string for an HTTP header."""
+        return 'calls=%s; commands=%s; max-pipeline=%s; ms=%.1f' % (
+            self.calls, self.commands, self.max_pipeline, self.seconds * 1000)
+
+
+    def log(self):
+        """Emit stats as a structured log line."""
+        budget = getattr(settings, 'REDIS_CALL_BUDGET', None)
+        over_budget = budget is not None and self.calls > budget
+        logger.log(
+            logging.WARNING if over_budget else logging.INFO,
+            "redis-stats name=%s calls=%s commands=%s max_pipeline=%s "
+            "ms=%.1f%s",
+            self.name,
+            self.calls,
+            self.commands,
+            self.max_pipeline,
+            self.seconds * 1000,
+            " over_budget=%s" % budget if over_budget else "",
+            extra={
+                'redis_stats': {
+                    'name': self.name,
+                    'calls': self.calls,
+                    'commands': self.commands,
+                    'max_pipeline': self.max_pipeline,
+                    'ms': self.seconds * 1000,
+                    },
+                },
+            )
+
+
+
+def _get_stats_stack():
+    """Return calling thread's stack of active ``RedisStats``."""
+    return _thread_data.__dict__.setdefault('stats', [])
+
+
+
+def start_stats(name):
+    """
+    Start tracking Redis usage in this thread; return the ``RedisStats``.
+
+    Tracking may be nested (e.g. an eagerly-run task within a request); usage
+    is recorded in every active ``RedisStats``.
+
+    """
+    stats = RedisStats(name)
+    _get_stats_stack().append(stats)
+    return stats
+
+
+
+def stop_stats(stats):
+    """Stop tracking Redis usage for given ``RedisStats``; return it."""
+    stack = _get_stats_stack()
+    if stats in stack:
+        stack.remove(stats)
+    return stats
+
+
+
+def record_stats(commands, seconds, pipeline=False):
+    """Record a Redis round-trip in all active ``RedisStats``."""
+    for stats in _get_stats_stack():
+        stats.record(commands, seconds, pipeline)
+
+
+
+class RedisStatsMiddleware(object):
+    """Track Redis usage per request; report in a header and a log line."""
+    def process_request(self, request):
+        request._redis_stats = start_stats(request.path)
+
+
+    def process_response(self, request, response):
+        stats = getattr(request, '_redis_stats', None)
+        if stats is not None:
+            stop_stats(stats)
+            stats.log()
+            if getattr(settings, 'REDIS_STATS_HEADER', False):
+                response['X-Redis-Stats'] = stats.as_header()
+        return response
+
+
+
+class ScanMixin(object):
+    """Incremental keyspace iteration for any client with a ``scan`` method."""
+    def scan_iter(self, match=None, count=None):
+        """
+        Iterate over all keys (matching glob ``match``) using SCAN.
+
+        Unlike KEYS, never blocks the server for long: each round-trip fetches
+        roughly ``count`` keys. Keys added or removed during iteration may or
+        may not be returned; all others are returned exactly once.
+
+        """
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match=match, count=count)
+            for key in keys:
+                yield key
+
+
+
+class InstrumentedRedis(ScanMixin, redis.StrictRedis):
+    """A ``StrictRedis`` client that records usage in ``RedisStats``."""
+    def execute_command(self, *args, **options):
+        start = time()
+        try:
+            return super(InstrumentedRedis, self).execute_command(
+                *args, **options)
+        finally:
+            record_stats(1, time() - start)
+
+
+    def scan(self, cursor=0, match=None, count=None):
+        """SCAN (not wrapped by this redis-py); return (cursor, keys)."""
+        args = [cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        cursor, keys = self.execute_command('SCAN', *args)
+        return int(cursor), keys
+
+
+    def sscan(self, key, cursor=0, match=None, count=None):
+        """SSCAN (not wrapped by this redis-py); return (cursor, members)."""
+        args = [key, cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        cursor, members = self.execute_command('SSCAN', *args)
+        return int(cursor), members
+
+
+    def memory_usage(self, keys):
+        """
+        Return list of approximate bytes used by each of ``keys``.
+
+        Uses MEMORY USAGE where the server supports it (Redis 4+), falling back
+        to the serialized length reported by DEBUG OBJECT. Keys that no longer
+        exist count as zero. One round-trip (two with the fallback).
+
+        """
+        p = self.pipeline(transaction=False)
+        for key in keys:
+            p.execute_command('MEMORY', 'USAGE', key)
+        results = p.execute(raise_on_error=False)
+        if any(_is_unknown_command(r) for r in results):
+            p = self.pipeline(transaction=False)
+            for key in keys:
+                p.debug_object(key)
+            results = [
+                r.get('serializedlength') if isinstance(r, dict) else r
+                for r in p.execute(raise_on_error=False)
+                ]
+        return [
+            0 if r is None or isinstance(r, Exception) else int(r)
+            for r in results
+            ]
+
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+            )
+
+
+
+class InstrumentedPipeline(StrictPipeline):
+    """A ``StrictPipeline`` that records usage in ``RedisStats``."""
+    def execute(self, *args, **kwargs):
+        commands = len(self.command_stack)
+        start = time()
+        try:
+            return super(InstrumentedPipeline, self).execute(*args, **kwargs)
+        finally:
+            record_stats(commands, time() - start, pipeline=True)
+
+
+
+class Script(object):
+    """
+    A server-side Lua script, with an equivalent Python implementation.
+
+    Calling the script runs it atomically in one round-trip: on a real Redis
+    via EVALSHA (falling back to EVAL the first time the server sees it); on
+    ``InMemoryRedis``, which can't run Lua, by calling ``python_func(client,
+    keys, args)`` with the client lock held.
+
+    Use the ``script`` decorator to define one.
+
+    """
+    def __init__(self, lua, python_func):
+        self.lua = lua
+        self.sha = hashlib.sha1(lua).hexdigest()
+        self.python_func = python_func
+
+
+    def __call__(self, keys=(), args=(), redis_client=None):
+        """Run script with given ``keys`` and ``args``; return its result."""
+        if redis_client is None:
+            redis_client = client
+        if isinstance(redis_client, InMemoryRedis):
+            return redis_client.run_script(self.python_func, keys, args)
+        keys_and_args = tuple(keys) + tuple(args)
+        try:
+            return redis_client.evalsha(self.sha, len(keys), *keys_and_args)
+        except NoScriptError:
+            return redis_client.eval(self.lua, len(keys), *keys_and_args)
+
+
+
+def script(lua):
+    """
+    Decorate a Python function as the in-memory equivalent of Lua ``lua``.
+
+    The decorated function takes ``(client, keys, args)`` and should do the
+    same as the Lua script, using ``client`` commands. Returns a ``Script``.
+
+    """
+    def _decorator(func):
+        return Script(lua, func)
+
+    return _decorator
+
+
+
+def _is_unknown_command(result):
+    """Return True if pipeline ``result`` is an unknown-command error."""
+    return (
+        isinstance(result, ResponseError) and
+        'unknown command' in str(result).lower()
+        )
+
+
+
+def memory_report(batch_size=500):
+    """
+    Return dict mapping key prefix to dict of ``keys`` count and ``bytes``.
+
+    A key's prefix is everything before its first colon (e.g. ``unread``,
+    ``notify``, ``announcements``). Totals are across all Redis instances in
+    use. Scans each keyspace incrementally, so is safe to run against a live
+    server.
+
+    """
+    report = {}
+    for redis_client in get_clients():
+        keys = []
+
+        def _tally():
+            sizes = redis_client.memory_usage(keys)
+            for key, size in zip(keys, sizes):
+                usage = report.setdefault(
+                    key.split(':', 1)[0], {'keys': 0, 'bytes': 0})
+                usage['keys'] += 1
+                usage['bytes'] += size
+            del keys[:]
+
+        for key in redis_client.scan_iter(count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                _tally()
+        if keys:
+            _tally()
+    return report
+
+
+
+def _command(method):
+    """
+    Decorate an ``InMemoryRedis`` method as a Redis command.
+
+    Every command holds the client lock, counts as one call to Redis (in
+    ``num_calls`` and any active ``RedisStats``), and first sweeps any expired
+    keys out of the data store.
+
+    """
+    @functools.wraps(method)
+    def _wrapped(self, *args, **kwargs):
+        with self._lock:
+            self.num_calls += 1
+            self._sweep()
+            if self._in_pipeline:
+                return method(self, *args, **kwargs)
+            start = time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                record_stats(1, time() - start)
+
+    return _wrapped
+
+
+
+class InMemoryRedis(ScanMixin):
     """
     An in-memory fake Redis, for when Redis is not available.
 
-    In-memory and not thread-safe; for use only in local development and for
-    running tests.
+    Thread-safe (all commands, and pipelines as a whole, are serialized by a
+    lock), so it can back a multi-threaded development or single-box server.
+    Keys with an expiry are freed as soon as any command runs after they
+    expire, rather than only when next read.
 
     """
     def __init__(self):
         self.data = {}
         self.expiry = {}
         self.num_calls = 0
+        self._expiry_heap = []
+        self._lock = threading.RLock()
+        self._in_pipeline = False
+
+
+    def run_script(self, func, keys, args):
+        """
+        Run ``func(self, keys, args)`` atomically, as one call to Redis.
+
+        Like real Redis, all ``args`` are passed to ``func`` as strings.
+
+        """
+        start = time()
+        with self._lock:
+            start_calls = self.num_calls
+            in_pipeline = self._in_pipeline
+            self._in_pipeline = True
+            try:
+                ret = func(self, list(keys), [str(arg) for arg in args])
+            finally:
+                self._in_pipeline = in_pipeline
+            self.num_calls = start_calls + 1
+        if not in_pipeline:
+            record_stats(1, time() - start)
+        return ret
 
 
-    def _get(self, key, default=None):
-        self._check_expiry(key)
-        return self.data.get(key, default)
-
-
-    def _setdefault(self, key, default):
-        self._check_expiry(key)
-        return self.data.setdefault(key, default)
-
-
-    def _check_expiry(self, key):
-        # All queries call this (indirectly via _get or _setdefault) once
-        self.num_calls += 1
-        expiry = self.expiry.get(key)
-        if expiry and time.time() > expiry:
+    def _sweep(self):
+        """Delete all keys whose expiry timestamp has passed."""
+        heap = self._expiry_heap
+        if not heap:
+            return
+        now = time()
+        while heap and heap[0][0] < now:
+            timestamp, key = heapq.heappop(heap)
+            # stale heap entries (expiry since changed or key deleted) are
+            # simply discarded
+            if self.expiry.get(key) == timestamp:
+                del self.expiry[key]
+                self.data.pop(key, None)
+
+
+    def _prune(self, key):
+        """Delete ``key`` if it is an empty collection, as Redis does."""
+        if key in self.data and not self.data[key]:
             del self.data[key]
-            del self.expiry[key]
+            self.expiry.pop(key, None)
 
 
+    @_command
     def expireat(self, key, timestamp):
         if not isinstance(timestamp, int):
             raise ResponseError("value is not an integer or out of range")
+        if key not in self.data:
+            return False
         self.expiry[key] = timestamp
+        heapq.heappush(self._expiry_heap, (timestamp, key))
+        return True
 
 
+    @_command
     def smembers(self, key):
-        return self._get(key, set())
+        return set(self.data.get(key, ()))
 
 
-    def sadd(self, key, val):
-        val = str(val)
-        s = self._setdefault(key, set())
-        ret = 1 if val in s else 0
-        s.add(val)
-        return ret
+    @_command
+    def sadd(self, key, *vals):
+        """Add members to set; return number of new members added."""
+        s = self.data.setdefault(key, set())
+        before = len(s)
+        s.update(str(val) for val in vals)
+        return len(s) - before
 
 
+    @_command
     def srem(self, key, val):
         val = str(val)
-        s = self._setdefault(key, set())
+        s = self.data.get(key, set())
         ret = 1 if val in s else 0
         s.discard(val)
+        self._prune(key)
         return ret
 
 
+    @_command
     def delete(self, key):
+        self.expiry.pop(key, None)
         if key in self.data:
             del self.data[key]
             return True
         return False
 
 
+    @_command
+    def lpush(self, key, *vals):
+        """Prepend values to list; return new length of list."""
+        l = self.data.setdefault(key, [])
+        for val in vals:
+            l.insert(0, str(val))
+        return len(l)
+
+
+    @_command
+    def llen(self, key):
+        return len(self.data.get(key, ()))
+
+
+    @_command
     def scard(self, key):
-        s = self._setdefault(key, set())
-        return len(s)
+        return len(self.data.get(key, ()))
 
 
+    @_command
     def sismember(self, key, val):
-        val = str(val)
-        s = self._setdefault(key, set())
-        return val in s
+        return str(val) in self.data.get(key, ())
+
+
+    @_command
+    def get(self, key):
+        val = self.data.get(key)
+        return None if val is None else str(val)
+
+
+    @_command
+    def set(self, key, val):
+        self.data[key] = str(val)
+        self.expiry.pop(key, None)
+        return True
+
+
+    @_command
+    def keys(self, pattern='*'):
+        return [k for k in self.data if fnmatch.fnmatchcase(k, pattern)]
+
+
+    @_command
+    def scan(self, cursor=0, match=None, count=None):
+        """
+        Return (next cursor, keys) for one step of an incremental scan.
 
+        Keys are visited in order of a hash of their name and the cursor is
+        the next hash to visit, so (as in Redis) keys present for the whole
+        scan are returned exactly once, even if other keys are added or
+        deleted in the meantime.
 
+        """
+        return _hash_scan(self.data, cursor, match, count)
+
+
+    @_command
+    def sscan(self, key, cursor=0, match=None, count=None):
+        """Return (next cursor, members) for one step of a set scan."""
+        return _hash_scan(self.data.get(key, ()), cursor, match, count)
+
+
+    @_command
+    def memory_usage(self, keys):
+        """Return list of approximate bytes used by each of ``keys``."""
+        sizes = []
+        for key in keys:
+            val = self.data.get(key)
+            if val is None:
+                sizes.append(0)
+            elif isinstance(val, basestring):
+                sizes.append(len(key) + len(val))
+            elif isinstance(val, dict):
+                sizes.append(len(key) + sum(
+                    len(k) + len(v) for k, v in val.items()))
+            elif isinstance(val, SortedSet):
+                sizes.append(len(key) + sum(
+                    len(m) + 8 for m in val.scores))
+            else:
+                sizes.append(len(key) + sum(len(m) for m in val))
+        return sizes
+
+
+    @_command
     def incr(self, key):
-        val = self._get(key, 0)
-        val += 1
-        self.data[key] = val
+        val = int(self.data.get(key, 0)) + 1
+        self.data[key] = str(val)
         return val
 
 
+    @_command
     def hmset(self, key, mapping):
-        d = self._setdefault(key, {})
+        d = self.data.setdefault(key, {})
         d.update((k, str(v)) for k, v in mapping.items())
         return True
 
 
+    @_command
     def hgetall(self, key):
-        return self._get(key, {}).copy()
+        return self.data.get(key, {}).copy()
 
 
-    def zadd(self, key, score, val):
-        score = float(score)
-        val = str(val)
-        l = self._setdefault(key, [])
-        add_index = 0
-        rem_index = None
-        for i, (iscore, ival) in enumerate(l):
-            if iscore < score:
-                add_index = i + 1
-            if val == ival:
-                rem_index = i
-        l.insert(add_index, (score, val))
-        if rem_index is not None:
-            if add_index <= rem_index:
-                rem_index += 1
-            l.pop(rem_index)
-        return 1
+    @_command
+    def hincrby(self, key, field, amount=1):
+        d = self.data.setdefault(key, {})
+        val = int(d.get(str(field), 0)) + amount
+        d[str(field)] = str(val)
+        return val
 
 
-    def zrangebyscore(self, key, min, max):
-        min = float(min)
-        max = float(max)
-        ret = []
-        for score, val in self._get(key, []):
-            if score >= min and score <= max:
-                ret.append(val)
+    @_command
+    def hdel(self, key, field):
+        d = self.data.get(key, {})
+        ret = 1 if d.pop(str(field), None) is not None else 0
+        self._prune(key)
+        return ret
+
+
+    @_command
+    def zadd(self, key, *args):
+        """Add score/member pairs; return number of new members added."""
+        z = self.data.setdefault(key, SortedSet())
+        return sum(
+            z.add(float(score), str(val))
+            for score, val in zip(args[::2], args[1::2])
+            )
+
+
+    @_command
+    def zrem(self, key, *vals):
+        z = self.data.get(key, SortedSet())
+        ret = sum(z.remove(str(val)) for val in vals)
+        self._prune(key)
+        return ret
+
+
+    @_command
+    def zcard(self, key):
+        return len(self.data.get(key, ()))
+
+
+    @_command
+    def zscore(self, key, val):
+        return self.data.get(key, SortedSet()).scores.get(str(val))
+
+
+    @_command
+    def zcount(self, key, min, max):
+        return self.data.get(key, SortedSet()).count(min, max)
+
+
+    @_command
+    def zrangebyscore(self, key, min, max, start=None, num=None,
+                      withscores=False):
+        return self.data.get(key, SortedSet()).range_by_score(
+            min, max, start, num, withscores)
+
+
+    @_command
+    def zrevrangebyscore(self, key, max, min, start=None, num=None,
+                         withscores=False):
+        return self.data.get(key, SortedSet()).range_by_score(
+            min, max, start, num, withscores, reverse=True)
+
+
+    @_command
+    def zremrangebyrank(self, key, min, max):
+        ret = self.data.get(key, SortedSet()).remove_range_by_rank(min, max)
+        self._prune(key)
+        return ret
+
+
+    @_command
+    def zremrangebyscore(self, key, min, max):
+        ret = self.data.get(key, SortedSet()).remove_range_by_score(min, max)
+        self._prune(key)
         return ret
 
 
@@ -136,6 +643,179 @@ class InMemoryRedis(object):
 
 
 
+class SortedSet(object):
+    """
+    Sorted-set storage for ``InMemoryRedis``.
+
+    Members are kept in a list sorted by (score, member), with a parallel list
+    of scores for bisection, so score-range queries are O(log n + k).
+
+    """
+    def __init__(self):
+        self.scores = {}
+        self.entries = []
+        self.keys = []
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def add(self, score, member):
+        """Add or re-score ``member``; return 1 if it is new, else 0."""
+        old_score = self.scores.get(member)
+        if old_score is not None:
+            if old_score == score:
+                return 0
+            self._remove_entry(old_score, member)
+        index = bisect.bisect_left(self.entries, (score, member))
+        self.entries.insert(index, (score, member))
+        self.keys.insert(index, score)
+        self.scores[member] = score
+        return 0 if old_score is not None else 1
+
+
+    def remove(self, member):
+        """Remove ``member``; return 1 if it was present, else 0."""
+        score = self.scores.pop(member, None)
+        if score is None:
+            return 0
+        self._remove_entry(score, member)
+        return 1
+
+
+    def bounds(self, low, high):
+        """Return (lo, hi) slice indices of entries in given score range."""
+        low, low_exclusive = _parse_score_bound(low)
+        high, high_exclusive = _parse_score_bound(high)
+        if low_exclusive:
+            lo = bisect.bisect_right(self.keys, low)
+        else:
+            lo = bisect.bisect_left(self.keys, low)
+        if high_exclusive:
+            hi = bisect.bisect_left(self.keys, high)
+        else:
+            hi = bisect.bisect_right(self.keys, high)
+        return lo, hi
+
+
+    def count(self, low, high):
+        """Return number of members in given score range."""
+        lo, hi = self.bounds(low, high)
+        return max(hi - lo, 0)
+
+
+    def range_by_score(self, low, high, start=None, num=None,
+                       withscores=False, reverse=False):
+        """
+        Return members in given score range, in score order.
+
+        If ``reverse`` is True, return in descending score order (with
+        ``start`` and ``num`` applied from the high end).
+
+        """
+        lo, hi = self.bounds(low, high)
+        if start is not None:
+            if reverse:
+                hi -= start
+                if num is not None and num >= 0:
+                    lo = max(lo, hi - num)
+            else:
+                lo += start
+                if num is not None and num >= 0:
+                    hi = min(hi, lo + num)
+        entries = self.entries[lo:hi] if hi > lo else []
+        if reverse:
+            entries = entries[::-1]
+        if withscores:
+            return [(member, score) for score, member in entries]
+        return [member for score, member in entries]
+
+
+    def remove_range_by_score(self, low, high):
+        """Remove members in given score range; return number removed."""
+        lo, hi = self.bounds(low, high)
+        if hi <= lo:
+            return 0
+        for score, member in self.entries[lo:hi]:
+            del self.scores[member]
+        del self.entries[lo:hi]
+        del self.keys[lo:hi]
+        return hi - lo
+
+
+    def remove_range_by_rank(self, start, stop):
+        """Remove members ranked ``start`` to ``stop`` (inclusive, may be <0)."""
+        size = len(self.entries)
+        lo = start + size if start < 0 else start
+        hi = (stop + size if stop < 0 else stop) + 1
+        lo, hi = max(lo, 0), min(hi, size)
+        if hi <= lo:
+            return 0
+        for score, member in self.entries[lo:hi]:
+            del self.scores[member]
+        del self.entries[lo:hi]
+        del self.keys[lo:hi]
+        return hi - lo
+
+
+    def _remove_entry(self, score, member):
+        index = bisect.bisect_left(self.entries, (score, member))
+        del self.entries[index]
+        del self.keys[index]
+
+
+
+def _parse_score_bound(value):
+    """
+    Parse a Redis score-range bound to a (float, exclusive) tuple.
+
+    Accepts numbers, '-inf'/'+inf', and '(' prefixed exclusive bounds.
+
+    """
+    if isinstance(value, basestring) and value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+
+def _key_hash(key):
+    """Return stable non-negative hash of ``key``, for fake SCAN ordering."""
+    return zlib.crc32(key) & 0xffffffff
+
+
+
+def _hash_scan(items, cursor, match, count):
+    """
+    Return (next cursor, items) for one step of a fake SCAN over ``items``.
+
+    Items are visited in order of a hash of their name and the cursor is the
+    next hash to visit, so (as in Redis) items present for the whole scan are
+    returned exactly once, even if others are added or removed in the
+    meantime.
+
+    """
+    cursor = int(cursor)
+    count = count or 10
+    hashed = sorted(
+        (_key_hash(item), item) for item in items
+        if _key_hash(item) >= cursor
+        )
+    if len(hashed) > count:
+        # don't split items sharing a hash across steps
+        last = hashed[count - 1][0]
+        batch = [(h, item) for h, item in hashed if h <= last]
+        next_cursor = last + 1
+    else:
+        batch = hashed
+        next_cursor = 0
+    found = [item for h, item in batch]
+    if match is not None:
+        found = [item for item in found if fnmatch.fnmatchcase(item, match)]
+    return next_cursor, found
+
+
+
 class Pipeline(object):
     def __init__(self, client):
         self.client = client
@@ -144,11 +824,19 @@ class Pipeline(object):
 
     def execute(self):
         results = []
-        start_calls = self.client.num_calls
-        for method_name, args, kwargs in self.calls:
-            results.append(getattr(self.client, method_name)(*args, **kwargs))
-        # a pipelined set of commands counts as one call to Redis
-        self.client.num_calls = start_calls + 1
+        start = time()
+        with self.client._lock:
+            start_calls = self.client.num_calls
+            self.client._in_pipeline = True
+            try:
+                for method_name, args, kwargs in self.calls:
+                    results.append(
+                        getattr(self.client, method_name)(*args, **kwargs))
+            finally:
+                self.client._in_pipeline = False
+            # a pipelined set of commands counts as one call to Redis
+            self.client.num_calls = start_calls + 1
+        record_stats(len(self.calls), time() - start, pipeline=True)
         return results
 
 
@@ -165,7 +853,141 @@ for method_name in dir(InMemoryRedis):
 
 
 
+class HashRing(object):
+    """
+    Consistent-hash ring mapping shard keys to clients.
+
+    Each node is placed at many points on the ring, so keys spread evenly, and
+    adding or removing a node only moves the keys that node gains or loses.
+
+    """
+    REPLICAS = 100
+
+
+    def __init__(self, nodes):
+        """``nodes`` is a dict mapping a stable node name to its client."""
+        self.nodes = nodes
+        self._ring = sorted(
+            (_ring_hash('%s-%s' % (name, i)), name)
+            for name in nodes
+            for i in range(self.REPLICAS)
+            )
+        self._hashes = [h for h, name in self._ring]
+
+
+    def get(self, shard_key):
+        """Return the client for given shard key."""
+        index = bisect.bisect(self._hashes, _ring_hash(str(shard_key)))
+        return self.nodes[self._ring[index % len(self._ring)][1]]
+
+
+
+def _ring_hash(value):
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+
+def connect(url, max_connections=None):
+    """Return an ``InstrumentedRedis`` for ``url``, with its own pool."""
+    parsed = urlparse.urlparse(url)
+    try:
+        db = int(parsed.path.replace('/', ''))
+    except ValueError:
+        db = 0
+    pool = redis.ConnectionPool(
+        host=parsed.hostname or 'localhost',
+        port=parsed.port or 6379,
+        db=db,
+        password=parsed.password,
+        max_connections=max_connections,
+        )
+    return InstrumentedRedis(connection_pool=pool)
+
+
+
+# roles with their own (optional) Redis configuration in REDIS_ROLES
+ROLES = ['unread', 'notifications', 'announcements', 'broker']
+
+# roles whose keys may be sharded across several instances ('notifications'
+# must not be: its store script writes keys it doesn't declare in KEYS)
+SHARDABLE_ROLES = ['unread']
+
+
+
+def _configure_roles(roles_config):
+    """Return dict mapping role to client or ``HashRing``, per settings."""
+    role_clients = {}
+    for role, config in roles_config.items():
+        if role not in ROLES:
+            raise ImproperlyConfigured("Unknown Redis role %r." % role)
+        max_connections = config.get('MAX_CONNECTIONS')
+        if config.get('SHARDS'):
+            if role not in SHARDABLE_ROLES:
+                raise ImproperlyConfigured(
+                    "Redis role %r cannot be sharded." % role)
+            role_clients[role] = HashRing(
+                dict(
+                    (url, connect(url, max_connections))
+                    for url in config['SHARDS']
+                    )
+                )
+        elif config.get('URL'):
+            role_clients[role] = connect(config['URL'], max_connections)
+    return role_clients
+
+
+
+def get_client(role, shard_key=None):
+    """
+    Return the Redis client for given role.
+
+    Roles not configured in ``REDIS_ROLES`` share the default ``client``. For
+    a sharded role, ``shard_key`` (e.g. a profile ID) is required to pick the
+    instance; all keys for one shard key live on the same instance.
+
+    """
+    configured = _role_clients.get(role)
+    if configured is None:
+        return client
+    if isinstance(configured, HashRing):
+        if shard_key is None:
+            raise ValueError("Redis role %r is sharded; need shard_key." % role)
+        return configured.get(shard_key)
+    return configured
+
+
+
+def get_clients(role=None):
+    """
+    Return list of distinct clients for given role (or all roles).
+
+    A sharded role has one client per shard.
+
+    """
+    clients = []
+    for r in ([role] if role else ROLES):
+        configured = _role_clients.get(r)
+        if configured is None:
+            found = [client]
+        elif isinstance(configured, HashRing):
+            found = [configured.nodes[name] for name in sorted(configured.nodes)]
+        else:
+            found = [configured]
+        clients.extend(c for c in found if c not in clients)
+    return clients
+
+
+
+def get_url(role):
+    """Return the Redis URL for given (unsharded) role, or the default."""
+    config = getattr(settings, 'REDIS_ROLES', {}).get(role, {})
+    return config.get('URL') or settings.REDIS_URL
+
+
+
 if settings.REDIS_URL: # pragma: no cover
-    client = redis.StrictRedis.from_url(settings.REDIS_URL)
+    client = connect(settings.REDIS_URL, settings.REDIS_MAX_CONNECTIONS)
 else: # pragma: no cover
     client = InMemoryRedis()
+
+_role_clients = _configure_roles(getattr(settings, 'REDIS_ROLES', {}))
@@ -10,20 +10,7 @@ from portfoliyo import model
 
 def post2dict(post, **extra):
     """Return given post rendered as dictionary, ready for JSONification."""
-    if post.author:
-        author_name = (
-            post.author.name or post.author.user.email or post.author.phone
-            )
-
-        relationship = post.get_relationship()
-
-        if relationship is None:
-            role = post.author.role
-        else:
-            role = relationship.description or post.author.role
-    else:
-        author_name = "Portfoliyo"
-        role = ""
+    author_name, role = post_author(post)
 
     timestamp = timezone.localtime(post.timestamp)
 
@@ -67,6 +54,27 @@ def post2dict(post, **extra):
 
 
 
+def post_author(post):
+    """Return (author name, role) displayed for given post."""
+    if post.author:
+        author_name = (
+            post.author.name or post.author.user.email or post.author.phone
+            )
+
+        relationship = post.get_relationship()
+
+        if relationship is None:
+            role = post.author.role
+        else:
+            role = relationship.description or post.author.role
+    else:
+        author_name = "Portfoliyo"
+        role = ""
+
+    return author_name, role
+
+
+
 def now():
     """Get the current (timezone-aware) datetime."""
     return datetime.datetime.utcnow().replace(tzinfo=timezone.utc)
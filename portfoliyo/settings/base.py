@@ -2,6 +2,7 @@
 Default Django settings for portfoliyo project.
 
 """
+import datetime
 import os
 from os.path import abspath, dirname, exists, join
 
@@ -112,6 +113,7 @@ TEMPLATE_CONTEXT_PROCESSORS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'portfoliyo.redis.RedisStatsMiddleware',
     'django.middleware.gzip.GZipMiddleware',
     'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -150,6 +152,8 @@ INSTALLED_APPS = [
     'form_utils',
     'south',
     'tastypie',
+    # for project-wide management commands
+    'portfoliyo',
     'portfoliyo.announce',
     'portfoliyo.landing',
     'portfoliyo.model.users',
@@ -255,13 +259,83 @@ PORTFOLIYO_NUMBERS = {
 DEFAULT_NUMBER = '+15555555555'
 
 REDIS_URL = None
+# connection pool size for the REDIS_URL client (None: unlimited)
+REDIS_MAX_CONNECTIONS = None
+# Optional separate Redis instances by role ('unread', 'notifications',
+# 'announcements', 'broker'); unlisted roles use REDIS_URL. Each maps to a
+# dict with a 'URL' (or, for 'unread' only, a list of 'SHARDS' URLs) and an
+# optional 'MAX_CONNECTIONS' pool size. The 'notifications' URL must be a
+# single non-clustered instance (not Redis Cluster).
+REDIS_ROLES = {}
 CELERY_ALWAYS_EAGER = True
+# report per-request Redis usage in an X-Redis-Stats response header (if None,
+# only in DEBUG mode; see settings/default.py)
+REDIS_STATS_HEADER = None
+# log Redis usage at WARNING level if a request/task exceeds this many calls
+REDIS_CALL_BUDGET = None
+# unread posts kept per (profile, village) by the compact_redis task
+UNREAD_MAX_PER_VILLAGE = 1000
+
+# Task queues, each consumed by its own worker process (see Procfile), so a
+# backlog of one kind of work never delays another: "realtime" for work users
+# notice right away, "bulk" for notifications and maintenance, "analytics"
+# for tracking. Within a queue, tasks with lower priority numbers go first.
+CELERY_DEFAULT_QUEUE = 'bulk'
+CELERY_TASK_QUEUES = ['realtime', 'bulk', 'analytics']
+CELERY_ROUTES = {
+    'portfoliyo.tasks.send_sms': {'queue': 'realtime', 'priority': 0},
+    'portfoliyo.tasks.push_event': {'queue': 'realtime', 'priority': 3},
+    'portfoliyo.tasks.push_events': {'queue': 'realtime', 'priority': 3},
+    'portfoliyo.tasks.record_notification': {'queue': 'bulk', 'priority': 0},
+    'portfoliyo.tasks.check_for_pending_notifications': {
+        'queue': 'bulk', 'priority': 3},
+    'portfoliyo.tasks.send_scheduled_notifications': {
+        'queue': 'bulk', 'priority': 3},
+    'portfoliyo.tasks.send_notification_email': {
+        'queue': 'bulk', 'priority': 6},
+    'portfoliyo.tasks.send_notification_emails': {
+        'queue': 'bulk', 'priority': 6},
+    'portfoliyo.tasks.sweep_notifications': {'queue': 'bulk', 'priority': 9},
+    'portfoliyo.tasks.compact_redis': {'queue': 'bulk', 'priority': 9},
+    'portfoliyo.tasks.mixpanel': {'queue': 'analytics'},
+    }
+
+CELERYBEAT_SCHEDULE = {
+    'compact-redis': {
+        'task': 'portfoliyo.tasks.compact_redis',
+        'schedule': datetime.timedelta(days=1),
+        },
+    'send-scheduled-notifications': {
+        'task': 'portfoliyo.tasks.send_scheduled_notifications',
+        'schedule': datetime.timedelta(minutes=1),
+        },
+    'sweep-notifications': {
+        'task': 'portfoliyo.tasks.sweep_notifications',
+        'schedule': datetime.timedelta(hours=1),
+        },
+    }
 
 PORTFOLIYO_BASE_URL = 'http://localhost:8000'
 
+# how often (at most) each process checks for changed announcements
+ANNOUNCEMENT_CACHE_SECONDS = 60
+
 NOTIFICATION_EMAILS = True
 # notifications last 48 hours by default
 NOTIFICATION_EXPIRY_SECONDS = 48 * 60 * 60
+# triggered notification emails within this many seconds are merged into one
+NOTIFICATION_DEBOUNCE_SECONDS = 5 * 60
+# max profiles per notification-email task
+NOTIFICATION_SEND_BATCH_SIZE = 100
+# profiles claimed for sending are due again if not sent within this long
+NOTIFICATION_SEND_LEASE_SECONDS = 60 * 60
+# pending profiles are dispatched in chunks of (about) this many...
+NOTIFICATION_DISPATCH_CHUNK_SIZE = 500
+# ...each scheduled to send this many seconds after the previous chunk
+NOTIFICATION_DISPATCH_INTERVAL_SECONDS = 10
+# rendered post and bulk-post fragments are shared (via the Django cache)
+# between notification emails for this long
+NOTIFICATION_FRAGMENT_CACHE_SECONDS = 60 * 60
 
 DEBUG_TOOLBAR = False
 DEBUG_URLS = DEBUG
@@ -12,6 +12,9 @@ if DEBUG:
     except NameError:
         EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+if REDIS_STATS_HEADER is None:
+    REDIS_STATS_HEADER = DEBUG
+
 
 if DEBUG_TOOLBAR:
     INSTALLED_APPS += ['debug_toolbar']
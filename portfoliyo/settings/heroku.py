@@ -163,7 +163,23 @@ LOGGING = {
 }
 
 REDIS_URL = env('REDISTOGO_URL')
+REDIS_MAX_CONNECTIONS = int(
+    env('PORTFOLIYO_REDIS_MAX_CONNECTIONS') or 0) or None
 CELERY_ALWAYS_EAGER = not REDIS_URL
+REDIS_ROLES = {}
+for role in ['unread', 'notifications', 'announcements', 'broker']:
+    role_config = {
+        'URL': env('PORTFOLIYO_REDIS_%s_URL' % role.upper()),
+        'SHARDS': filter(
+            None, env('PORTFOLIYO_REDIS_%s_SHARDS' % role.upper()).split(',')),
+        'MAX_CONNECTIONS': env(
+            'PORTFOLIYO_REDIS_%s_MAX_CONNECTIONS' % role.upper()) or None,
+        }
+    if role_config['MAX_CONNECTIONS']:
+        role_config['MAX_CONNECTIONS'] = int(role_config['MAX_CONNECTIONS'])
+    if role_config['URL'] or role_config['SHARDS']:
+        REDIS_ROLES[role] = role_config
+del role, role_config
 
 GOOGLE_ANALYTICS_ID = env('GOOGLE_ANALYTICS_ID')
 USERVOICE_ID = env('USERVOICE_ID')
@@ -176,4 +192,7 @@ PORTFOLIYO_BASE_URL = env('PORTFOLIYO_BASE_URL')
 
 NOTIFICATION_EMAILS = env('PORTFOLIYO_NOTIFICATION_EMAILS', bool)
 NOTIFICATION_EXPIRY_SECONDS = env('PORTFOLIYO_NOTIFICATION_EXPIRY_SECONDS', int)
+if env('PORTFOLIYO_NOTIFICATION_DEBOUNCE_SECONDS'):
+    NOTIFICATION_DEBOUNCE_SECONDS = env(
+        'PORTFOLIYO_NOTIFICATION_DEBOUNCE_SECONDS', int)
 DEBUG_URLS = env('PORTFOLIYO_DEBUG_URLS', bool)
@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 
 from celery.utils.log import get_task_logger
+from django.conf import settings
 
 from portfoliyo.celery import celery, ModelTask
 
@@ -24,10 +25,52 @@ def send_sms(phone, source, body):
 
 @celery.task(ignore_result=True)
 def check_for_pending_notifications():
-    """Trigger notifications to all users with pending notifications."""
+    """Schedule notifications to all users with pending notifications."""
+    from portfoliyo.notifications import schedule
+    stats = schedule.dispatch_pending()
+    logger.info(
+        "Dispatched %(profiles)s pending profiles in %(chunks)s chunks "
+        "(%(scheduled)s newly scheduled; resumed: %(resumed)s).", stats)
+
+
+
+@celery.task(ignore_result=True)
+def send_scheduled_notifications():
+    """Send notification emails to all profiles whose scheduled send is due."""
+    from portfoliyo.notifications import schedule
+    while True:
+        profile_ids = schedule.pop_due(settings.NOTIFICATION_SEND_BATCH_SIZE)
+        if not profile_ids:
+            break
+        send_notification_emails.delay(profile_ids)
+
+
+
+@celery.task(ignore_result=True)
+def sweep_notifications():
+    """Prune expired pending notifications for all profiles."""
     from portfoliyo.notifications import store
-    for profile_id in store.pending_profile_ids():
-        send_notification_email.delay(profile_id)
+    stats = store.sweep()
+    logger.info(
+        "Swept pending notifications: checked %(checked)s profiles, "
+        "pruned %(pruned)s notifications, unpended %(unpended)s profiles.",
+        stats)
+
+
+
+@celery.task(ignore_result=True)
+def compact_redis():
+    """Compact stored unread state and log a Redis memory report."""
+    from portfoliyo import redis
+    from portfoliyo.model import unread
+    stats = unread.compact(settings.UNREAD_MAX_PER_VILLAGE)
+    logger.info(
+        "Compacted unread state: scanned %(scanned)s keys, "
+        "deleted %(deleted)s, trimmed %(trimmed)s posts.", stats)
+    for prefix, usage in sorted(redis.memory_report().items()):
+        logger.info(
+            "Redis memory: prefix=%s keys=%s bytes=%s",
+            prefix, usage['keys'], usage['bytes'])
 
 
 
@@ -39,7 +82,36 @@ def send_notification_email(profile_id):
 
 
 
-@celery.task(base=ModelTask, ignore_result=True)
+@celery.task(ignore_result=True)
+def send_notification_emails(profile_ids):
+    """
+    Send notification emails to given profile IDs over one connection.
+
+    Failed emails are scheduled again; all the profiles' claims (see
+    ``schedule.pop_due``) are then released.
+
+    """
+    from portfoliyo.notifications import render, schedule
+    stats = render.send_many(profile_ids)
+    logger.info(
+        "Sent %(sent)s notification emails (%(skipped)s skipped, "
+        "%(failed)s failed) in %(seconds).2f seconds.", stats)
+    schedule.schedule(stats['failed_profile_ids'])
+    schedule.release(profile_ids)
+
+
+
+@celery.task(
+    base=ModelTask,
+    ignore_result=True,
+    select_related={
+        # recording checks the recipient's user; post notifications need
+        # the post author
+        'users.profile': ['user'],
+        'village.post': ['author'],
+        'village.bulkpost': ['author'],
+        },
+    )
 def record_notification(name, *args, **kw):
     """Record a notification (to later be incorporated in an email)."""
     from portfoliyo.notifications import record
@@ -48,7 +120,11 @@ def record_notification(name, *args, **kw):
 
 
 
-@celery.task(ignore_result=True)
+@celery.task(
+    ignore_result=True,
+    dedupe=True,
+    batch_task='portfoliyo.tasks.push_events',
+    )
 def push_event(name, *args, **kw):
     """Send a Pusher event."""
     from portfoliyo.pusher import events
@@ -57,6 +133,23 @@ def push_event(name, *args, **kw):
 
 
 
+@celery.task(ignore_result=True)
+def push_events(calls):
+    """
+    Send many Pusher events; ``calls`` is a list of (args, kwargs) tuples.
+
+    Each is as for ``push_event``; a failure to send one event is logged and
+    doesn't prevent sending the rest.
+
+    """
+    for args, kw in calls:
+        try:
+            push_event(*args, **kw)
+        except Exception:
+            logger.exception("Failed to push event %r.", args[:1])
+
+
+
 @celery.task(ignore_result=True)
 def mixpanel(func, *args, **kw):
     """Record something in Mixpanel."""
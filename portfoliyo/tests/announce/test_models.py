@@ -1,6 +1,11 @@
 """Tests for announcement models."""
+import datetime
+import time
+
+import mock
+
 from portfoliyo.announce import models as announce
-from portfoliyo.tests import factories
+from portfoliyo.tests import factories, utils
 
 
 
@@ -28,3 +33,84 @@ def test_read_unread(db, redis):
 
     assert list(announce.get_unread(p1)) == [a2]
     assert list(announce.get_unread(p2)) == [a1, a2]
+
+
+
+def test_to_all_constant_redis_calls(db, redis):
+    """Announcing costs one Redis call regardless of number of users."""
+    for i in range(5):
+        factories.ProfileFactory.create(user__email='%s@example.com' % i)
+
+    with utils.assert_num_calls(redis, 1):
+        announce.to_all("Something is happening!")
+
+
+
+def test_new_users_do_not_see_old_announcements(db, redis):
+    """Announcements made before a user joined are not unread for them."""
+    a = announce.to_all("Something is happening!")
+    a.timestamp = a.timestamp - datetime.timedelta(days=1)
+    a.save()
+    p = factories.ProfileFactory.create(user__email='one@example.com')
+
+    assert announce.get_unread(p) == []
+
+
+
+def test_all_read_costs_at_most_one_redis_call(db, redis):
+    """Once all announcements are read, lookup is cached in-process."""
+    p = factories.ProfileFactory.create(user__email='one@example.com')
+    a1 = announce.to_all("Something is happening!")
+    a2 = announce.to_all("Something else is happening!")
+    announce.mark_read(p, a1.id)
+    announce.mark_read(p, a2.id)
+    # first lookup finds nothing unread and advances the watermark
+    assert announce.get_unread(p) == []
+
+    # dismissed-IDs set is cleared once the watermark passes it
+    assert redis.smembers(announce.make_dismissed_key(p.id)) == set()
+
+    # while local cache TTL is valid, no Redis calls or queries at all
+    with utils.assert_num_calls(redis, 0):
+        with utils.assert_num_queries(0):
+            assert announce.get_unread(p) == []
+
+    # after TTL, a single Redis call to check the version
+    later = time.time() + 3600
+    with mock.patch('portfoliyo.announce.models.time.time') as mock_time:
+        mock_time.return_value = later
+        with utils.assert_num_calls(redis, 1):
+            with utils.assert_num_queries(0):
+                assert announce.get_unread(p) == []
+
+
+
+def test_cache_invalidated_by_version_change(db, redis):
+    """A version bump (e.g. by another process) invalidates local cache."""
+    p = factories.ProfileFactory.create(user__email='one@example.com')
+    a1 = announce.to_all("Something is happening!")
+    assert announce.get_unread(p) == [a1]
+
+    # another process dismisses the announcement
+    redis.sadd(announce.make_dismissed_key(p.id), a1.id)
+    redis.incr(announce.VERSION_KEY)
+
+    # stale until TTL expires
+    assert announce.get_unread(p) == [a1]
+    later = time.time() + 3600
+    with mock.patch('portfoliyo.announce.models.time.time') as mock_time:
+        mock_time.return_value = later
+        assert announce.get_unread(p) == []
+
+
+
+def test_new_announcement_seen_after_all_read(db, redis):
+    """A new announcement is unread even after the watermark advanced."""
+    p = factories.ProfileFactory.create(user__email='one@example.com')
+    a1 = announce.to_all("Something is happening!")
+    announce.mark_read(p, a1.id)
+    assert announce.get_unread(p) == []
+
+    a2 = announce.to_all("Yet another thing is happening!")
+
+    assert announce.get_unread(p) == [a2]
@@ -63,6 +63,11 @@ def pytest_addoption(parser):
             "Requires REDIS_URL setting."
             ),
         )
+    parser.addoption(
+        '--bench-json',
+        metavar='PATH',
+        help="Write notification benchmark results to JSON file at PATH.",
+        )
 
 
 def pytest_generate_tests(metafunc):
@@ -127,8 +132,8 @@ def _redis_call_counts(request):
     server). This is at least a correct assumption for our usage.
 
     """
-    from redis import StrictRedis
-    sr = StrictRedis
+    from portfoliyo.redis import InstrumentedRedis
+    sr = InstrumentedRedis
     def _tracked_execute_command(self, *args, **kw):
         self.num_calls += 1
         return self._orig_exec(*args, **kw)
@@ -177,6 +182,22 @@ def _disable_redis(request):
 
 
 
+@pytest.fixture(autouse=True)
+def _clear_announcement_cache():
+    """Clear the per-process announcement cache before every test."""
+    from portfoliyo.announce import models
+    models.clear_cache()
+
+
+
+@pytest.fixture(autouse=True)
+def _clear_fragment_cache():
+    """Clear template fragments cached (via the cache tag) by earlier tests."""
+    from django.templatetags import cache
+    cache.cache.clear()
+
+
+
 @pytest.fixture
 def cache(request):
     """Enable the cache, clear it, and give test access to it."""
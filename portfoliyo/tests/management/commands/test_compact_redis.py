@@ -0,0 +1,55 @@
+from cStringIO import StringIO
+
+from django.core.management import call_command, CommandError
+import mock
+import pytest
+
+from portfoliyo.management.commands import compact_redis
+
+
+
+def test_compacts_and_reports(monkeypatch, settings):
+    settings.UNREAD_MAX_PER_VILLAGE = 5
+    mock_compact = mock.Mock()
+    mock_compact.return_value = {'scanned': 3, 'deleted': 1, 'trimmed': 2}
+    monkeypatch.setattr(compact_redis.unread, 'compact', mock_compact)
+    mock_report = mock.Mock()
+    mock_report.return_value = {'unread': {'keys': 3, 'bytes': 120}}
+    monkeypatch.setattr(compact_redis.redis, 'memory_report', mock_report)
+
+    mock_stdout = StringIO()
+    call_command('compact_redis', stdout=mock_stdout)
+
+    mock_compact.assert_called_once_with(5)
+    output = mock_stdout.getvalue()
+    assert 'deleted 1, trimmed 2 posts' in output
+    assert 'unread' in output and '120' in output
+
+
+def test_report_only(monkeypatch):
+    mock_compact = mock.Mock()
+    monkeypatch.setattr(compact_redis.unread, 'compact', mock_compact)
+    mock_report = mock.Mock()
+    mock_report.return_value = {}
+    monkeypatch.setattr(compact_redis.redis, 'memory_report', mock_report)
+
+    call_command('compact_redis', report_only=True, stdout=StringIO())
+
+    assert not mock_compact.called
+    mock_report.assert_called_once_with()
+
+
+def test_max_unread_option(monkeypatch):
+    mock_compact = mock.Mock()
+    mock_compact.return_value = {'scanned': 0, 'deleted': 0, 'trimmed': 0}
+    monkeypatch.setattr(compact_redis.unread, 'compact', mock_compact)
+
+    call_command('compact_redis', max_unread='10', verbosity=0)
+
+    mock_compact.assert_called_once_with(10)
+
+
+def test_bad_max_unread():
+    command = compact_redis.Command()
+    with pytest.raises(CommandError):
+        command.handle(max_unread='lots', verbosity=0)
@@ -0,0 +1,30 @@
+from cStringIO import StringIO
+
+from django.core.management import call_command
+
+
+
+def test_queue_depths(redis):
+    redis.lpush('realtime', 'a', 'b')
+    redis.lpush('realtime\x06\x163', 'c')
+    redis.lpush('analytics\x06\x169', 'd')
+
+    mock_stdout = StringIO()
+    call_command('queue_depths', stdout=mock_stdout)
+
+    lines = [l.split() for l in mock_stdout.getvalue().splitlines()]
+    assert lines == [
+        ['queue', 'tasks'],
+        ['analytics', '1'],
+        ['bulk', '0'],
+        ['realtime', '3'],
+        ]
+
+
+def test_queue_depths_some_queues(redis):
+    redis.lpush('bulk', 'a')
+
+    mock_stdout = StringIO()
+    call_command('queue_depths', 'bulk', stdout=mock_stdout)
+
+    assert mock_stdout.getvalue().splitlines()[1].split() == ['bulk', '1']
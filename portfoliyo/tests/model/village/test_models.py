@@ -327,11 +327,20 @@ class TestPostCreate(object):
         rel2 = factories.RelationshipFactory.create(
             to_profile=rel1.student)
 
-        target = 'portfoliyo.notifications.record.post'
-        with mock.patch(target) as mock_notify_post:
+        target = 'portfoliyo.notifications.record._record_many'
+        with mock.patch(target) as mock_record_many:
             post = models.Post.create(rel1.elder, rel1.student, "Hello")
 
-        mock_notify_post.assert_called_with(rel2.elder, post)
+        mock_record_many.assert_called_once_with(
+            [
+                (
+                    rel2.elder,
+                    'post',
+                    rel2.elder.notify_parent_text,
+                    {'post-id': post.id},
+                    ),
+                ]
+            )
 
 
     def test_can_prevent_notification(self, db):
@@ -507,6 +516,31 @@ class TestBulkPost(object):
         assert not unread.is_unread(sub, rel3.elder)
 
 
+    def test_marks_unread_in_one_batch(self, db):
+        """All sub-posts are marked unread in a single batched call."""
+        rel = factories.RelationshipFactory.create(
+            from_profile__user__email='foo@example.com')
+        rel2 = factories.RelationshipFactory.create(
+            from_profile__user__email='bar@example.com', to_profile=rel.student)
+        other_rel = factories.RelationshipFactory.create(
+            from_profile=rel.elder)
+        rel3 = factories.RelationshipFactory.create(
+            from_profile__user__email='baz@example.com',
+            to_profile=other_rel.student,
+            )
+        group = factories.GroupFactory.create(owner=rel.elder)
+        group.students.add(rel.student, other_rel.student)
+
+        target = 'portfoliyo.model.village.models.unread.mark_unread_many'
+        with mock.patch(target) as mock_mark_unread_many:
+            models.BulkPost.create(rel.elder, group, 'Foo')
+
+        assert mock_mark_unread_many.call_count == 1
+        pairs = mock_mark_unread_many.call_args[0][0]
+        assert {(p.student, e) for p, e in pairs} == {
+            (rel.student, rel2.elder), (other_rel.student, rel3.elder)}
+
+
     def test_all_students(self, db):
         """group=None sends to all author's students."""
         rel = factories.RelationshipFactory.create()
@@ -606,12 +640,21 @@ class TestBulkPost(object):
         group.elders.add(other)
         group.students.add(rel.student)
 
-        target = 'portfoliyo.notifications.record.bulk_post'
-        with mock.patch(target) as mock_notify_bulk_post:
+        target = 'portfoliyo.notifications.record._record_many'
+        with mock.patch(target) as mock_record_many:
             bulk_post = models.BulkPost.create(
                 rel.elder, group, "Hello")
 
-        mock_notify_bulk_post.assert_called_with(other, bulk_post)
+        mock_record_many.assert_called_once_with(
+            [
+                (
+                    other,
+                    'bulk post',
+                    other.notify_teacher_post,
+                    {'bulk-post-id': bulk_post.id},
+                    ),
+                ]
+            )
 
 
 class TestBasePost(object):
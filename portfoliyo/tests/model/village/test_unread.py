@@ -1,7 +1,13 @@
 """Tests for unread-counts management."""
+import datetime
+
+from django.utils.timezone import utc
+
+from portfoliyo import redis as redis_module
 from portfoliyo.model import unread
+from portfoliyo.redis import HashRing, InMemoryRedis
 
-from portfoliyo.tests import factories
+from portfoliyo.tests import factories, utils
 
 
 
@@ -36,6 +42,53 @@ def test_all_unread(db, redis):
 
 
 
+def test_mark_unread_many(db, redis):
+    """Can mark many posts unread by many profiles at once."""
+    post1 = factories.PostFactory.create()
+    post2 = factories.PostFactory.create(student=post1.student)
+    post3 = factories.PostFactory.create()
+    profile1 = factories.ProfileFactory.create()
+    profile2 = factories.ProfileFactory.create()
+
+    unread.mark_unread_many(
+        [(post1, profile1), (post2, profile1), (post3, profile2)])
+
+    assert unread.is_unread(post1, profile1)
+    assert unread.is_unread(post2, profile1)
+    assert not unread.is_unread(post3, profile1)
+    assert unread.is_unread(post3, profile2)
+    assert unread.unread_counts([post1.student], profile1) == {
+        post1.student: 2}
+
+
+
+def test_mark_unread_many_round_trips(db, redis):
+    """
+    Batch unread marking is O(1) Redis round-trips, not O(students x elders).
+
+    Marking one at a time costs a round-trip per (post, elder) pair; in a
+    batch it is one round-trip total.
+
+    """
+    posts = [factories.PostFactory.create() for i in range(10)]
+    elders = [factories.ProfileFactory.create() for i in range(3)]
+    pairs = [(post, elder) for post in posts for elder in elders]
+
+    with utils.assert_num_calls(redis, 1):
+        unread.mark_unread_many(pairs)
+
+    with utils.assert_num_calls(redis, 0):
+        unread.mark_unread_many([])
+
+    # already unread: ZADDs report no change, so no counts to increment
+    with utils.assert_num_calls(redis, 1):
+        unread.mark_unread_many(pairs)
+
+    assert unread.unread_counts([posts[0].student], elders[0]) == {
+        posts[0].student: 1}
+
+
+
 def test_mark_read(db, redis):
     """Can mark a post as read."""
     post = factories.PostFactory.create()
@@ -48,6 +101,20 @@ def test_mark_read(db, redis):
 
 
 
+def test_mark_read_after_village_read(db, redis):
+    """Marking read after the village was marked read leaves count at zero."""
+    post = factories.PostFactory.create()
+    profile = factories.ProfileFactory.create()
+    unread.mark_unread(post, profile)
+    unread.mark_village_read(post.student, profile)
+
+    with utils.assert_num_calls(redis, 1):
+        unread.mark_read(post, profile)
+
+    assert unread.unread_counts([post.student], profile) == {post.student: 0}
+
+
+
 def test_mark_village_read(db, redis):
     """Marks posts only in given village read."""
     post1 = factories.PostFactory.create()
@@ -66,6 +133,68 @@ def test_mark_village_read(db, redis):
 
 
 
+def test_timestamp_score_round_trip():
+    """Sorted-set scores convert back to the same aware datetime."""
+    ts = datetime.datetime(2013, 2, 3, 4, 5, 6, 789000, tzinfo=utc)
+
+    assert unread.score_timestamp(unread.timestamp_score(ts)) == ts
+
+
+
+def test_oldest_unread(db, redis):
+    """oldest_unread returns ID and timestamp of oldest unread post."""
+    rel = factories.RelationshipFactory.create()
+    posts = _posts_by_hour(rel.student, 3)
+    profile = rel.elder
+    assert unread.oldest_unread(rel.student, profile) is None
+
+    unread.mark_unread(posts[2], profile)
+    unread.mark_unread(posts[1], profile)
+
+    assert unread.oldest_unread(rel.student, profile) == (
+        str(posts[1].id), posts[1].timestamp)
+
+
+
+def test_unread_before(db, redis):
+    """Can page back through unread posts, newest first."""
+    rel = factories.RelationshipFactory.create()
+    posts = _posts_by_hour(rel.student, 5)
+    unread.mark_unread_many((post, rel.elder) for post in posts)
+
+    page = unread.unread_before(
+        rel.student, rel.elder, posts[4].timestamp, count=2)
+
+    assert page == [str(posts[3].id), str(posts[2].id)]
+    assert unread.unread_before(
+        rel.student, rel.elder, posts[2].timestamp) == [
+        str(posts[1].id), str(posts[0].id)]
+
+
+
+def test_unread_count_since(db, redis):
+    """Can count unread posts since a given time."""
+    rel = factories.RelationshipFactory.create()
+    posts = _posts_by_hour(rel.student, 4)
+    unread.mark_unread_many((post, rel.elder) for post in posts)
+
+    assert unread.unread_count_since(
+        rel.student, rel.elder, posts[1].timestamp) == 3
+
+
+
+def _posts_by_hour(student, num):
+    """Create ``num`` posts in student's village, an hour apart."""
+    return [
+        factories.PostFactory.create(
+            student=student,
+            timestamp=datetime.datetime(2013, 1, 25, i, tzinfo=utc),
+            )
+        for i in range(num)
+        ]
+
+
+
 def test_unread_count(db, redis):
     post1 = factories.PostFactory.create()
     factories.PostFactory.create(student=post1.student)
@@ -135,3 +264,120 @@ def test_group_unread_counts(db, redis):
 
     assert unread.group_unread_counts([groupa, groupb], profile) == {
         groupa: 2, groupb: 3}
+
+
+
+def test_unread_counts_not_skewed_by_repeat_marks(db, redis):
+    """Marking the same post unread/read twice only changes count once."""
+    post = factories.PostFactory.create()
+    post2 = factories.PostFactory.create(student=post.student)
+    profile = factories.ProfileFactory.create()
+    unread.mark_unread(post, profile)
+    unread.mark_unread(post, profile)
+    unread.mark_unread(post2, profile)
+    unread.mark_read(post2, profile)
+    unread.mark_read(post2, profile)
+
+    assert unread.unread_counts([post.student], profile) == {post.student: 1}
+
+
+
+def test_unread_counts_after_mark_village_read(db, redis):
+    """Marking a village read zeroes its unread count."""
+    post = factories.PostFactory.create()
+    other = factories.PostFactory.create()
+    profile = factories.ProfileFactory.create()
+    unread.mark_unread(post, profile)
+    unread.mark_unread(other, profile)
+
+    unread.mark_village_read(post.student, profile)
+
+    assert unread.unread_counts([post.student, other.student], profile) == {
+        post.student: 0, other.student: 1}
+
+
+
+def test_unread_counts_single_query(db, redis):
+    """Unread counts for any number of students cost one Redis query."""
+    posts = [factories.PostFactory.create() for i in range(3)]
+    profile = factories.ProfileFactory.create()
+    for post in posts:
+        unread.mark_unread(post, profile)
+
+    with utils.assert_num_calls(redis, 1):
+        counts = unread.unread_counts([p.student for p in posts], profile)
+
+    assert counts == {p.student: 1 for p in posts}
+
+
+
+def test_group_unread_counts_queries(db, redis):
+    """Group counts take one Redis query and one DB query for membership."""
+    groups = []
+    profile = factories.ProfileFactory.create()
+    for i in range(3):
+        post = factories.PostFactory.create()
+        group = factories.GroupFactory.create()
+        group.students.add(post.student)
+        unread.mark_unread(post, profile)
+        groups.append(group)
+
+    with utils.assert_num_calls(redis, 1):
+        with utils.assert_num_queries(1):
+            counts = unread.group_unread_counts(groups, profile)
+
+    assert counts == {g: 1 for g in groups}
+
+
+
+def test_compact_drops_stale_keys(db, redis):
+    """Compaction drops unread state for deleted relationships."""
+    rel = factories.RelationshipFactory.create()
+    stale_rel = factories.RelationshipFactory.create(from_profile=rel.elder)
+    post = factories.PostFactory.create(student=rel.student)
+    stale_post = factories.PostFactory.create(student=stale_rel.student)
+    unread.mark_unread(post, rel.elder)
+    unread.mark_unread(stale_post, rel.elder)
+    stale_rel.delete()
+
+    stats = unread.compact()
+
+    assert stats == {'scanned': 2, 'deleted': 1, 'trimmed': 0}
+    assert unread.is_unread(post, rel.elder)
+    assert not unread.is_unread(stale_post, rel.elder)
+    assert redis.hgetall(unread.make_counts_key(rel.elder)) == {
+        str(rel.student.id): '1'}
+
+
+
+def test_compact_trims_to_newest(db, redis):
+    """Compaction keeps only the newest ``max_unread`` unread posts."""
+    rel = factories.RelationshipFactory.create()
+    posts = _posts_by_hour(rel.student, 5)
+    unread.mark_unread_many((post, rel.elder) for post in posts)
+
+    stats = unread.compact(max_unread=2, batch_size=1)
+
+    assert stats == {'scanned': 1, 'deleted': 0, 'trimmed': 3}
+    assert unread.all_unread(rel.student, rel.elder) == {
+        str(posts[3].id), str(posts[4].id)}
+    assert unread.unread_counts([rel.student], rel.elder) == {rel.student: 2}
+
+
+
+def test_sharded_by_profile(db, redis, monkeypatch):
+    """With sharded unread role, each profile's state is on one shard."""
+    shards = {'a': InMemoryRedis(), 'b': InMemoryRedis()}
+    monkeypatch.setattr(
+        redis_module, '_role_clients', {'unread': HashRing(shards)})
+    post = factories.PostFactory.create()
+    profiles = [factories.ProfileFactory.create() for i in range(6)]
+
+    unread.mark_unread_many((post, profile) for profile in profiles)
+
+    for profile in profiles:
+        shard = redis_module.get_client('unread', shard_key=profile.id)
+        assert shard.zcard(unread.make_key(post.student, profile)) == 1
+        assert unread.unread_counts([post.student], profile) == {
+            post.student: 1}
+    assert not redis.data
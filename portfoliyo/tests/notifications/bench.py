@@ -0,0 +1,231 @@
+"""
+Notification pipeline benchmark harness.
+
+Builds a synthetic school (teachers, students, parents, posts and bulk posts),
+stores a configurable mix of pending notifications for a teacher through
+``notifications.store``, then times ``render.render`` and ``render.send``
+while counting SQL queries and Redis round-trips.
+
+Needs a test database and Redis (e.g. the ``db`` and ``redis`` fixtures);
+``test_budgets`` runs it and enforces query and Redis budgets. To record the
+results as JSON, for tracking regressions over time, run::
+
+    py.test portfoliyo/tests/notifications/test_budgets.py --bench-json=out.json
+
+"""
+from contextlib import contextmanager
+import json
+import time
+
+from django.db import connection
+
+from portfoliyo import redis
+from portfoliyo.notifications import render, store, types
+from portfoliyo.tests import factories
+
+
+
+# pending notifications of each type per unit of backlog
+DEFAULT_MIX = {
+    types.POST: 5,
+    types.BULK_POST: 2,
+    types.NEW_PARENT: 1,
+    types.ADDED_TO_VILLAGE: 1,
+    types.NEW_TEACHER: 1,
+    }
+
+
+
+class Counts(object):
+    """SQL queries, Redis round-trips and wall time within a ``counting``."""
+    def __init__(self):
+        self.queries = 0
+        self.redis_calls = 0
+        self.redis_commands = 0
+        self.seconds = 0.0
+
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'redis_calls': self.redis_calls,
+            'redis_commands': self.redis_commands,
+            'seconds': self.seconds,
+            }
+
+
+
+@contextmanager
+def counting():
+    """Context manager: count queries, Redis usage and time; yield ``Counts``."""
+    counts = Counts()
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start_queries = len(connection.queries)
+    stats = redis.start_stats('bench')
+    start = time.time()
+    try:
+        yield counts
+    finally:
+        counts.seconds = time.time() - start
+        redis.stop_stats(stats)
+        counts.queries = len(connection.queries) - start_queries
+        counts.redis_calls = stats.calls
+        counts.redis_commands = stats.commands
+        connection.use_debug_cursor = old_debug_cursor
+
+
+
+class School(object):
+    """
+    A synthetic school.
+
+    Every teacher is in every student's village; each student has
+    ``parents`` parents. Each teacher has a group of all students. Needs at
+    least two teachers, so some notifications can come from another teacher.
+
+    """
+    def __init__(self, teachers=2, students=5, parents=2):
+        self.school = factories.SchoolFactory.create()
+        self.teachers = [
+            factories.ProfileFactory.create(
+                school=self.school,
+                school_staff=True,
+                name='Teacher %s' % i,
+                user__email='teacher%s-%s@example.com' % (
+                    self.school.id, i),
+                user__is_active=True,
+                )
+            for i in range(teachers)
+            ]
+        self.students = []
+        self.parents = {}
+        for i in range(students):
+            student = factories.ProfileFactory.create(
+                school=self.school, name='Student %s' % i)
+            self.students.append(student)
+            for teacher in self.teachers:
+                factories.RelationshipFactory.create(
+                    from_profile=teacher, to_profile=student)
+            self.parents[student] = [
+                factories.RelationshipFactory.create(
+                    from_profile__school=self.school,
+                    from_profile__name='Parent %s-%s' % (i, j),
+                    to_profile=student,
+                    description='Mother',
+                    )
+                for j in range(parents)
+                ]
+        self.groups = {}
+        for teacher in self.teachers:
+            group = factories.GroupFactory.create(
+                owner=teacher, name='%s class' % teacher.name)
+            group.students.add(*self.students)
+            self.groups[teacher] = group
+
+
+    def store_backlog(self, recipient, mix=None, backlog=1):
+        """
+        Create posts etc and store pending notifications for ``recipient``.
+
+        ``mix`` maps notification type to number of notifications per unit of
+        ``backlog`` (default ``DEFAULT_MIX``). All notifications are
+        triggering. Return total number of notifications stored.
+
+        """
+        mix = DEFAULT_MIX if mix is None else mix
+        others = [t for t in self.teachers if t != recipient]
+        notifications = []
+        for name, count in mix.items():
+            for i in range(count * backlog):
+                student = self.students[i % len(self.students)]
+                data = getattr(self, '_make_%s' % name.replace(' ', '_'))(
+                    recipient, others[i % len(others)], student)
+                notifications.append((recipient.id, name, True, data))
+        store.store_batch(notifications)
+        return len(notifications)
+
+
+    def _make_post(self, recipient, other, student):
+        rel = self.parents[student][0]
+        post = factories.PostFactory.create(
+            author=rel.elder,
+            student=student,
+            relationship=rel,
+            original_text='A message from %s.' % rel.elder.name,
+            html_text='A message from %s.' % rel.elder.name,
+            )
+        return {'post-id': post.id}
+
+
+    def _make_bulk_post(self, recipient, other, student):
+        group = self.groups[other]
+        bulk_post = factories.BulkPostFactory.create(
+            author=other,
+            group=group,
+            original_text='To the whole class.',
+            html_text='To the whole class.',
+            )
+        for s in self.students:
+            factories.PostFactory.create(
+                author=other,
+                student=s,
+                from_bulk=bulk_post,
+                original_text=bulk_post.original_text,
+                html_text=bulk_post.html_text,
+                )
+        return {'bulk-post-id': bulk_post.id}
+
+
+    def _make_new_parent(self, recipient, other, student):
+        signup = factories.TextSignupFactory.create(
+            family=self.parents[student][-1].elder,
+            student=student,
+            teacher=recipient,
+            state='done',
+            )
+        return {'signup-id': signup.id}
+
+
+    def _make_added_to_village(self, recipient, other, student):
+        return {'added-by-id': other.id, 'student-id': student.id}
+
+
+    def _make_new_teacher(self, recipient, other, student):
+        return {'teacher-id': other.id, 'student-id': student.id}
+
+
+
+def run(backlog=1, mix=None, **school_kw):
+    """
+    Benchmark rendering and sending one teacher's notifications.
+
+    ``backlog`` and ``mix`` are as for ``School.store_backlog``; other keyword
+    arguments are passed to ``School``. Return a dictionary of results, with
+    ``render`` and ``send`` counts.
+
+    """
+    school = School(**school_kw)
+    recipient = school.teachers[0]
+    num = school.store_backlog(recipient, mix=mix, backlog=backlog)
+
+    with counting() as render_counts:
+        render.render(recipient, clear=False)
+    with counting() as send_counts:
+        sent = render.send(recipient.id)
+    assert sent, "Benchmark email was not sent."
+
+    return {
+        'backlog': backlog,
+        'notifications': num,
+        'school': school_kw,
+        'render': render_counts.as_dict(),
+        'send': send_counts.as_dict(),
+        }
+
+
+
+def write_json(results, path):
+    """Write list of ``run`` results to JSON file at ``path``."""
+    with open(path, 'w') as fh:
+        json.dump({'results': results}, fh, indent=2, sort_keys=True)
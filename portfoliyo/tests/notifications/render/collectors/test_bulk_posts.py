@@ -14,3 +14,19 @@ def test_not_visible(db):
 
     with pytest.raises(bulk_posts.base.RehydrationFailed):
         bpc.hydrate({'bulk-post-id': bp.id})
+
+
+
+def test_fragment_key(db):
+    """Fragment key differs only if the rendering would."""
+    rel = factories.RelationshipFactory.create()
+    bp = factories.BulkPostFactory.create(author=rel.elder)
+    others = [factories.ProfileFactory.create() for i in range(2)]
+
+    def _key(recipient):
+        village_set = bulk_posts.VillageSet([rel.student], recipient)
+        village_set.add(bp)
+        return village_set.fragment_key
+
+    assert _key(others[0]) == _key(others[1])
+    assert _key(rel.elder) != _key(others[0])
@@ -2,7 +2,7 @@
 import mock
 import pytest
 
-from portfoliyo.tests import factories
+from portfoliyo.tests import factories, utils
 
 from portfoliyo.notifications.render.collectors import new_parent
 
@@ -16,6 +16,27 @@ class TestSignup(object):
         assert signup.role == 'Foo'
 
 
+    def test_from_textsignups_num_queries(self, db):
+        """Relationships for a list of signups are looked up in one query."""
+        rels = [
+            factories.RelationshipFactory.create(description='Dad'),
+            factories.RelationshipFactory.create(description='Mom'),
+            ]
+        signups = [
+            factories.TextSignupFactory.create(
+                family=rel.elder, student=rel.student)
+            for rel in rels
+            ]
+        signups.append(factories.TextSignupFactory.create(family__role='Foo'))
+        for ts in signups:
+            ts.family, ts.student, ts.group
+
+        with utils.assert_num_queries(1):
+            result = new_parent.Signup.from_textsignups(signups)
+
+        assert [s.role for s in result] == ['Dad', 'Mom', 'Foo']
+
+
 
 class TestNewParentCollector(object):
     def test_no_student(self, db):
@@ -0,0 +1,133 @@
+"""Tests for PostCollector and related classes."""
+from datetime import timedelta
+
+from django.utils import timezone
+import mock
+
+from portfoliyo import serializers
+from portfoliyo.notifications.render.collectors import posts
+from portfoliyo.tests import factories, utils
+
+
+
+def _post(student, hours_ago, **kw):
+    """Create a post in ``student`` village, ``hours_ago`` hours old."""
+    return factories.PostFactory.create(
+        student=student,
+        timestamp=timezone.now() - timedelta(hours=hours_ago),
+        **kw)
+
+
+
+def test_latest_posts(db):
+    """Returns latest ``count`` non-excluded posts per village, newest first."""
+    rel1 = factories.RelationshipFactory.create()
+    rel2 = factories.RelationshipFactory.create()
+    p1 = [_post(rel1.student, h, author=rel1.elder) for h in [4, 1, 3, 2]]
+    p2 = [_post(rel2.student, h, author=rel2.elder) for h in [2, 1]]
+    factories.PostFactory.create()
+
+    latest = posts.latest_posts(
+        [rel1.student, rel2.student], exclude_ids=[p1[1].id], count=2)
+
+    assert latest == {
+        rel1.student.id: [p1[3], p1[2]],
+        rel2.student.id: [p2[1], p2[0]],
+        }
+
+
+
+def test_latest_posts_no_window_functions(db, monkeypatch):
+    """Without window functions, returns the same posts (query per village)."""
+    monkeypatch.setattr(posts, '_has_window_functions', lambda: False)
+    rel1 = factories.RelationshipFactory.create()
+    rel2 = factories.RelationshipFactory.create()
+    p1 = [_post(rel1.student, h, author=rel1.elder) for h in [4, 1, 3, 2]]
+    p2 = [_post(rel2.student, h, author=rel2.elder) for h in [2, 1]]
+
+    latest = posts.latest_posts(
+        [rel1.student, rel2.student], exclude_ids=[p1[1].id], count=2)
+
+    assert latest == {
+        rel1.student.id: [p1[3], p1[2]],
+        rel2.student.id: [p2[1], p2[0]],
+        }
+
+
+
+def test_context_posts_batch_num_queries(db):
+    """Context posts for a batch of villages take two queries in all."""
+    batch = []
+    authors = {}
+    for i in range(3):
+        rel = factories.RelationshipFactory.create(
+            description='Dad', from_profile__name='Dad %s' % i)
+        for h in range(3):
+            _post(rel.student, h, author=rel.elder, relationship=rel)
+        batch.append(posts.Village(rel.student, batch=batch))
+        authors[rel.student] = rel.elder.name
+
+    # latest posts (with authors and relationships), then attachments
+    with utils.assert_num_queries(2):
+        for village in batch:
+            assert [p['author'] for p in village.context_posts] == [
+                authors[village.student]] * 3
+            assert village.context_posts[0]['role'] == 'Dad'
+
+
+
+def test_context_posts_old(db):
+    """If all recent posts are old, only one is used for context."""
+    rel = factories.RelationshipFactory.create()
+    _post(rel.student, 50, author=rel.elder)
+    old = _post(rel.student, 60, author=rel.elder)
+    village = posts.Village(rel.student)
+
+    assert [p['post_id'] for p in village.context_posts] == [old.id]
+
+
+
+def test_fragment_key(db):
+    """Fragment key changes if the post's author name or role changes."""
+    post = factories.PostFactory.create(
+        author__name='Someone', author__role='Dad')
+    key = posts.fragment_key(post)
+
+    assert posts.fragment_key(post) == key
+
+    post.author.name = 'Someone Else'
+    renamed_key = posts.fragment_key(post)
+    post.author.role = 'Mom'
+
+    assert renamed_key != key
+    assert posts.fragment_key(post) not in [key, renamed_key]
+
+
+
+def test_fragment_key_date(db):
+    """Fragment key changes with the date its timestamp is displayed on."""
+    post = factories.PostFactory.create()
+    key = posts.fragment_key(post)
+    tomorrow = serializers.now() + timedelta(days=1)
+
+    with mock.patch.object(serializers, 'now', return_value=tomorrow):
+        assert posts.fragment_key(post) != key
+
+
+
+def test_serialized_post_lazy(db):
+    """A SerializedPost is only serialized when a rendered field is needed."""
+    post = factories.PostFactory.create(author__name='Someone')
+
+    with mock.patch.object(
+            serializers, 'post2dict', wraps=serializers.post2dict) as mock_s:
+        data = posts.SerializedPost(post, new=True)
+        assert data['post_id'] == post.id
+        assert data['author_id'] == post.author_id
+        assert data['new']
+        assert data['fragment_key'] == posts.fragment_key(post)
+        assert not mock_s.called
+
+        assert data['author'] == 'Someone'
+        assert data['plain_text'] == post.original_text
+        assert mock_s.call_count == 1
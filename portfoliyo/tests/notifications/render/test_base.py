@@ -3,13 +3,16 @@ from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.core import mail
+from django.core.cache.backends.locmem import LocMemCache
+from django.templatetags import cache as cache_tags
 from django.core.urlresolvers import reverse
 from django.test import html
 from django.utils import timezone
 import mock
 import pytest
 
-from portfoliyo.notifications import record
+from portfoliyo import serializers
+from portfoliyo.notifications import record, store
 from portfoliyo.notifications.render import base
 from portfoliyo.tests import factories
 
@@ -33,25 +36,16 @@ def recip(request, db, redis):
         prefs = params.get('prefs', {})
         kw.update(prefs)
 
-    # Temporarily patch the ``send_notification_email`` task to do nothing; we
-    # want to trigger the actual email-sending ourselves in these tests.
-    patcher = mock.patch('portfoliyo.tasks.send_notification_email')
+    # Temporarily patch CSS inlining to be a no-op; our tests assert against
+    # the HTML that's in the templates, not as mangled by inlining.
+    def mock_inline(html, **kw):
+        return html
+
+    patcher = mock.patch(
+        'portfoliyo.notifications.render.inline.inline', mock_inline)
     patcher.start()
     request.addfinalizer(patcher.stop)
 
-    # Temporarily patch premailer to be a no-op; our tests assert against the
-    # HTML that's in the templates, not as mangled by premailer.
-    class mock_Premailer(object):
-        def __init__(self, html, **kw):
-            self.html = html
-
-        def transform(self):
-            return self.html
-
-    patcher2 = mock.patch('premailer.Premailer', mock_Premailer)
-    patcher2.start()
-    request.addfinalizer(patcher2.stop)
-
     return factories.ProfileFactory.create(**kw)
 
 
@@ -1080,3 +1074,159 @@ class TestSend(object):
         assert base.send(recip.id)
         self.assert_multi_email(
             params['subject'], params['html'], params['text'], context)
+
+
+
+class TestFragmentCache(object):
+    def test_bulk_post_rendered_once(self, recip, monkeypatch):
+        """Co-recipients of a bulk post share its rendered village set."""
+        cache = LocMemCache('fragments', {})
+        monkeypatch.setattr(cache_tags, 'cache', cache)
+        other = factories.ProfileFactory.create(
+            user__email='bar@example.com', user__is_active=True)
+        teacher = factories.ProfileFactory.create(
+            school_staff=True, name='Teach1')
+        group = factories.GroupFactory.create(owner=teacher)
+        for i in range(2):
+            rel = factories.RelationshipFactory.create(
+                from_profile=recip, to_profile__name='St%s' % i)
+            factories.RelationshipFactory.create(
+                from_profile=other, to_profile=rel.student)
+            group.students.add(rel.student)
+        bulk_post = factories.BulkPostFactory.create(
+            author=teacher, group=group, html_text='hello')
+        for student in group.students.all():
+            factories.PostFactory.create(
+                author=teacher, student=student, from_bulk=bulk_post)
+        record.bulk_post(recip, bulk_post)
+        record.bulk_post(other, bulk_post)
+
+        with mock.patch.object(cache, 'set', wraps=cache.set) as mock_set:
+            with mock.patch.object(
+                    serializers, 'post2dict',
+                    wraps=serializers.post2dict) as mock_serialize:
+                base.send_many([recip.id, other.id])
+
+        fragments = [c[0][0] for c in mock_set.call_args_list]
+        assert len(fragments) == len(set(fragments)) == 4
+        # only the first recipient's cache misses serialize the bulk post
+        assert mock_serialize.call_count == 1
+        assert [m.body for m in mail.outbox][0] == mail.outbox[1].body
+
+
+
+class TestSendMany(object):
+    def _notify(self, recip):
+        rel = factories.RelationshipFactory.create(from_profile=recip)
+        other_rel = factories.RelationshipFactory.create(
+            to_profile=rel.student)
+        record.added_to_village(recip, other_rel.elder, rel.student)
+
+
+    def test_send_many(self, recip):
+        """Sends all emails over one connection; skips those with nothing."""
+        other = factories.ProfileFactory.create(
+            user__email='bar@example.com', user__is_active=True)
+        nothing = factories.ProfileFactory.create(
+            user__email='baz@example.com', user__is_active=True)
+        self._notify(recip)
+        self._notify(other)
+
+        target = 'portfoliyo.notifications.render.base.mail.get_connection'
+        with mock.patch(target, wraps=mail.get_connection) as mock_get_conn:
+            stats = base.send_many([recip.id, nothing.id, other.id])
+
+        assert mock_get_conn.call_count == 1
+        assert [m.to for m in mail.outbox] == [
+            ['foo@example.com'], ['bar@example.com']]
+        assert (stats['sent'], stats['skipped'], stats['failed']) == (2, 1, 0)
+        assert stats['seconds'] >= 0
+
+
+    def test_send_many_partial_failure(self, recip):
+        """A failed send is counted, and the connection re-opened."""
+        other = factories.ProfileFactory.create(
+            user__email='bar@example.com', user__is_active=True)
+        self._notify(recip)
+        self._notify(other)
+        connection = mock.Mock()
+        connection.send_messages.side_effect = [Exception("oops"), 1]
+
+        target = 'portfoliyo.notifications.render.base.mail.get_connection'
+        with mock.patch(target) as mock_get_conn:
+            mock_get_conn.return_value = connection
+            stats = base.send_many([recip.id, other.id])
+
+        assert (stats['sent'], stats['skipped'], stats['failed']) == (1, 0, 1)
+        assert stats['failed_profile_ids'] == [recip.id]
+        assert connection.send_messages.call_count == 2
+        assert connection.open.call_count == 2
+        assert connection.close.call_count == 2
+        # the failed email's notifications are left pending
+        assert store.pending_profile_ids() == set([str(recip.id)])
+
+
+    def test_send_many_open_failure(self, recip):
+        """If the connection can't be opened, all are counted as failed."""
+        self._notify(recip)
+        connection = mock.Mock()
+        connection.open.side_effect = Exception("down")
+
+        target = 'portfoliyo.notifications.render.base.mail.get_connection'
+        with mock.patch(target) as mock_get_conn:
+            mock_get_conn.return_value = connection
+            stats = base.send_many([recip.id, recip.id + 1])
+
+        assert (stats['sent'], stats['skipped'], stats['failed']) == (0, 0, 2)
+        assert not connection.send_messages.called
+        assert store.pending_profile_ids() == set([str(recip.id)])
+
+
+    def test_send_many_reopen_failure(self, recip):
+        """If re-opening fails, the rest are counted as failed, not sent."""
+        others = [
+            factories.ProfileFactory.create(
+                user__email='%s@example.com' % i, user__is_active=True)
+            for i in range(2)
+            ]
+        for profile in [recip] + others:
+            self._notify(profile)
+        connection = mock.Mock()
+        connection.open.side_effect = [None, Exception("down")]
+        connection.send_messages.side_effect = Exception("oops")
+
+        target = 'portfoliyo.notifications.render.base.mail.get_connection'
+        with mock.patch(target) as mock_get_conn:
+            mock_get_conn.return_value = connection
+            stats = base.send_many([recip.id] + [p.id for p in others])
+
+        assert (stats['sent'], stats['skipped'], stats['failed']) == (0, 0, 3)
+        assert stats['failed_profile_ids'] == [recip.id] + [
+            p.id for p in others]
+        assert connection.send_messages.call_count == 1
+        assert store.pending_profile_ids() == set(
+            str(p.id) for p in [recip] + others)
+
+
+    def test_send_many_render_failure(self, recip):
+        """A failed render is counted and logged; others are still sent."""
+        other = factories.ProfileFactory.create(
+            user__email='bar@example.com', user__is_active=True)
+        self._notify(recip)
+        self._notify(other)
+
+        real_render = base._render
+
+        def render(collection):
+            if collection.profile == recip:
+                raise ValueError("oops")
+            return real_render(collection)
+
+        target = 'portfoliyo.notifications.render.base._render'
+        logger = 'portfoliyo.notifications.render.base.logger'
+        with mock.patch(target, render):
+            with mock.patch(logger) as mock_logger:
+                stats = base.send_many([recip.id, other.id])
+
+        assert (stats['sent'], stats['skipped'], stats['failed']) == (1, 0, 1)
+        assert mock_logger.exception.call_count == 1
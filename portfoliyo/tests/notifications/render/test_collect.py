@@ -2,16 +2,19 @@ import contextlib
 
 import mock
 
-from portfoliyo.notifications import types
+from portfoliyo.notifications import store, types
 from portfoliyo.notifications.render import collect
+from portfoliyo.tests import factories, utils
 
 
 @contextlib.contextmanager
 def mock_store(notification_data):
-    get_all = 'portfoliyo.notifications.store.get_all'
-    with mock.patch(get_all) as mock_get_all:
-        mock_get_all.return_value = notification_data
-        yield
+    target = 'portfoliyo.notifications.store.%s'
+    with mock.patch(target % 'pending_ids') as mock_pending_ids:
+        with mock.patch(target % 'get_data') as mock_get_data:
+            mock_pending_ids.return_value = range(len(notification_data))
+            mock_get_data.return_value = notification_data
+            yield
 
 
 
@@ -37,12 +40,13 @@ class TestNotificationCollection(object):
             assert not collection
 
 
-    def test_context(self):
+    def test_context(self, monkeypatch):
         """Accessing context attr forces hydration."""
         def fake_hydrate(self_):
             self_._hydrated = True
             self_._context = {'foo': 'bar'}
-        collect.NotificationCollection._hydrate = fake_hydrate
+        monkeypatch.setattr(
+            collect.NotificationCollection, '_hydrate', fake_hydrate)
 
         collection = collect.NotificationCollection(mock.Mock())
 
@@ -51,3 +55,118 @@ class TestNotificationCollection(object):
 
         assert collection.context == {'foo': 'bar'}
         assert collection._hydrated
+
+
+
+    def test_post_hydration_queries(self, db, redis):
+        """Post notifications are rehydrated in a fixed number of queries."""
+        profile = factories.ProfileFactory.create()
+        for i in range(2):
+            rel = factories.RelationshipFactory.create(from_profile=profile)
+            for j in range(3):
+                post = factories.PostFactory.create(
+                    student=rel.student, relationship=rel, author=rel.elder)
+                store.store(profile.id, types.POST, data={'post-id': post.id})
+        collection = collect.NotificationCollection(profile)
+        collection.notification_data
+
+        # posts (with author, student, relationship), then attachments
+        with utils.assert_num_queries(2):
+            collectors = collection.collectors
+
+        assert len(collectors[types.POST].notifications) == 6
+
+
+    def test_bulk_post_hydration_queries(self, db, redis):
+        """Bulk-post notifications take one query for all visible posts."""
+        rel = factories.RelationshipFactory.create()
+        other_rel = factories.RelationshipFactory.create(
+            from_profile=rel.elder)
+        group = factories.GroupFactory.create(owner=rel.elder)
+        group.students.add(rel.student, other_rel.student)
+        for i in range(3):
+            bp = factories.BulkPostFactory.create(group=group)
+            for student in [rel.student, other_rel.student]:
+                factories.PostFactory.create(from_bulk=bp, student=student)
+            store.store(
+                rel.elder.id, types.BULK_POST, data={'bulk-post-id': bp.id})
+        collection = collect.NotificationCollection(rel.elder)
+        collection.notification_data
+
+        # bulk posts (with authors), then visible triggered posts
+        with utils.assert_num_queries(2):
+            collectors = collection.collectors
+
+        assert len(collectors[types.BULK_POST].notifications) == 3
+
+
+    def test_bulk_post_switch_type_queries(self, db, redis):
+        """Bulk posts seen in one village become posts without more queries."""
+        rel = factories.RelationshipFactory.create(
+            from_profile__name='Teacher')
+        factories.RelationshipFactory.create(to_profile=rel.student)
+        group = factories.GroupFactory.create(owner=rel.elder)
+        group.students.add(rel.student)
+        for i in range(3):
+            bp = factories.BulkPostFactory.create(
+                group=group, author=rel.elder)
+            factories.PostFactory.create(
+                from_bulk=bp,
+                student=rel.student,
+                author=rel.elder,
+                relationship=rel,
+                )
+            store.store(
+                rel.elder.id, types.BULK_POST, data={'bulk-post-id': bp.id})
+        collection = collect.NotificationCollection(rel.elder)
+        collection.notification_data
+
+        # bulk posts (with authors), visible triggered posts (with
+        # relationships), then their attachments; serializing the switched
+        # posts needs no more queries
+        with utils.assert_num_queries(3):
+            collectors = collection.collectors
+
+        assert types.BULK_POST not in collectors
+        village = collection.context['villages'][0]
+        assert [p['author'] for p in village.new_posts] == ['Teacher'] * 3
+
+
+    def test_failed_rehydration_reported(self, db):
+        """Each notification that fails rehydration is logged."""
+        logger = 'portfoliyo.notifications.render.collect.logger'
+        profile = factories.ProfileFactory.create()
+        collection = collect.NotificationCollection(profile)
+        data = [
+            {'name': types.POST, 'post-id': '0'},
+            {'name': types.POST, 'post-id': 'foo'},
+            ]
+        with mock.patch(logger) as mock_logger:
+            with mock_store(data):
+                assert not collection
+
+        assert mock_logger.info.call_count == 2
+
+
+    def test_deleted_objects_not_queried_again(self, db, redis):
+        """Notifications for deleted objects fail without a query apiece."""
+        logger = 'portfoliyo.notifications.render.collect.logger'
+        rel = factories.RelationshipFactory.create()
+        post = factories.PostFactory.create(
+            student=rel.student, relationship=rel, author=rel.elder)
+        store.store(rel.elder.id, types.POST, data={'post-id': post.id})
+        for i in range(3):
+            deleted = factories.PostFactory.create(
+                student=rel.student, relationship=rel, author=rel.elder)
+            store.store(rel.elder.id, types.POST, data={'post-id': deleted.id})
+            deleted.delete()
+        collection = collect.NotificationCollection(rel.elder)
+        collection.notification_data
+
+        # posts (with author, student, relationship), then attachments
+        with mock.patch(logger) as mock_logger:
+            with utils.assert_num_queries(2):
+                collectors = collection.collectors
+
+        assert len(collectors[types.POST].notifications) == 1
+        assert mock_logger.info.call_count == 3
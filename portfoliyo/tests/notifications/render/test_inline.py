@@ -0,0 +1,132 @@
+import mock
+import premailer
+
+from portfoliyo.notifications import record
+from portfoliyo.notifications.render import base, inline
+from portfoliyo.tests import factories
+
+
+
+HTML = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<style type="text/css">
+/* comment */
+h1, h2 {color: #555555 !important;}
+p {font-size:14px; margin: 0;}
+a:link { color: #e3002a; }
+.post {padding:1em; border-bottom:1px solid #dddddd;}
+h2 + .post {border-top:1px solid #dddddd;}
+.mine {background-color:#ffffff;}
+.new {background-color:#fde5e5;}
+.date {width:125px; text-align:right;}
+</style>
+</head>
+<body>
+<h2>A village:</h2>
+<table class="post mine new" style="table-layout:fixed;">
+<!--inline-fragment--><tbody><tr><td>
+  <table class="date"><tbody><tr><td>today</td></tr></tbody></table>
+  <p>Some <a href="/village/1/">text</a>.</p>
+  <img src="/static/foo.png" />
+</td></tr></tbody><!--/inline-fragment-->
+</table>
+<table class="post">
+<!--inline-fragment--><tbody><tr><td>
+  <p style="margin: 1px">More</p>
+</td></tr></tbody><!--/inline-fragment-->
+</table>
+</body>
+</html>
+"""
+
+
+
+def test_same_as_premailer():
+    """Output matches that of premailer, without fragment markers."""
+    expected = premailer.Premailer(
+        inline.unmarked(HTML), base_url='http://example.com', output_xhtml=True
+        ).transform()
+
+    assert inline.inline(HTML, base_url='http://example.com') == expected
+    # and again, with cached fragment
+    assert inline.inline(HTML, base_url='http://example.com') == expected
+
+
+def test_no_base_url():
+    """Without a base URL, links are left alone."""
+    expected = premailer.Premailer(
+        inline.unmarked(HTML), output_xhtml=True).transform()
+
+    assert inline.inline(HTML) == expected
+
+
+def test_no_fragments():
+    """HTML without fragment markers is inlined as a whole."""
+    html = inline.unmarked(HTML)
+    expected = premailer.Premailer(html, output_xhtml=True).transform()
+
+    assert inline.inline(html) == expected
+
+
+def test_fragments_inlined_once(monkeypatch):
+    """Fragments are inlined together, once; later only the rest is."""
+    monkeypatch.setattr(inline, '_inlined', {})
+    with mock.patch.object(
+            inline, '_transform', wraps=inline._transform) as mock_transform:
+        inline.inline(HTML)
+        inline.inline(HTML)
+
+    transformed = [c[0][0] for c in mock_transform.call_args_list]
+    assert len(transformed) == 3
+    assert transformed[1].count(inline.FRAGMENT_START) == 2
+    assert 'class="date"' not in transformed[2]
+
+
+def test_fragment_cache_bounded(monkeypatch):
+    """Inlined fragment cache is cleared when it gets too big."""
+    monkeypatch.setattr(inline, 'MAX_CACHED_FRAGMENTS', 1)
+    inline.inline(HTML)
+    inline.inline(HTML.replace('today', 'yesterday'))
+
+    assert len(inline._inlined) == 1
+    assert inline.inline(HTML) == premailer.Premailer(
+        inline.unmarked(HTML), output_xhtml=True).transform()
+
+
+def test_activity_email_same_as_premailer(db, redis):
+    """Output matches premailer's on a rendered activity email."""
+    recip = factories.ProfileFactory.create(
+        user__email='foo@example.com',
+        user__is_active=True,
+        notify_new_parent=True,
+        notify_added_to_village=True,
+        notify_teacher_post=True,
+        )
+    teacher = factories.ProfileFactory.create(school_staff=True, name='Teach')
+    rel = factories.RelationshipFactory.create(
+        from_profile=recip, to_profile__name='A Student')
+    other_rel = factories.RelationshipFactory.create(
+        from_profile=teacher, to_profile=rel.student)
+    for i in range(2):
+        post = factories.PostFactory.create(
+            author=teacher, student=rel.student, html_text='<b>hi</b> %s' % i)
+        record.post(recip, post)
+    record.new_parent(
+        recip, factories.TextSignupFactory.create(student=rel.student))
+    record.added_to_village(recip, other_rel.elder, rel.student)
+
+    rendered = []
+    def capture(html, base_url=None):
+        rendered.append((html, base_url))
+        return html
+    with mock.patch.object(inline, 'inline', capture):
+        base.render(recip)
+
+    [(html, base_url)] = rendered
+    expected = premailer.Premailer(
+        inline.unmarked(html), base_url=base_url, output_xhtml=True
+        ).transform()
+
+    assert html.count(inline.FRAGMENT_START) == 2
+    assert inline.inline(html, base_url=base_url) == expected
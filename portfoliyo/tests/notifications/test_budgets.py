@@ -0,0 +1,40 @@
+"""
+Query and Redis budgets for rendering and sending notification emails.
+
+Budgets must not grow with the number of pending notifications; if a change
+legitimately needs more queries or round-trips, raise the budget here.
+
+"""
+from portfoliyo.tests.notifications import bench
+
+
+
+# backlog sizes to benchmark
+BACKLOGS = [1, 5]
+
+# maximum (queries, redis round-trips) for any backlog size
+RENDER_BUDGET = (12, 2)
+# sending also clears the sent notifications, once sent
+SEND_BUDGET = (13, 3)
+
+
+
+def test_budgets(db, redis, request):
+    """Rendering and sending stay within fixed query and Redis budgets."""
+    results = [bench.run(backlog=backlog) for backlog in BACKLOGS]
+
+    json_path = request.config.getoption('--bench-json')
+    if json_path:
+        bench.write_json(results, json_path)
+
+    for result in results:
+        for stage, (queries, redis_calls) in [
+                ('render', RENDER_BUDGET), ('send', SEND_BUDGET)]:
+            counts = result[stage]
+            assert counts['queries'] <= queries, (
+                "%s of backlog %s took %s queries (budget %s)." % (
+                    stage, result['backlog'], counts['queries'], queries))
+            assert counts['redis_calls'] <= redis_calls, (
+                "%s of backlog %s took %s Redis calls (budget %s)." % (
+                    stage, result['backlog'], counts['redis_calls'],
+                    redis_calls))
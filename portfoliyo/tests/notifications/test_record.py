@@ -2,9 +2,9 @@
 import mock
 import pytest
 
-from portfoliyo.notifications import record
+from portfoliyo.notifications import record, schedule, store
 
-from portfoliyo.tests import factories
+from portfoliyo.tests import factories, utils
 
 
 
@@ -55,6 +55,51 @@ def test_village_additions_calls_new_teacher(db):
 
 
 
+def test_post_all(db, redis):
+    """Records notifications for whole audience in a batch."""
+    rel = factories.RelationshipFactory.create(
+        from_profile__school_staff=True)
+    rels = [
+        factories.RelationshipFactory.create(
+            to_profile=rel.student,
+            from_profile__user__email='elder%s@example.com' % i,
+            from_profile__notify_teacher_post=(i != 1),
+            )
+        for i in range(3)
+        ]
+    # no email address, so no notification
+    factories.RelationshipFactory.create(to_profile=rel.student)
+    post = factories.PostFactory.create(author=rel.elder, student=rel.student)
+
+    with utils.assert_num_queries(1):
+        with utils.assert_num_calls(redis, 2):
+            record.post_all(post)
+
+    assert sorted(schedule.scheduled_profile_ids()) == [
+        rels[0].elder.id, rels[2].elder.id]
+    for r in rels:
+        assert list(store.get_all(r.elder.id)) == [
+            {
+                'name': 'post',
+                'triggering': '0' if r is rels[1] else '1',
+                'post-id': str(post.id),
+                }
+            ]
+    assert store.pending_profile_ids() == {
+        str(rels[0].elder.id), str(rels[2].elder.id)}
+
+
+
+def test_post_all_no_audience(db, redis):
+    """If there's nobody to notify, does nothing."""
+    rel = factories.RelationshipFactory.create()
+    post = factories.PostFactory.create(author=rel.elder, student=rel.student)
+
+    with utils.assert_num_calls(redis, 0):
+        record.post_all(post)
+
+
+
 @pytest.fixture
 def mock_record(request):
     patcher = mock.patch('portfoliyo.notifications.record._record')
@@ -155,12 +200,12 @@ def test_record(mock_store):
 
 
 def test_record_triggering(mock_store):
-    """If triggering, triggers send_notification task."""
-    tgt = 'portfoliyo.notifications.record.tasks.send_notification_email.delay'
-    with mock.patch(tgt) as mock_task_delay:
+    """If triggering, schedules a notification email."""
+    tgt = 'portfoliyo.notifications.record.schedule.schedule'
+    with mock.patch(tgt) as mock_schedule:
         record._record(_profile(id=2), 'some', triggering=True)
 
-    mock_task_delay.assert_called_with(2)
+    mock_schedule.assert_called_with([2])
     mock_store.assert_called_with(
         2, 'some', triggering=True, data=None)
 
@@ -169,13 +214,13 @@ def test_record_triggering(mock_store):
 def test_record_triggering_disabled(mock_store):
     """If NOTIFICATION_EMAILS setting is ``False``, no email sent."""
     settings_tgt = 'portfoliyo.notifications.record.settings'
-    tgt = 'portfoliyo.notifications.record.tasks.send_notification_email.delay'
+    tgt = 'portfoliyo.notifications.record.schedule.schedule'
     with mock.patch(settings_tgt) as mock_settings:
-        with mock.patch(tgt) as mock_task_delay:
+        with mock.patch(tgt) as mock_schedule:
             mock_settings.NOTIFICATION_EMAILS = False
             record._record(_profile(id=2), 'some', triggering=True)
 
-    assert mock_task_delay.call_count == 0
+    assert mock_schedule.call_count == 0
 
 
 
@@ -0,0 +1,152 @@
+"""Tests for debounced notification-email scheduling."""
+import mock
+
+from portfoliyo.notifications import schedule, store
+from portfoliyo.tests import utils
+
+
+
+def test_schedule(redis, settings):
+    """Schedules send after the debounce window, in one round-trip."""
+    settings.NOTIFICATION_DEBOUNCE_SECONDS = 300
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        with utils.assert_num_calls(redis, 1):
+            assert schedule.schedule([1, 2]) == [1, 2]
+
+    assert schedule.scheduled_profile_ids() == {1: 1300, 2: 1300}
+
+
+
+def test_schedule_merges(redis, settings):
+    """Later triggers within the window don't push back the scheduled send."""
+    settings.NOTIFICATION_DEBOUNCE_SECONDS = 300
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        schedule.schedule([1])
+        t.return_value = 1100
+        assert schedule.schedule([1, 2]) == [2]
+
+    assert schedule.scheduled_profile_ids() == {1: 1300, 2: 1400}
+
+
+
+def test_schedule_delay(redis):
+    """Can schedule with an explicit delay."""
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        schedule.schedule([1], delay=0)
+
+    assert schedule.scheduled_profile_ids() == {1: 1000}
+
+
+
+def test_schedule_nothing(redis):
+    """Scheduling no profiles doesn't touch Redis."""
+    with utils.assert_num_calls(redis, 0):
+        assert schedule.schedule([]) == []
+
+
+
+def test_pop_due(redis):
+    """Pops only due profiles, earliest first, each only once."""
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        schedule.schedule([1], delay=20)
+        schedule.schedule([2], delay=10)
+        schedule.schedule([3], delay=100)
+        t.return_value = 1050
+        with utils.assert_num_calls(redis, 1):
+            assert schedule.pop_due() == [2, 1]
+        assert schedule.pop_due() == []
+
+    assert schedule.scheduled_profile_ids().keys() == [3]
+
+
+
+def test_pop_due_lease(redis):
+    """Claimed profiles are due again if not released before lease expiry."""
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        schedule.schedule([1, 2], delay=0)
+        assert schedule.pop_due(lease=60) == [1, 2]
+        schedule.release([2])
+        t.return_value = 1059
+        assert schedule.pop_due(lease=60) == []
+        t.return_value = 1060
+        assert schedule.pop_due(lease=60) == [1]
+        schedule.release([1])
+        t.return_value = 2000
+        assert schedule.pop_due(lease=60) == []
+
+
+
+def test_release_none(redis):
+    """Releasing no profiles does nothing."""
+    with utils.assert_num_calls(redis, 0):
+        schedule.release([])
+
+
+
+def test_pop_due_limit(redis):
+    """Can limit number of profiles popped."""
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        schedule.schedule([1, 2, 3], delay=0)
+        assert schedule.pop_due(limit=2) == [1, 2]
+        assert schedule.pop_due(limit=2) == [3]
+
+
+
+def test_dispatch_pending(redis):
+    """Schedules all pending profiles, a chunk at a time, staggered."""
+    for i in range(10):
+        store.store(i, 'some', triggering=True)
+
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        stats = schedule.dispatch_pending(chunk_size=3, interval=10)
+
+    scheduled = schedule.scheduled_profile_ids()
+    assert sorted(scheduled) == range(10)
+    assert stats['profiles'] == stats['scheduled'] == 10
+    assert stats['chunks'] > 1
+    assert sorted(set(scheduled.values())) == [
+        1000 + 10 * i for i in range(stats['chunks'])]
+    assert not stats['resumed']
+    assert redis.get(schedule.DISPATCH_CURSOR_KEY) is None
+
+
+
+def test_dispatch_pending_resumes(redis):
+    """Resumes a crashed dispatch from its saved cursor."""
+    for i in range(10):
+        store.store(i, 'some', triggering=True)
+    target = 'portfoliyo.notifications.schedule.schedule'
+    with mock.patch(target) as mock_schedule:
+        mock_schedule.side_effect = [[], Exception("boom")]
+        try:
+            schedule.dispatch_pending(chunk_size=3)
+        except Exception:
+            pass
+    first = mock_schedule.call_args_list[0][0][0]
+
+    stats = schedule.dispatch_pending(chunk_size=3)
+
+    assert stats['resumed']
+    assert sorted(schedule.scheduled_profile_ids()) == sorted(
+        set(range(10)) - set(int(i) for i in first))
+
+
+
+def test_dispatch_pending_no_double_send(redis):
+    """Re-dispatching already-scheduled profiles leaves their schedule."""
+    store.store(1, 'some', triggering=True)
+    with mock.patch('portfoliyo.notifications.schedule.time.time') as t:
+        t.return_value = 1000
+        schedule.schedule([1])
+        stats = schedule.dispatch_pending()
+        due = schedule.pop_due()
+
+    assert stats['scheduled'] == 0
+    assert due == []
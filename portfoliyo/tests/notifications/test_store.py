@@ -1,9 +1,15 @@
 """Tests for notification storage/retrieval."""
+import time
+
 from django.conf import settings
 import mock
 
 from portfoliyo.notifications import store
+from portfoliyo.tests import utils
+
 
+# a real current time, so Redis doesn't expire keys stored in tests
+NOW = time.time()
 
 
 def test_pending_profile_ids(redis):
@@ -17,6 +23,23 @@ def test_pending_profile_ids(redis):
 
 
 
+def test_scan_pending_profile_ids(redis):
+    """Scans profile IDs with triggering notifications in chunks."""
+    for i in range(10):
+        store.store(i, 'some', triggering=True)
+    store.store(10, 'other', triggering=False)
+
+    found = []
+    cursor, profile_ids = store.scan_pending_profile_ids(count=3)
+    found.extend(profile_ids)
+    while cursor:
+        cursor, profile_ids = store.scan_pending_profile_ids(cursor, count=3)
+        found.extend(profile_ids)
+
+    assert sorted(found, key=int) == [str(i) for i in range(10)]
+
+
+
 def test_get_all(redis):
     """Gets all data from all pending notifications."""
     store.store(1, 'some', data={'foo': 'bar'})
@@ -55,6 +78,25 @@ def test_get_all_clear(redis):
 
 
 
+def test_clear(redis):
+    """Clears only given notifications; profile pending while any remain."""
+    store.store(1, 'some', triggering=True)
+    ids = store.pending_ids(1)
+    store.store(1, 'newer', triggering=True)
+
+    with utils.assert_num_calls(redis, 1):
+        store.clear(1, ids)
+
+    assert [n['name'] for n in store.get_all(1)] == ['newer']
+    assert store.pending_profile_ids() == set(['1'])
+
+    store.clear(1, store.pending_ids(1))
+
+    assert list(store.get_all(1)) == []
+    assert store.pending_profile_ids() == set()
+
+
+
 def test_get_all_excludes_expired(redis):
     """Does not return expired notifications."""
     initial_time = 123456.789
@@ -66,3 +108,134 @@ def test_get_all_excludes_expired(redis):
         mock_time.return_value = expired_time
 
         assert list(store.get_all(1)) == []
+
+
+
+def _expiring(mock_time, profile_ids, triggering=True):
+    """Store notifications for ``profile_ids`` that are expired by ``NOW``."""
+    mock_time.return_value = NOW - settings.NOTIFICATION_EXPIRY_SECONDS - 10
+    store.store_many(profile_ids, 'old', triggering=triggering)
+    mock_time.return_value = NOW
+
+
+
+def test_get_all_trims_expired(redis):
+    """Trims expired notifications out of the pending set."""
+    with mock.patch('portfoliyo.notifications.store.time.time') as mock_time:
+        _expiring(mock_time, [1])
+        redis.zadd(store.make_pending_notifications_key(1), '+inf', 99)
+
+        list(store.get_all(1))
+
+    assert redis.zcard(store.make_pending_notifications_key(1)) == 1
+
+
+
+def test_store_trims_expired(redis):
+    """Storing a notification trims expired ones from the pending set."""
+    with mock.patch('portfoliyo.notifications.store.time.time') as mock_time:
+        _expiring(mock_time, [1, 1])
+        store.store(1, 'new')
+
+    assert redis.zcard(store.make_pending_notifications_key(1)) == 1
+
+
+
+def test_prune(redis):
+    """Prunes expired notifications and unpends emptied profiles."""
+    with mock.patch('portfoliyo.notifications.store.time.time') as mock_time:
+        _expiring(mock_time, [1, 1, 2])
+        redis.sadd(store.PENDING_PROFILES_KEY, 3)
+        redis.zadd(store.make_pending_notifications_key(2), '+inf', 99)
+
+        with utils.assert_num_calls(redis, 1):
+            assert store.prune([1, 2, 3]) == (3, 2)
+
+    assert store.pending_profile_ids() == {'2'}
+
+
+
+def test_prune_none(redis):
+    """Pruning no profiles does nothing."""
+    with utils.assert_num_calls(redis, 0):
+        assert store.prune([]) == (0, 0)
+
+
+
+def test_sweep(redis):
+    """Sweeps expired notifications for all profiles."""
+    with mock.patch('portfoliyo.notifications.store.time.time') as mock_time:
+        _expiring(mock_time, range(10))
+        _expiring(mock_time, [10], triggering=False)
+        redis.zadd(store.make_pending_notifications_key(5), '+inf', 99)
+
+        stats = store.sweep(chunk_size=3)
+
+    assert stats['pruned'] == 11
+    assert stats['unpended'] == 9
+    assert stats['checked'] >= 11
+    assert store.pending_profile_ids() == {'5'}
+    assert redis.zcard(store.make_pending_notifications_key(10)) == 0
+
+
+
+def test_store_returns_id(redis):
+    """Store returns per-profile sequential notification IDs."""
+    assert store.store(1, 'some') == 1
+    assert store.store(1, 'other') == 2
+    assert store.store(2, 'some') == 1
+
+
+
+def test_store_one_call(redis):
+    """Storing a notification takes a single Redis round-trip."""
+    with utils.assert_num_calls(redis, 1):
+        store.store(1, 'some', triggering=True, data={'foo': 'bar'})
+
+
+
+def test_store_many(redis):
+    """Can store the same notification for many profiles in one call."""
+    store.store(2, 'earlier')
+
+    with utils.assert_num_calls(redis, 1):
+        ids = store.store_many(
+            [1, 2, 3], 'some', triggering=True, data={'foo': 'bar'})
+
+    assert ids == [1, 2, 1]
+    expected = {'name': 'some', 'triggering': '1', 'foo': 'bar'}
+    assert list(store.get_all(1)) == [expected]
+    assert list(store.get_all(2))[1:] == [expected]
+    assert store.pending_profile_ids() == {'1', '2', '3'}
+
+
+
+def test_store_many_none(redis):
+    """Storing for no profiles does nothing."""
+    with utils.assert_num_calls(redis, 0):
+        assert store.store_many([], 'some') == []
+
+
+
+def test_get_all_round_trips(redis):
+    """Gets data for any number of notifications in two round-trips."""
+    for i in range(5):
+        store.store(1, 'some', data={'num': str(i)})
+
+    with utils.assert_num_calls(redis, 2):
+        res = list(store.get_all(1))
+
+    assert [n['num'] for n in res] == ['0', '1', '2', '3', '4']
+
+
+
+def test_get_all_chunked(redis):
+    """Can fetch notification data in chunks."""
+    for i in range(5):
+        store.store(1, 'some', data={'num': str(i)})
+
+    with utils.assert_num_calls(redis, 4):
+        res = list(store.get_all(1, clear=True, chunk_size=2))
+
+    assert [n['num'] for n in res] == ['0', '1', '2', '3', '4']
+    assert list(store.get_all(1)) == []
@@ -1,8 +1,9 @@
 """Tests for our transactional Celery behavior."""
+import mock
 import pytest
 
 from portfoliyo import celery, tasks, xact
-from portfoliyo.tests import factories
+from portfoliyo.tests import factories, utils
 
 
 
@@ -37,6 +38,79 @@ class TestTransactionTask(object):
 
 
 
+    def test_duplicate_tasks_sent(self, sms):
+        """Identical pending calls of a non-``dedupe`` task are all sent."""
+        with xact.xact():
+            for i in range(2):
+                tasks.send_sms.delay(
+                    '+15555555555', '+15555555555', 'something')
+
+        assert len(sms.outbox) == 2
+
+
+    def test_duplicate_dedupe_tasks_sent_once(self):
+        """Identical pending calls of a ``dedupe`` task are sent only once."""
+        with mock.patch('portfoliyo.pusher.events.posted') as mock_posted:
+            with xact.xact():
+                for i in range(2):
+                    tasks.push_event.delay('posted', 1)
+
+        mock_posted.assert_called_once_with(1)
+
+
+
+class TestPublish(object):
+    def test_publish(self):
+        """Drops duplicate dedupe calls; merges calls of batch-task tasks."""
+        calls = [
+            celery.Call(tasks.push_event, ('posted', 1), {'foo': 'bar'}, {}),
+            celery.Call(tasks.send_sms, ('+1', '+2', 'hi'), {}, {}),
+            celery.Call(tasks.push_event, ('posted', 2), {}, {}),
+            celery.Call(tasks.push_event, ('posted', 1), {'foo': 'bar'}, {}),
+            celery.Call(tasks.send_sms, ('+1', '+2', 'hi'), {}, {}),
+            celery.Call(tasks.push_event, ('posted', 3), {}, {'countdown': 5}),
+            ]
+        target = 'portfoliyo.tasks.%s.original_apply_async'
+        with mock.patch(target % 'push_events') as mock_push_events:
+            with mock.patch(target % 'push_event') as mock_push_event:
+                with mock.patch(target % 'send_sms') as mock_send_sms:
+                    stats = celery.publish(calls)
+
+        assert stats == {
+            'queued': 6, 'duplicates': 1, 'merged': 2, 'published': 4}
+        mock_push_events.assert_called_once_with(
+            ([(('posted', 1), {'foo': 'bar'}), (('posted', 2), {})],),
+            producer=None,
+            )
+        mock_push_event.assert_called_once_with(
+            ('posted', 3), {}, producer=None, countdown=5)
+        assert mock_send_sms.call_count == 2
+
+
+    def test_batch_of_one(self):
+        """A single call of a task with a batch task is sent as is."""
+        calls = [celery.Call(tasks.push_event, ('posted', 1), {}, {})]
+        target = 'portfoliyo.tasks.push_event.original_apply_async'
+        with mock.patch(target) as mock_push_event:
+            stats = celery.publish(calls)
+
+        assert stats['merged'] == 0
+        mock_push_event.assert_called_once_with(
+            ('posted', 1), {}, producer=None)
+
+
+    def test_merged_events_pushed(self):
+        """Merged push events are all sent, even if one fails."""
+        with mock.patch('portfoliyo.pusher.events.posted') as mock_posted:
+            mock_posted.side_effect = [Exception("boom"), None]
+            with xact.xact():
+                tasks.push_event.delay('posted', 1)
+                tasks.push_event.delay('posted', 2)
+
+        assert mock_posted.call_args_list == [mock.call(1), mock.call(2)]
+
+
+
 class TestModelReference(object):
     def test_from_instance(self, db):
         """Can flatten a model instance into a reference."""
@@ -121,6 +195,48 @@ class TestModelReference(object):
 
 
 
+    def test_find(self):
+        """Finds all references in a value, including in sequences."""
+        mr1 = celery.ModelReference('auth', 'user', 1)
+        mr2 = celery.ModelReference('auth', 'user', 2)
+
+        assert celery.ModelReference.find([mr1, 3, [mr2]]) == [mr1, mr2]
+
+
+    def test_load(self, db):
+        """Loads referenced instances into cache, one query per model."""
+        users = [factories.UserFactory.create() for i in range(2)]
+        profile = factories.ProfileFactory.create()
+        refs = [celery.ModelReference.from_instance(u) for u in users]
+        refs.append(celery.ModelReference.from_instance(profile))
+        refs.append(celery.ModelReference('auth', 'user', -1))
+        refs.append(celery.ModelReference('no', 'such', 'class'))
+        cache = {}
+
+        with utils.assert_num_queries(2):
+            celery.ModelReference.load(refs, cache)
+
+        assert cache == {
+            ('auth', 'user', users[0].pk): users[0],
+            ('auth', 'user', users[1].pk): users[1],
+            ('users', 'profile', profile.pk): profile,
+            }
+
+
+    def test_load_select_related(self, db):
+        """Can load related objects along with referenced instances."""
+        profile = factories.ProfileFactory.create()
+        ref = celery.ModelReference.from_instance(profile)
+        cache = {}
+
+        celery.ModelReference.load(
+            [ref], cache, select_related={'users.profile': ['user']})
+
+        with utils.assert_num_queries(0):
+            assert cache[ref.as_tuple()].user == profile.user
+
+
+
 class TestModelTask(object):
     def test_dereference_fails(self):
         """If dereferencing fails, skips task execution and returns None."""
@@ -128,3 +244,44 @@ class TestModelTask(object):
         mt = celery.ModelTask()
 
         assert mt(bad_mr) is None
+
+
+    def test_batched_dereference(self, db):
+        """Model arguments of the same class are loaded in one query."""
+        added_by, teacher1, teacher2, student = [
+            factories.ProfileFactory.create() for i in range(4)]
+        args = [
+            celery.ModelReference.from_instance(a)
+            for a in [added_by, [teacher1, teacher2], [student]]
+            ]
+        target = 'portfoliyo.notifications.record.village_additions'
+        with mock.patch(target) as mock_village_additions:
+            with utils.assert_num_queries(1):
+                tasks.record_notification('village_additions', *args)
+
+        called_args = mock_village_additions.call_args[0]
+        assert called_args == (added_by, [teacher1, teacher2], [student])
+        with utils.assert_num_queries(0):
+            called_args[0].user
+
+
+
+def test_routes():
+    """Latency-sensitive tasks are routed apart from bulk and analytics."""
+    router = celery.celery.amqp.router
+
+    def _queue(task):
+        return router.route({}, task.name)['queue']
+
+    assert _queue(tasks.send_sms) == 'realtime'
+    assert _queue(tasks.push_event) == 'realtime'
+    assert _queue(tasks.send_notification_emails) == 'bulk'
+    assert _queue(tasks.mixpanel) == 'analytics'
+    assert _queue(tasks.record_notification) == 'bulk'
+
+
+
+def test_beat_schedule():
+    """Periodic tasks are configured."""
+    assert 'send-scheduled-notifications' in (
+        celery.celery.conf.CELERYBEAT_SCHEDULE)
@@ -5,10 +5,18 @@ These tests will also run against a real Redis, if configured, verifying the
 tests themselves.
 
 """
-import mock
+import logging
+import threading
 
+import mock
 import pytest
-from redis.exceptions import ResponseError
+from redis.exceptions import NoScriptError, ResponseError
+
+from django.core.exceptions import ImproperlyConfigured
+
+from portfoliyo import redis as redis_module
+from portfoliyo.redis import InMemoryRedis, memory_report, script
+from portfoliyo.tests import utils
 
 
 
@@ -33,6 +41,14 @@ def test_sets_convert_to_str(redis):
     assert redis.smembers('foo') == set()
 
 
+def test_set_return_values(redis):
+    """SADD and SREM return number of members actually added/removed."""
+    assert redis.sadd('foo', 'bar') == 1
+    assert redis.sadd('foo', 'bar') == 0
+    assert redis.srem('foo', 'bar') == 1
+    assert redis.srem('foo', 'bar') == 0
+
+
 def test_delete(redis):
     """Test in-memory implementation of Redis delete."""
     redis.delete('foo')
@@ -48,6 +64,28 @@ def test_incr(redis):
     assert redis.incr('foo') == 2
 
 
+def test_hincrby(redis):
+    """Test in-memory implementation of Redis hincrby and hdel."""
+    assert redis.hincrby('foo', 3, 2) == 2
+    assert redis.hincrby('foo', 3, -1) == 1
+    assert redis.hincrby('foo', 'bar') == 1
+    assert redis.hgetall('foo') == {'3': '1', 'bar': '1'}
+    assert redis.hdel('foo', 'bar') == 1
+    assert redis.hdel('foo', 'bar') == 0
+    assert redis.hgetall('foo') == {'3': '1'}
+
+
+def test_get_set(redis):
+    """Test in-memory implementation of Redis get, set, incr and keys."""
+    assert redis.get('foo') is None
+    redis.set('foo', 3)
+    assert redis.get('foo') == '3'
+    assert redis.incr('foo') == 4
+    assert redis.get('foo') == '4'
+    redis.set('bar', 'baz')
+    assert sorted(redis.keys('ba*')) == ['bar']
+
+
 def test_pipeline(redis):
     """Test in-memory implementation of Redis pipelining."""
     p = redis.pipeline()
@@ -82,6 +120,148 @@ def test_sorted_sets(redis):
         '0', 'three', 'five', 'eight']
 
 
+def test_sorted_set_return_values(redis):
+    """zadd returns count of new members; zrem count of removed."""
+    assert redis.zadd('foo', 1, 'one', 2, 'two') == 2
+    assert redis.zadd('foo', 3, 'two') == 0
+    assert redis.zrem('foo', 'two') == 1
+    assert redis.zrem('foo', 'two') == 0
+    assert redis.zcard('foo') == 1
+    assert redis.zscore('foo', 'one') == 1.0
+
+
+def test_zrangebyscore_exclusive_and_limit(redis):
+    """zrangebyscore supports exclusive bounds and start/num limiting."""
+    for i in range(10):
+        redis.zadd('foo', i, 'm%s' % i)
+
+    assert redis.zrangebyscore('foo', '(2', '(5') == ['m3', 'm4']
+    assert redis.zrangebyscore('foo', 2, 8, start=1, num=3) == [
+        'm3', 'm4', 'm5']
+    assert redis.zcount('foo', '-inf', '(5') == 5
+
+
+def test_zrevrangebyscore(redis):
+    """zrevrangebyscore returns members newest first, optionally scored."""
+    for i in range(5):
+        redis.zadd('foo', i, 'm%s' % i)
+
+    assert redis.zrevrangebyscore('foo', '(4', 1) == ['m3', 'm2', 'm1']
+    assert redis.zrevrangebyscore('foo', '+inf', '-inf', start=0, num=2) == [
+        'm4', 'm3']
+    assert redis.zrangebyscore(
+        'foo', '-inf', '+inf', start=0, num=1, withscores=True) == [
+        ('m0', 0.0)]
+
+
+def test_zremrangebyscore(redis):
+    """zremrangebyscore removes and counts members in score range."""
+    for i in range(5):
+        redis.zadd('foo', i, 'm%s' % i)
+
+    assert redis.zremrangebyscore('foo', '-inf', 2) == 3
+    assert redis.zrangebyscore('foo', '-inf', '+inf') == ['m3', 'm4']
+
+
+def test_zremrangebyrank(redis):
+    """zremrangebyrank removes members by rank, counting from either end."""
+    for i in range(5):
+        redis.zadd('foo', i, 'm%s' % i)
+
+    assert redis.zremrangebyrank('foo', 0, -4) == 2
+    assert redis.zrangebyscore('foo', '-inf', '+inf') == ['m2', 'm3', 'm4']
+    assert redis.zremrangebyrank('foo', 0, -4) == 0
+
+
+def test_scan_iter(redis):
+    """scan_iter returns all matching keys exactly once, in many steps."""
+    for i in range(25):
+        redis.set('foo:%s' % i, i)
+    redis.set('bar', 1)
+
+    found = list(redis.scan_iter(match='foo:*', count=3))
+
+    assert sorted(found) == sorted('foo:%s' % i for i in range(25))
+
+
+def test_scan_iter_while_deleting(redis):
+    """Deleting already-scanned keys doesn't cause any keys to be skipped."""
+    for i in range(25):
+        redis.set('foo:%s' % i, i)
+
+    found = []
+    for key in redis.scan_iter(count=3):
+        found.append(key)
+        redis.delete(key)
+
+    assert sorted(found) == sorted('foo:%s' % i for i in range(25))
+
+
+def test_sscan(redis):
+    """sscan returns all set members exactly once, in many steps."""
+    redis.sadd('foo', *range(25))
+
+    found = []
+    cursor = None
+    while cursor != 0:
+        cursor, members = redis.sscan('foo', cursor or 0, count=3)
+        found.extend(members)
+
+    assert sorted(found) == sorted(str(i) for i in range(25))
+
+
+def test_memory_usage(redis):
+    """memory_usage returns a size for each key, zero if it doesn't exist."""
+    redis.set('foo', 'bar')
+    redis.hmset('baz', {'one': 'two'})
+
+    sizes = redis.memory_usage(['foo', 'baz', 'nope'])
+
+    assert sizes[0] > 0
+    assert sizes[1] > 0
+    assert sizes[2] == 0
+
+
+def test_memory_report(redis):
+    """memory_report totals keys and sizes by key prefix."""
+    redis.set('unread:1:2', 'x')
+    redis.set('unread:1:3', 'x')
+    redis.set('notify:1', 'x')
+
+    report = memory_report(batch_size=2)
+
+    assert sorted(report) == ['notify', 'unread']
+    assert report['unread']['keys'] == 2
+    assert report['notify']['keys'] == 1
+    assert report['unread']['bytes'] > report['notify']['bytes']
+
+
+@script("return redis.call('INCRBY', KEYS[1], ARGV[1])")
+def _incrby_script(client, keys, args):
+    for i in range(int(args[0])):
+        ret = client.incr(keys[0])
+    return ret
+
+
+def test_script(redis):
+    """Scripts run in one round-trip (as Python, in the in-memory Redis)."""
+    with utils.assert_num_calls(redis, 1):
+        assert _incrby_script(keys=['foo'], args=[3]) == 3
+
+    assert redis.get('foo') == '3'
+
+
+def test_script_loads_if_needed():
+    """On a real Redis, scripts not yet known to the server are sent whole."""
+    client = mock.Mock()
+    client.evalsha.side_effect = NoScriptError()
+    client.eval.return_value = 4
+
+    assert _incrby_script(keys=['foo'], args=[3], redis_client=client) == 4
+    client.evalsha.assert_called_once_with(_incrby_script.sha, 1, 'foo', 3)
+    client.eval.assert_called_once_with(_incrby_script.lua, 1, 'foo', 3)
+
+
 def test_expireat(redis):
     """Test in-memory implementation of expireat."""
     with mock.patch('portfoliyo.redis.time') as mock_time:
@@ -108,3 +288,226 @@ def test_copies(redis):
     d.pop('one')
 
     assert redis.hgetall('foo') == {'one': 'one'}
+
+
+
+def test_expired_keys_swept_on_any_command():
+    """Expired keys are freed by the next command, even if never re-read."""
+    r = InMemoryRedis()
+    with mock.patch('portfoliyo.redis.time') as mock_time:
+        mock_time.return_value = 5.123
+        r.hmset('foo', {'one': 'one'})
+        r.expireat('foo', 10)
+        r.hmset('bar', {'one': 'one'})
+        r.expireat('bar', 20)
+        mock_time.return_value = 11.331
+
+        r.incr('baz')
+
+        assert set(r.data) == {'bar', 'baz'}
+        assert set(r.expiry) == {'bar'}
+
+
+def test_emptied_collections_are_deleted():
+    """Removing the last member of a collection deletes the key."""
+    r = InMemoryRedis()
+    r.sadd('set', 'a')
+    r.srem('set', 'a')
+    r.hincrby('hash', 'a')
+    r.hdel('hash', 'a')
+    r.zadd('zset', 1, 'a')
+    r.zrem('zset', 'a')
+
+    assert r.data == {}
+
+
+def test_thread_safe():
+    """Concurrent commands and pipelines from many threads are serialized."""
+    r = InMemoryRedis()
+
+    def _work():
+        for i in range(200):
+            r.incr('counter')
+            r.pipeline().sadd('set', i).hincrby('hash', 'f').execute()
+
+    threads = [threading.Thread(target=_work) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert r.get('counter') == '1000'
+    assert r.scard('set') == 200
+    assert r.hgetall('hash') == {'f': '1000'}
+
+
+
+class TestRedisStats(object):
+    def test_records_calls_and_pipelines(self, redis):
+        """Active RedisStats record round-trips, commands and pipeline size."""
+        from portfoliyo.redis import start_stats, stop_stats
+        stats = start_stats('test')
+        redis.incr('foo')
+        redis.pipeline().incr('foo').incr('bar').sadd('baz', 1).execute()
+        stop_stats(stats)
+        redis.incr('foo')
+
+        assert stats.calls == 2
+        assert stats.commands == 4
+        assert stats.max_pipeline == 3
+        assert stats.as_header().startswith(
+            'calls=2; commands=4; max-pipeline=3; ms=')
+
+
+    def test_nested(self, redis):
+        """Calls are recorded in all active (nested) RedisStats."""
+        from portfoliyo.redis import start_stats, stop_stats
+        outer = start_stats('outer')
+        redis.incr('foo')
+        inner = start_stats('inner')
+        redis.incr('foo')
+        stop_stats(inner)
+        stop_stats(outer)
+
+        assert outer.calls == 2
+        assert inner.calls == 1
+
+
+    def test_over_budget_logs_warning(self, redis):
+        """Exceeding REDIS_CALL_BUDGET logs at warning level."""
+        from portfoliyo.redis import start_stats, stop_stats
+        stats = start_stats('test')
+        redis.incr('foo')
+        redis.incr('foo')
+        stop_stats(stats)
+
+        with mock.patch('portfoliyo.redis.settings') as mock_settings:
+            mock_settings.REDIS_CALL_BUDGET = 1
+            with mock.patch('portfoliyo.redis.logger') as mock_logger:
+                stats.log()
+
+        assert mock_logger.log.call_args[0][0] == logging.WARNING
+        assert mock_logger.log.call_args[1]['extra']['redis_stats'][
+            'calls'] == 2
+
+
+    def test_response_header(self, client, settings):
+        """If enabled, each response reports its Redis usage in a header."""
+        settings.REDIS_STATS_HEADER = True
+        response = client.get('/login/')
+
+        assert response.headers['X-Redis-Stats'].startswith('calls=0;')
+
+
+    def test_no_response_header(self, client, settings):
+        """The Redis usage header can be disabled."""
+        settings.REDIS_STATS_HEADER = False
+        response = client.get('/login/')
+
+        assert 'X-Redis-Stats' not in response.headers
+
+
+    def test_task_stats_logged(self, redis):
+        """Celery tasks log their Redis usage."""
+        from portfoliyo.celery import celery
+
+        @celery.task
+        def redis_task():
+            redis.incr('foo')
+
+        with mock.patch('portfoliyo.redis.logger') as mock_logger:
+            redis_task.delay()
+
+        stats = mock_logger.log.call_args[1]['extra']['redis_stats']
+        assert stats['calls'] == 1
+
+
+    def test_task_stats_not_logged_if_no_calls(self, redis):
+        """Celery tasks that don't use Redis don't log Redis usage."""
+        from portfoliyo.celery import celery
+
+        @celery.task
+        def no_redis_task():
+            pass
+
+        with mock.patch('portfoliyo.redis.logger') as mock_logger:
+            no_redis_task.delay()
+
+        assert not mock_logger.log.called
+
+
+
+class TestRoles(object):
+    def test_unconfigured_role_uses_default_client(self, redis):
+        assert redis_module.get_client('notifications') is redis
+        assert redis_module.get_clients() == [redis]
+
+
+    def test_configured_role(self, redis, monkeypatch):
+        other = InMemoryRedis()
+        monkeypatch.setattr(
+            redis_module, '_role_clients', {'announcements': other})
+
+        assert redis_module.get_client('announcements') is other
+        assert redis_module.get_client('unread', shard_key=3) is redis
+        assert redis_module.get_clients() == [redis, other]
+
+
+    def test_sharded_role(self, redis, monkeypatch):
+        shards = {'a': InMemoryRedis(), 'b': InMemoryRedis()}
+        monkeypatch.setattr(
+            redis_module,
+            '_role_clients',
+            {'unread': redis_module.HashRing(shards)},
+            )
+
+        used = set(
+            redis_module.get_client('unread', shard_key=i) for i in range(50))
+
+        assert used == set(shards.values())
+        assert redis_module.get_client('unread', shard_key=7) is (
+            redis_module.get_client('unread', shard_key=7))
+        assert redis_module.get_clients('unread') == [shards['a'], shards['b']]
+        with pytest.raises(ValueError):
+            redis_module.get_client('unread')
+
+
+    def test_configure_roles(self):
+        roles = redis_module._configure_roles({
+                'notifications': {
+                    'URL': 'redis://example.com:6380/2',
+                    'MAX_CONNECTIONS': 7,
+                    },
+                'unread': {'SHARDS': ['redis://one', 'redis://two']},
+                })
+
+        pool = roles['notifications'].connection_pool
+        assert pool.connection_kwargs['host'] == 'example.com'
+        assert pool.connection_kwargs['port'] == 6380
+        assert pool.connection_kwargs['db'] == 2
+        assert pool.max_connections == 7
+        assert sorted(roles['unread'].nodes) == ['redis://one', 'redis://two']
+
+
+    def test_only_unread_can_be_sharded(self):
+        with pytest.raises(ImproperlyConfigured):
+            redis_module._configure_roles(
+                {'notifications': {'SHARDS': ['redis://one']}})
+
+
+    def test_unknown_role(self):
+        with pytest.raises(ImproperlyConfigured):
+            redis_module._configure_roles({'foo': {'URL': 'redis://one'}})
+
+
+
+class TestHashRing(object):
+    def test_adding_node_moves_few_keys(self):
+        """Adding a third node moves roughly a third of keys."""
+        two = redis_module.HashRing({'a': 'a', 'b': 'b'})
+        three = redis_module.HashRing({'a': 'a', 'b': 'b', 'c': 'c'})
+
+        moved = [k for k in range(1000) if two.get(k) != three.get(k)]
+
+        assert all(three.get(k) == 'c' for k in moved)
+        assert 200 < len(moved) < 450
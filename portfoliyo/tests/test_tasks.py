@@ -6,12 +6,89 @@ from portfoliyo import tasks
 
 
 def test_check_for_pending_notifications():
-    """Triggers send_notification_email task for all pending profile IDs."""
-    target1 = 'portfoliyo.tasks.send_notification_email'
-    target2 = 'portfoliyo.notifications.store.pending_profile_ids'
-    with mock.patch(target1) as mock_send_notification:
-        with mock.patch(target2) as mock_pending_profile_ids:
-            mock_pending_profile_ids.return_value = [5]
-            tasks.check_for_pending_notifications.delay()
-
-    mock_send_notification.delay.assert_called_once_with(5)
+    """Dispatches all pending profile IDs to be scheduled."""
+    target = 'portfoliyo.notifications.schedule.dispatch_pending'
+    with mock.patch(target) as mock_dispatch_pending:
+        mock_dispatch_pending.return_value = {
+            'chunks': 1, 'profiles': 1, 'scheduled': 1, 'resumed': False}
+        tasks.check_for_pending_notifications.delay()
+
+    mock_dispatch_pending.assert_called_once_with()
+
+
+
+def test_send_scheduled_notifications(settings):
+    """Sends notification emails to due profiles, in batches."""
+    settings.NOTIFICATION_SEND_BATCH_SIZE = 2
+    target1 = 'portfoliyo.notifications.schedule.pop_due'
+    target2 = 'portfoliyo.tasks.send_notification_emails'
+    with mock.patch(target1) as mock_pop_due:
+        with mock.patch(target2) as mock_send_notifications:
+            mock_pop_due.side_effect = [[1, 2], [3], []]
+            tasks.send_scheduled_notifications.delay()
+
+    assert mock_pop_due.call_args_list == [mock.call(2)] * 3
+    assert mock_send_notifications.delay.call_args_list == [
+        mock.call([1, 2]), mock.call([3])]
+
+
+
+def test_send_notification_emails():
+    """Sends emails; reschedules failures and releases all claims."""
+    target = 'portfoliyo.notifications.%s'
+    with mock.patch(target % 'render.send_many') as mock_send_many:
+        with mock.patch(target % 'schedule.schedule') as mock_schedule:
+            with mock.patch(target % 'schedule.release') as mock_release:
+                mock_send_many.return_value = {
+                    'sent': 1,
+                    'skipped': 0,
+                    'failed': 1,
+                    'seconds': 1.0,
+                    'failed_profile_ids': [2],
+                    }
+                tasks.send_notification_emails.delay([1, 2])
+
+    mock_send_many.assert_called_once_with([1, 2])
+    mock_schedule.assert_called_once_with([2])
+    mock_release.assert_called_once_with([1, 2])
+
+
+
+def test_sweep_notifications():
+    """Sweeps expired pending notifications."""
+    target = 'portfoliyo.notifications.store.sweep'
+    with mock.patch(target) as mock_sweep:
+        mock_sweep.return_value = {'checked': 2, 'pruned': 3, 'unpended': 1}
+        tasks.sweep_notifications.delay()
+
+    mock_sweep.assert_called_once_with()
+
+
+
+def test_compact_redis(settings):
+    """Compacts unread state to configured maximum and reports memory."""
+    settings.UNREAD_MAX_PER_VILLAGE = 7
+    target1 = 'portfoliyo.model.unread.compact'
+    target2 = 'portfoliyo.redis.memory_report'
+    with mock.patch(target1) as mock_compact:
+        with mock.patch(target2) as mock_memory_report:
+            mock_compact.return_value = {
+                'scanned': 1, 'deleted': 0, 'trimmed': 0}
+            mock_memory_report.return_value = {
+                'unread': {'keys': 1, 'bytes': 10}}
+            tasks.compact_redis.delay()
+
+    mock_compact.assert_called_once_with(7)
+    mock_memory_report.assert_called_once_with()
+
+
+
+def test_send_notification_emails():
+    """Sends notification emails to all profiles in one batch."""
+    target = 'portfoliyo.notifications.render.send_many'
+    with mock.patch(target) as mock_send_many:
+        mock_send_many.return_value = {
+            'sent': 1, 'skipped': 0, 'failed': 1, 'seconds': 0.5}
+        tasks.send_notification_emails.delay([3, 4])
+
+    mock_send_many.assert_called_once_with([3, 4])
@@ -4,6 +4,7 @@ import datetime
 
 from django.core import mail
 from django.core.urlresolvers import reverse
+from django.utils.timezone import utc
 import mock
 import pytest
 
@@ -804,6 +805,72 @@ class TestGetPosts(object):
         assert data['meta']['more'] == True
 
 
+    def test_extends_back_to_first_unread(self, db, redis):
+        """Backlog reaches back to include the oldest unread post."""
+        rel = factories.RelationshipFactory.create()
+        posts = [
+            factories.PostFactory.create(
+                student=rel.student,
+                timestamp=datetime.datetime(2013, 1, 25, i, tzinfo=utc),
+                )
+            for i in range(5)
+            ]
+        model.unread.mark_unread(posts[1], rel.elder)
+        model.unread.mark_unread(posts[3], rel.elder)
+        with mock.patch.object(views, 'BACKLOG_POSTS', 2):
+            data = views._get_posts(rel.elder, student=rel.student)
+
+        self.assert_posts(data, posts[1:])
+        assert [p['unread'] for p in data['objects']] == [
+            True, False, True, False]
+        assert data['meta']['limit'] == 4
+        assert data['meta']['more'] == True
+
+
+    def test_first_unread_included_despite_score_rounding(self, db, redis):
+        """Oldest unread post is included even if its score rounds later."""
+        rel = factories.RelationshipFactory.create()
+        posts = [
+            factories.PostFactory.create(
+                student=rel.student,
+                timestamp=datetime.datetime(2013, 1, 25, i, tzinfo=utc),
+                )
+            for i in range(3)
+            ]
+        model.unread.mark_unread(posts[0], rel.elder)
+        rounded = (
+            str(posts[0].id),
+            posts[0].timestamp + datetime.timedelta(microseconds=1),
+            )
+        with mock.patch.object(views, 'BACKLOG_POSTS', 1):
+            with mock.patch.object(
+                    model.unread, 'oldest_unread', return_value=rounded):
+                data = views._get_posts(rel.elder, student=rel.student)
+
+        self.assert_posts(data, posts)
+        assert [p['unread'] for p in data['objects']] == [True, False, False]
+
+
+    def test_unread_backlog_capped(self, db, redis):
+        """Backlog extends back at most MAX_UNREAD_BACKLOG_POSTS posts."""
+        rel = factories.RelationshipFactory.create()
+        posts = [
+            factories.PostFactory.create(
+                student=rel.student,
+                timestamp=datetime.datetime(2013, 1, 25, i, tzinfo=utc),
+                )
+            for i in range(5)
+            ]
+        for post in posts:
+            model.unread.mark_unread(post, rel.elder)
+        with mock.patch.object(views, 'BACKLOG_POSTS', 1):
+            with mock.patch.object(views, 'MAX_UNREAD_BACKLOG_POSTS', 3):
+                data = views._get_posts(rel.elder, student=rel.student)
+
+        self.assert_posts(data, posts[2:])
+        assert all(p['unread'] for p in data['objects'])
+
+
 
 class TestVillage(GroupContextTests):
     """Tests for village chat view."""
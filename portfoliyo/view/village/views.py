@@ -23,6 +23,8 @@ from . import forms
 
 # number of posts to show in backlog
 BACKLOG_POSTS = 15
+# max posts to show in backlog when extending it back to the first unread post
+MAX_UNREAD_BACKLOG_POSTS = 50
 
 
 @login_required
@@ -333,10 +335,14 @@ def _get_posts(profile, student=None, group=None):
     Get all posts for given student/group; list them as read/unread by given
     ``profile``.
 
+    In a student village, the backlog extends back to include the profile's
+    oldest unread post (up to ``MAX_UNREAD_BACKLOG_POSTS``), and only the
+    unread IDs within the backlog are loaded.
+
     """
-    all_unread = set()
+    first_unread = None
     if student:
-        all_unread = model.unread.all_unread(student, profile)
+        first_unread = model.unread.oldest_unread(student, profile)
         queryset = student.posts_in_village.select_related(
             'author__user', 'student', 'relationship').prefetch_related(
             'attachments')
@@ -351,25 +357,37 @@ def _get_posts(profile, student=None, group=None):
 
     post_data = []
     count = 0
+    limit = BACKLOG_POSTS
     if queryset is not None:
         count = queryset.count()
+        posts = []
+        if first_unread is not None:
+            posts = list(
+                queryset.filter(id__gte=first_unread[0]).order_by(
+                    '-timestamp')[:MAX_UNREAD_BACKLOG_POSTS])
+            limit = max(len(posts), BACKLOG_POSTS)
+        if len(posts) < BACKLOG_POSTS:
+            posts = list(queryset.order_by('-timestamp')[:BACKLOG_POSTS])
+        all_unread = set()
+        if first_unread is not None and posts:
+            all_unread = set(
+                model.unread.unread_in_range(
+                    student, profile, since=posts[-1].timestamp))
         post_data = [
             serializers.post2dict(
                 post,
                 unread=str(post.id) in all_unread,
                 mine=post.author == profile,
                 )
-            for post in reversed(
-                queryset.order_by(
-                    '-timestamp')[:BACKLOG_POSTS])
+            for post in reversed(posts)
             ]
 
     return {
         'objects': post_data,
         'meta': {
             'total_count': count,
-            'limit': BACKLOG_POSTS,
-            'more': count > BACKLOG_POSTS,
+            'limit': limit,
+            'more': count > limit,
             },
         }
 
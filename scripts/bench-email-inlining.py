@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Benchmark CSS inlining of notification emails.
+
+Usage: scripts/bench-email-inlining.py [--villages N] [--posts N] [--emails N]
+
+Renders a synthetic ``notifications/activity.html`` email (no database needed)
+with the given number of villages and posts per village, then reports emails
+per second for inlining it with a fresh ``premailer.Premailer`` per email
+(before) and with ``portfoliyo.notifications.render.inline`` (after), which
+inlines each post body only once and then only the rest of every email.
+The measured emails are all the same, so "fragments" shows the cost once
+each post body has been inlined (as it is when the same posts go out in many
+emails); "cold" clears the inlined-fragment cache before every email (no post
+shared with an earlier email).
+
+Exits with an error if the two produce different output.
+
+"""
+import argparse
+import os
+import sys
+import time
+
+
+
+class Obj(object):
+    """Stand-in for a model instance in the template context."""
+    def __init__(self, name='', **kw):
+        self.name = name
+        self.__dict__.update(kw)
+
+
+    def __unicode__(self):
+        return self.name
+
+
+
+def make_context(num_villages, posts_per_village):
+    recipient = Obj('Recipient', id=1)
+    villages = []
+    for i in range(num_villages):
+        student = Obj('Student %s' % i, id=100 + i)
+        posts = [
+            Obj(
+                author_id=recipient.id if j % 3 == 0 else 2,
+                author='Author %s' % j,
+                role='Teacher' if j % 3 == 0 else 'Mother',
+                new=j % 2 == 0,
+                timestamp_display='Jan 1, 2013 at 1:%02d p.m.' % j,
+                text='Post <a href="/foo/">number</a> %s.' % j,
+                fragment_key='%s-%s' % (i, j),
+                )
+            for j in range(posts_per_village)
+            ]
+        villages.append(Obj(student=student, posts=posts))
+    return {
+        'recipient': recipient,
+        'any_requested_posts': True,
+        'requested_villages': villages,
+        'any_requested_new_parent': True,
+        'signups': [
+            Obj(
+                family=Obj('Family %s' % i),
+                student=v.student,
+                role='Father',
+                group=None,
+                )
+            for i, v in enumerate(villages)
+            ],
+        }
+
+
+
+def emails_per_second(func, num_emails):
+    start = time.time()
+    for i in range(num_emails):
+        func()
+    return num_emails / (time.time() - start)
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark CSS inlining of notification emails.")
+    parser.add_argument('--villages', type=int, default=5)
+    parser.add_argument('--posts', type=int, default=5)
+    parser.add_argument('--emails', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    from django.conf import settings
+    from django.template.loader import render_to_string
+    import premailer
+    from portfoliyo.notifications.render import base, inline
+
+    context = make_context(args.villages, args.posts)
+    # don't let rendered-fragment caching skew the benchmark
+    context['fragment_cache_seconds'] = 0
+    context['fragment_version'] = base.FRAGMENT_VERSION
+    context['LANGUAGE_CODE'] = settings.LANGUAGE_CODE
+    html = render_to_string(base.HTML_TEMPLATE, context)
+    base_url = settings.PORTFOLIYO_BASE_URL
+
+    def before():
+        return premailer.Premailer(
+            inline.unmarked(html), base_url=base_url, output_xhtml=True
+            ).transform()
+
+    def after():
+        return inline.inline(html, base_url=base_url)
+
+    def cold():
+        inline._inlined.clear()
+        return after()
+
+    if before() != after():
+        sys.exit("Inlined output differs from premailer output.")
+
+    print "%s villages, %s posts per village, %s bytes of HTML" % (
+        args.villages, args.posts, len(html))
+    for name, func in [
+            ('premailer', before), ('fragments', after), ('cold', cold)]:
+        print "%-12s %8.1f emails/sec" % (
+            name, emails_per_second(func, args.emails))
+
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault(
+        'DJANGO_SETTINGS_MODULE', 'portfoliyo.settings.default')
+    main(sys.argv[1:])
@@ -19,6 +19,13 @@ var PYO = (function (PYO, $) {
         }
     };
 
+    PYO.scrollToPost = function (post) {
+        if (PYO.feedPosts.length && post.length) {
+            var offset = post.offset().top - PYO.feedPosts.offset().top;
+            PYO.feedPosts.scrollTop(PYO.feedPosts.scrollTop() + offset).scroll();
+        }
+    };
+
     PYO.scrolledToBottom = function () {
         var bottom = false;
         if (PYO.feedPosts.length && PYO.feedPosts.get(0).scrollHeight - PYO.feedPosts.scrollTop() - PYO.feedPosts.outerHeight() <= 50) {
@@ -492,6 +499,7 @@ var PYO = (function (PYO, $) {
 
     PYO.initializeFeed = function () {
         var posts = PYO.feed.find('.post');
+        var firstUnread = posts.filter('.unread').first();
 
         posts.find('.details').html5accordion();
         PYO.authorPosts = posts.filter('.mine').length;
@@ -509,6 +517,8 @@ var PYO = (function (PYO, $) {
         PYO.submitPost();
         PYO.characterCount('.village-main');
         PYO.scrollToBottom();
+        // open at the first unread post, if any
+        PYO.scrollToPost(firstUnread);
         PYO.scrollForBacklog();
 
         $('.post-add-form').resize(function () {